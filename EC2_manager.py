@@ -1,139 +1,336 @@
-import boto3
+import json
+import math
 import time 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-def ec2_menu():
+import botocore
+
+import job_manager
+
+def ec2_menu(ctx):
     while True:
         print("\n EC2 MENU")
         print("1. Launch EC2 instance")
         print("2. Manage EC2 instances")
-        print("3. Return to main menu")
+        print("3. Fleet actions")
+        print("4. Background jobs")
+        print("5. Return to main menu")
 
         try:
-            choice = int(input("Select an option (1-3): ").strip())
+            choice = int(input("Select an option (1-5): ").strip())
         except ValueError:
             print("Please enter a valid number: ")
             continue 
 
-        if choice == 1:
-            launch_instance()
-        
-        elif choice == 2:
-            manage_instances()
-        
-        elif choice == 3:
-            print("Returning to main menu...")
-            break
-        else:
-            print("Invalid choice. Please pick a number between 1-3.")
+        try:
+            if choice == 1:
+                launch_instance(ctx)
+
+            elif choice == 2:
+                manage_instances(ctx)
+
+            elif choice == 3:
+                fleet_menu(ctx)
+
+            elif choice == 4:
+                ctx.jobs.show()
+
+            elif choice == 5:
+                print("Returning to main menu...")
+                break
+            else:
+                print("Invalid choice. Please pick a number between 1-5.")
+        except botocore.exceptions.ClientError as e:
+            # Includes calls the user's policies deny, which are refused locally.
+            print(f"EC2 request failed: {e.response['Error']['Message']}")
+
+
+DEFAULT_IMAGE_ID = 'ami-0fc32db49bc3bfbb1'
+DEFAULT_INSTANCE_TYPE = 't2.micro'
+CAPACITY_ERRORS = {'InsufficientInstanceCapacity', 'InsufficientCapacity', 'InsufficientHostCapacity'}
+TAG_WORKERS = 16
+MAX_FILTER_VALUES = 200
 
 
-import boto3
+def launch_parameters(ctx, count, min_count=None):
+    # AMI and instance type come from a launch template or the settings file,
+    # falling back to the original defaults.
+    settings = ctx.settings
+    params = {'MinCount': min_count or count, 'MaxCount': count}
+    template = settings.get('launch_template')
+    if template:
+        key = 'LaunchTemplateId' if template.startswith('lt-') else 'LaunchTemplateName'
+        params['LaunchTemplate'] = {key: template, 'Version': settings.get('launch_template_version', '$Default')}
+        if settings.get('image_id'):
+            params['ImageId'] = settings['image_id']
+        if settings.get('instance_type'):
+            params['InstanceType'] = settings['instance_type']
+    else:
+        params['ImageId'] = settings.get('image_id') or DEFAULT_IMAGE_ID
+        params['InstanceType'] = settings.get('instance_type') or DEFAULT_INSTANCE_TYPE
+    return params
+
+
+def launch_tags(ctx, name):
+    tags = [{'Key': 'Name', 'Value': name}, {'Key': 'Project', 'Value': PROJECT_TAG}]
+    if ctx.username:
+        # The EC2 policy from IAM_manager.attach_policies only covers Owner-tagged instances.
+        tags.append({'Key': 'Owner', 'Value': ctx.username})
+    return [{'ResourceType': 'instance', 'Tags': tags}]
+
+
+def split_count(count, parts):
+    share, extra = divmod(count, parts)
+    return [share + (1 if index < extra else 0) for index in range(parts)]
+
+
+def run_batch(ec2, params, count, subnet_id=None):
+    request = dict(params, MinCount=min(params['MinCount'], count), MaxCount=count)
+    if subnet_id:
+        request['SubnetId'] = subnet_id
+    return [instance['InstanceId'] for instance in ec2.run_instances(**request)['Instances']]
 
-def launch_instance():
-    ec2 = boto3.client('ec2')
 
+def fan_out(ec2, params, count, subnet_ids):
+    # Spreads the batch over the configured subnets (and so AZs) concurrently,
+    # moving the share of any subnet that runs out of capacity to the others.
+    instance_ids = []
+    remaining = count
+    subnets = list(subnet_ids)
+    last_error = None
+    while remaining and subnets:
+        shares = [(subnet, share) for subnet, share in zip(subnets, split_count(remaining, len(subnets))) if share]
+        remaining = 0
+        with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+            futures = {pool.submit(run_batch, ec2, dict(params, MinCount=1), share, subnet): (subnet, share)
+                       for subnet, share in shares}
+            for future, (subnet, share) in futures.items():
+                try:
+                    launched = future.result()
+                except botocore.exceptions.ClientError as e:
+                    if e.response['Error']['Code'] not in CAPACITY_ERRORS:
+                        raise
+                    last_error = e
+                    subnets.remove(subnet)
+                    remaining += share
+                    continue
+                instance_ids.extend(launched)
+                remaining += share - len(launched)
+    if len(instance_ids) < params['MinCount']:
+        if last_error:
+            raise last_error
+        raise RuntimeError(f"Only {len(instance_ids)} of {params['MinCount']} instances could be launched.")
+    return instance_ids
+
+
+def name_instances(ec2, name, instance_ids):
+    # Every instance gets its own Name, which needs one create_tags call each.
+    if len(instance_ids) < 2:
+        return
+    names = [(instance_id, f"{name}-{number}") for number, instance_id in enumerate(instance_ids, start=1)]
+    with ThreadPoolExecutor(max_workers=min(TAG_WORKERS, len(names))) as pool:
+        list(pool.map(lambda pair: ec2.create_tags(Resources=[pair[0]], Tags=[{'Key': 'Name', 'Value': pair[1]}]), names))
+
+
+def provision_instances(ctx, name, count=1, min_count=None, subnet_ids=None, notify=True):
+    ec2 = ctx.client('ec2')
+    params = launch_parameters(ctx, count, min_count)
+    params['TagSpecifications'] = launch_tags(ctx, name)
+    subnet_ids = subnet_ids if subnet_ids is not None else ctx.settings.get('subnet_ids', [])
+    started = ctx.jobs.poller.clock.now()
+
+    try:
+        instance_ids = run_batch(ec2, params, count)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in CAPACITY_ERRORS or not subnet_ids:
+            raise
+        instance_ids = fan_out(ec2, params, count, subnet_ids)
+
+    name_instances(ec2, name, instance_ids)
+    ctx.cache.invalidate('instances')
+    # The whole batch is waited on together by the shared poller.
+    job = ctx.jobs.submit('launch', instance_ids, 'running', FLEET_ACTIONS['start'][2], notify=False, started=started)
+    if notify:
+        job.callbacks.append(lambda finished: report_launch(ctx, finished))
+    return job
+
+
+def launch_instance(ctx):
     while True:
         instance_name = input("Enter a name for your EC2 instance: ").strip().lower()
         if not instance_name:
             instance_name = 'DefaultEC2instance'
 
         try:
-            print("\nLaunching EC2 instance...")
-            response = ec2.run_instances(
-                ImageId='ami-0fc32db49bc3bfbb1',
-                MinCount=1,
-                MaxCount=1,
-                InstanceType='t2.micro',
-                TagSpecifications=[{
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {'Key': 'Name', 'Value': instance_name},
-                        {'Key': 'Project', 'Value': 'DigitalTimeCapsule'}
-                    ]
-                }]
-            )
-
-            instance_id = response['Instances'][0]['InstanceId']
-            print(f"Created EC2 Instance with ID: {instance_id}")
-
-            print("Waiting 10s for Instance to enter running state...")
-            ec2_resource = boto3.resource('ec2')
-            instance = ec2_resource.Instance(instance_id)
-            instance.wait_until_running()
-
-            instance.load()
-            public_ip = instance.public_ip_address
-            if not public_ip:
-                print("Warning. No public IP assigned. Check subnet settings or use an Elastic IP")
-
-            print(f"Instance is running. Public IP address {public_ip}")
-            print("You can now SSH into your instance")
+            count = int(input("How many instances should be launched? (press enter for 1): ").strip() or 1)
+        except ValueError:
+            print("Please enter a whole number.")
+            continue
+        if count < 1:
+            print("Please launch at least one instance.")
+            continue
+
+        try:
+            print(f"\nLaunching {count} EC2 instance(s)...")
+            job = provision_instances(ctx, instance_name, count)
+            print(f"Created EC2 Instance(s) with ID: {', '.join(job.instance_ids)}")
+            print(f"Waiting for the instances to start in background job {job.id}, you can keep using the menu.")
             break  # Exit loop after successful launch
 
-        except Exception as e:
+        except (botocore.exceptions.ClientError, RuntimeError) as e:
             print("Error launching EC2: ", str(e))
             retry = input("Would you like to try again? (y/n): ").strip().lower()
             if retry != 'y':
                 break
 
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def launch_latencies(job):
+    latencies = [result['at'] - job.started for result in job.snapshot().values() if result['ok'] and 'at' in result]
+    return {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90), 'p99': percentile(latencies, 99)}
+
+
+def report_launch(ctx, job):
+    print(f"\n[{job.progress()}]")
+    results = job.snapshot()
+    running = [instance_id for instance_id, result in results.items() if result['ok']]
+    for instance_id, result in results.items():
+        if not result['ok']:
+            print(f"Instance {instance_id} did not start: {result.get('error')}")
+    if not running:
+        return
+
+    public_ips = {}
+    for chunk in chunked(running, MAX_FILTER_VALUES):
+        for row in query_instances(ctx, [{'Name': 'instance-id', 'Values': chunk}]):
+            public_ips[row.instance_id] = row.public_ip
+    for instance_id in running:
+        public_ip = public_ips.get(instance_id)
+        if not public_ip:
+            print(f"Warning. No public IP assigned to {instance_id}. Check subnet settings or use an Elastic IP")
+        print(f"Instance {instance_id} is running. Public IP address {public_ip}")
+
+    latencies = launch_latencies(job)
+    print(f"Launch to running: p50 {latencies['p50']:.0f}s, p90 {latencies['p90']:.0f}s, p99 {latencies['p99']:.0f}s")
+    print("You can now SSH into your instances")
+
 ##############################
-def list_instances():
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_instances()
+PROJECT_TAG = 'DigitalTimeCapsule'
+ACTIVE_STATES = ['pending', 'running', 'stopping', 'stopped', 'shutting-down']
+
+InstanceRecord = namedtuple('InstanceRecord', ['instance_id', 'state', 'name', 'instance_type', 'public_ip'])
+
+# One JMESPath search over the pages projects each instance down to the fields
+# we show, instead of walking every tag of every instance by hand.
+INSTANCE_FIELDS = ("Reservations[].Instances[].[InstanceId, State.Name, "
+                   "Tags[?Key=='Name'].Value | [0], InstanceType, PublicIpAddress]")
+
+
+class InstanceTable:
+    __slots__ = ('rows', 'by_id', 'by_name')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.by_id = {}
+        self.by_name = {}
+        for row in rows:
+            self.by_id[row.instance_id] = row
+            self.by_name.setdefault(row.name, []).append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def get(self, instance_id):
+        return self.by_id.get(instance_id)
+
+    def named(self, name):
+        return self.by_name.get(name, [])
+
+
+def instance_filters(project=PROJECT_TAG, owner=None, states=ACTIVE_STATES):
+    filters = []
+    if project:
+        filters.append({'Name': 'tag:Project', 'Values': [project]})
+    if owner:
+        filters.append({'Name': 'tag:Owner', 'Values': [owner]})
+    if states:
+        filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+    return filters
+
+
+def query_instances(ctx, filters=None, page_size=1000):
+    key = ('instances', json.dumps(filters or [], sort_keys=True), page_size)
+    return ctx.cache.get_or_load(key, lambda: load_instances(ctx, filters, page_size))
+
+
+def load_instances(ctx, filters=None, page_size=1000):
+    paginator = ctx.client('ec2').get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=filters or [], PaginationConfig={'PageSize': page_size})
+    rows = []
+    for instance_id, state, name, instance_type, public_ip in pages.search(INSTANCE_FIELDS):
+        rows.append(InstanceRecord(instance_id, state, name or 'N/A', instance_type, public_ip))
+    return InstanceTable(rows)
+
+
+def default_filters(ctx):
+    owner = ctx.username if ctx.settings.get('filter_by_owner') else None
+    return instance_filters(owner=owner)
+
+
+def list_instances(ctx, filters=None):
+    instances = query_instances(ctx, default_filters(ctx) if filters is None else filters)
 
-    instances = []
     print('\n--- Your EC2 Instances ---')
-    count = 1 
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            instance_id = instance['InstanceId']
-            state = instance['State']['Name']
-            name = "N/A"
-            if 'Tags' in instance:
-                for tag in instance['Tags']:
-                    if tag['Key'] == 'Name':
-                        name = tag['Value']
-            print(f"{count}. ID: {instance_id} | State: {state} | Name: {name}")
-            instances.append({
-                'InstanceId': instance_id,
-                'State': state,
-                'Name': name
-            })
-            count += 1
+    for count, instance in enumerate(instances, start=1):
+        print(f"{count}. ID: {instance.instance_id} | State: {instance.state} | Name: {instance.name}")
     return instances
 
-def manage_instances():
-    ec2 = boto3.client('ec2')
 
-    instances = list_instances()
+def select_instance(instances, choice):
+    # Accepts a list number, an instance ID or a Name tag.
+    if choice.isdigit():
+        index = int(choice)
+        return instances[index - 1] if 1 <= index <= len(instances) else None
+    if choice in instances.by_id:
+        return instances.get(choice)
+    named = instances.named(choice)
+    return named[0] if len(named) == 1 else None
+
+def manage_instances(ctx):
+    instances = list_instances(ctx)
 
     if not instances:
         print("No EC2 instances found.")
         return 
 
-    print("\n Available Instances:")
-    for idx, instance in enumerate(instances, start = 1):
-        print(f"{idx}. ID: {instance['InstanceId']}, State: {instance['State']}")
-
     while True: 
-        try:
-            selection = int(input("Select an instance by number (or 0 to go back): ").strip())
-            if selection == 0:
-                return
-            if selection < 1 or selection > len(instances):
-                print(f"Please enter a number between 1 and {len(instances)}.")
-                continue
-            selected_instance = instances[selection -1]
-            break
-        except (ValueError, IndexError):
-            print("Invalid input. Please enter a valid number.")
+        choice = input("Select an instance by number, ID or name (or 0 to go back): ").strip()
+        if choice == '0':
+            return
+        selected_instance = select_instance(instances, choice)
+        if selected_instance is None:
+            print(f"Please enter a number between 1 and {len(instances)}, or an exact instance ID or name.")
             continue
+        break
     
-    instance_id = selected_instance['InstanceId']
-    print(f"\n You selected: {instance_id} (State: {selected_instance['State']}, Name: {selected_instance['Name']})")
+    instance_id = selected_instance.instance_id
+    print(f"\n You selected: {instance_id} (State: {selected_instance.state}, Name: {selected_instance.name})")
     
     while True:   
-        print(f"\n What would you like to do?")
+        print("\n What would you like to do?")
         print("1. Start instance")
         print("2. Stop instance")
         print("3. Reboot instance")
@@ -147,16 +344,16 @@ def manage_instances():
             continue 
 
         if action == 1:
-            start_instance(ec2, instance_id)
+            start_instance(ctx, instance_id)
 
         elif action == 2:
-            stop_instance(ec2, instance_id)
+            stop_instance(ctx, instance_id)
         
         elif action == 3:
-            reboot_instance(ec2, instance_id)
+            reboot_instance(ctx, instance_id)
         
         elif action == 4:
-            terminate_instance(ec2, instance_id)
+            terminate_instance(ctx, instance_id)
 
         elif action == 5:
             print("Returning to EC2 menu")
@@ -164,55 +361,169 @@ def manage_instances():
         else:
             print("Invalid choice, please select a number between 1 and 5")
 
-def start_instance(ec2, instance_id):
-    try:
-        ec2.start_instances(InstanceIds=[instance_id])
-        print(f"Starting instance {instance_id}")
-        waiter = ec2.get_waiter('instance_running')
-        waiter.wait(InstanceIds=[instance_id])
-        print(f"Instance {instance_id} is now running.")
-        new_state = ec2.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]['State']['Name']
-        print(f"New state of instance {instance_id}: {new_state}")
-    except Exception as e:
-        print(f"Failed to start instance: {e}")
-
-def stop_instance(ec2, instance_id):
-    try:
-        ec2.stop_instances(InstanceIds=[instance_id])
-        print(f"Stopping instance {instance_id}")
-        waiter = ec2.get_waiter('instance_stopped')
-        waiter.wait(InstanceIds=[instance_id])
-        print(f"Instance {instance_id} has now stopped.")
-        new_state = ec2.describe_instances(InstanceIds = [instance_id])['Reservations'][0]['Instances'][0]['State']['Name']
-        print(f"New state of instance {instance_id}: {new_state}")
-    except Exception as e:
-        print(f"Failed to stop instance: {e}")
-
-def reboot_instance(ec2, instance_id):
+# API call, state to wait for, and states that mean the wait can never succeed.
+FLEET_ACTIONS = {
+    'start': ('start_instances', 'running', {'terminated', 'shutting-down'}),
+    'stop': ('stop_instances', 'stopped', {'terminated', 'shutting-down'}),
+    'reboot': ('reboot_instances', 'ok', {'terminated', 'shutting-down', 'stopped'}),
+    'terminate': ('terminate_instances', 'terminated', set()),
+}
+SETTLE_SECONDS = {'reboot': 10}
+MAX_IDS_PER_CALL = 1000
+MAX_STATUS_IDS_PER_CALL = 100
+WAIT_DELAY = 15
+WAIT_TIMEOUT = 600
+
+
+def chunked(items, size):
+    items = list(items)
+    for first in range(0, len(items), size):
+        yield items[first:first + size]
+
+
+def resolve_targets(ctx, instance_ids=None, tags=None):
+    targets = list(instance_ids or [])
+    if tags:
+        filters = [{'Name': f"tag:{key}", 'Values': [value]} for key, value in tags.items()]
+        filters.append({'Name': 'instance-state-name', 'Values': ACTIVE_STATES})
+        targets.extend(row.instance_id for row in query_instances(ctx, filters))
+    return list(dict.fromkeys(targets))
+
+
+def describe_states(ec2, instance_ids):
+    states = {}
+    for chunk in chunked(instance_ids, MAX_IDS_PER_CALL):
+        pages = ec2.get_paginator('describe_instances').paginate(InstanceIds=chunk)
+        for instance_id, state in pages.search("Reservations[].Instances[].[InstanceId, State.Name]"):
+            states[instance_id] = state
+    return states
+
+
+def describe_status(ec2, instance_ids):
+    # "ok" once both the system and instance status checks pass, otherwise the state name.
+    states = {}
+    for chunk in chunked(instance_ids, MAX_STATUS_IDS_PER_CALL):
+        response = ec2.describe_instance_status(InstanceIds=chunk, IncludeAllInstances=True)
+        for status in response['InstanceStatuses']:
+            checks = (status['SystemStatus']['Status'], status['InstanceStatus']['Status'])
+            states[status['InstanceId']] = 'ok' if checks == ('ok', 'ok') else status['InstanceState']['Name']
+    return states
+
+
+def wait_for_fleet(ec2, instance_ids, target, failed_states=(), delay=WAIT_DELAY, timeout=WAIT_TIMEOUT, sleep=time.sleep):
+    # Waits in the foreground with the same poller background jobs use, so the
+    # whole fleet is checked with as few describe calls as the API allows and
+    # unknown IDs and API errors are handled the same way.
+    if not instance_ids:
+        return {}
+    clock = job_manager.SleepClock(sleep)
+    poller = job_manager.InstancePoller(ec2, clock, min_delay=delay, max_delay=delay)
+    job = poller.submit(job_manager.Job('wait', instance_ids, target, failed_states, started=clock.now(),
+                                        timeout=timeout))
+    while not job.done:
+        clock.sleep(delay)
+        poller.tick()
+    return job.snapshot()
+
+
+def send_isolating(call, instance_ids, results):
+    # EC2 rejects the whole call when one ID in it is unknown. A rejected chunk
+    # is split in half until the bad IDs are on their own, so the rest still
+    # get the action. Returns the IDs EC2 accepted, failures go into results.
     try:
-        ec2.reboot_instances(InstanceIds=[instance_id])
-        print(f"Rebooting instance {instance_id}")
-        time.sleep(10)
-        waiter = ec2.get_waiter('instance_status_ok')
-        waiter.wait(InstanceIds=[instance_id])
-        print(f"Instance {instance_id} is back to OK status.")
-        new_state = ec2.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]['State']['Name']
-        print(f"New state of instance {instance_id}: {new_state}")
-    except Exception as e:
-        print(f"Failed to reboot instance: {e}")
-
-def terminate_instance(ec2, instance_id):
+        call(InstanceIds=instance_ids)
+        return list(instance_ids)
+    except botocore.exceptions.ClientError as e:
+        code = e.response['Error']['Code']
+        if code not in (job_manager.NOT_FOUND, job_manager.MALFORMED) or len(instance_ids) == 1:
+            for instance_id in instance_ids:
+                results[instance_id] = {'state': None, 'ok': False, 'error': e.response['Error']['Message']}
+            return []
+    middle = len(instance_ids) // 2
+    return (send_isolating(call, instance_ids[:middle], results)
+            + send_isolating(call, instance_ids[middle:], results))
+
+
+def fleet_action(ctx, action, instance_ids=None, tags=None, wait=True, delay=WAIT_DELAY, timeout=WAIT_TIMEOUT, sleep=time.sleep, background=False):
+    operation, target, failed_states = FLEET_ACTIONS[action]
+    ec2 = ctx.client('ec2')
+    targets = resolve_targets(ctx, instance_ids, tags)
+
+    results = {}
+    accepted = []
+    for chunk in chunked(targets, MAX_IDS_PER_CALL):
+        accepted.extend(send_isolating(getattr(ec2, operation), chunk, results))
+
+    ctx.cache.invalidate('instances')
+    if background:
+        # Hand the wait to the shared poller and return the job handle straight away.
+        return ctx.jobs.submit(action, targets, target, failed_states, results, settle=SETTLE_SECONDS.get(action, 0))
+    if wait:
+        results.update(wait_for_fleet(ec2, accepted, target, failed_states, delay, timeout, sleep))
+    else:
+        results.update({instance_id: {'state': None, 'ok': True} for instance_id in accepted})
+    return results
+
+
+def print_fleet_results(action, results):
+    succeeded = sum(1 for result in results.values() if result['ok'])
+    print(f"{action.capitalize()}: {succeeded} of {len(results)} instances succeeded.")
+    for instance_id, result in results.items():
+        if result['ok']:
+            print(f"{instance_id}: {result['state'] or 'requested'}")
+        else:
+            print(f"{instance_id}: failed ({result['error']})")
+
+
+def fleet_menu(ctx):
+    action = input("Which action? (start/stop/reboot/terminate, or 'back' to return): ").strip().lower()
+    if action == 'back':
+        return
+    if action not in FLEET_ACTIONS:
+        print("Invalid action. Please type start, stop, reboot or terminate.")
+        return
+
+    target = input("Enter instance IDs separated by commas, or a tag as Key=Value: ").strip()
+    if '=' in target:
+        key, value = target.split('=', 1)
+        instance_ids, tags = None, {key.strip(): value.strip()}
+    else:
+        instance_ids, tags = [part.strip() for part in target.split(',') if part.strip()], None
+
+    targets = resolve_targets(ctx, instance_ids, tags)
+    if not targets:
+        print("No matching instances found.")
+        return
+    if input(f"{action.capitalize()} {len(targets)} instances? (y/n): ").strip().lower() != 'y':
+        print("Cancelled.")
+        return
+
+    job = fleet_action(ctx, action, targets, background=True)
+    print(f"Sent {action} to {len(targets)} instances as background job {job.id}. Check progress under Background jobs.")
+
+
+def start_in_background(ctx, action, instance_id):
+    job = fleet_action(ctx, action, [instance_id], background=True)
+    print(f"Background job {job.id} started. Check progress under Background jobs.")
+    return job
+
+def start_instance(ctx, instance_id):
+    print(f"Starting instance {instance_id}")
+    return start_in_background(ctx, 'start', instance_id)
+
+def stop_instance(ctx, instance_id):
+    print(f"Stopping instance {instance_id}")
+    return start_in_background(ctx, 'stop', instance_id)
+
+def reboot_instance(ctx, instance_id):
+    print(f"Rebooting instance {instance_id}")
+    return start_in_background(ctx, 'reboot', instance_id)
+
+def terminate_instance(ctx, instance_id):
     confirm = input("Are you sure you want to terminate this instance? (y/n): ").strip().lower()
     if confirm == 'y':
-        try:
-            ec2.terminate_instances(InstanceIds=[instance_id])
-            print(f"Terminating instance {instance_id}")
-            waiter = ec2.get_waiter('instance_terminated')
-            waiter.wait(InstanceIds=[instance_id])
-            print(f"Instance {instance_id} has been terminated.")
-        except Exception as e:
-            print(f"Failed to terminate instance: {e}")
-        return 
+        print(f"Terminating instance {instance_id}")
+        return start_in_background(ctx, 'terminate', instance_id)
     elif confirm == 'n':
         print("Termination cancelled.")
         return
@@ -1,19 +1,28 @@
 import boto3
 import json
 import os 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
-iam = boto3.client('iam')
-ec2 = boto3.client ('ec2')
-s3 = boto3.client ('s3')
+import auth_manager
+import client_manager
+
+
+def iam_client():
+    # Created on first use rather than at import, so starting the app does not
+    # load service models or resolve credentials before anyone has logged in.
+    return client_manager.get_client('iam')
 
 
 def register_user():
     username = input("Enter a username to register: ").strip()
-    
+    return create_user(username)
+
+
+def create_user(username):
+    iam = iam_client()
     #Checks if username exists.
     try:
-        iam.get_user(Username=username)
+        iam.get_user(UserName=username)
         print(f'User "{username}" already exists. Please try a different username.')
         return None
     except ClientError as e:
@@ -24,7 +33,7 @@ def register_user():
 
     #Now create user.
     try:
-        iam.create_user(Username=username)
+        iam.create_user(UserName=username)
         print(f'IAM user "{username}" created')
         return username
     except ClientError as e:
@@ -32,7 +41,10 @@ def register_user():
         return None
 
 
-def attach_policies(username):
+def user_policies(username):
+    # Inline policy name -> policy document for a capsule user. Shared by
+    # attach_policies and the bulk provisioner so both write the same thing.
+
     # Define custom S3 policy to restrict to user's own bucket
     s3_policy = {
         "Version": "2012-10-17",
@@ -66,19 +78,23 @@ def attach_policies(username):
         }]
     }
 
+    return {
+        f"{username}-S3-OwnBucketAccess": s3_policy,
+        f"{username}-EC2-TaggedInstanceAccess": ec2_policy,
+    }
+
+
+def attach_policies(username):
+    iam = iam_client()
     try:
-        # Attach S3 inline policy
-        iam.put_user_policy(
-            UserName=username,
-            PolicyName=f"{username}-S3-OwnBucketAccess",
-            PolicyDocument=json.dumps(s3_policy)
-        )
-        # Attach EC2 inline policy
-        iam.put_user_policy(
-            UserName=username,
-            PolicyName=f"{username}-EC2-TaggedInstanceAccess",
-            PolicyDocument=json.dumps(ec2_policy)
-        )
+        # Attach the S3 and EC2 inline policies
+        for policy_name, document in user_policies(username).items():
+            iam.put_user_policy(
+                UserName=username,
+                PolicyName=policy_name,
+                PolicyDocument=json.dumps(document)
+            )
+        auth_manager.remember_capsule_user(username)
         print(f"Attached custom S3 and EC2 policies to user '{username}'")
     except ClientError as e:
         print(f"Error attaching policies: {e}")
@@ -89,6 +105,7 @@ def attach_policies(username):
 ########################
 
 def create_access_keys(username):
+    iam = iam_client()
     try:
         response = iam.create_access_key(UserName=username)
         access_key = response['AccessKey']['AccessKeyId']
@@ -121,19 +138,20 @@ def login():
             aws_secret_access_key=secret_key
         )
 
-        sts_client = session.client('sts')
-        sts_client.get_caller_identity()
+        # Resolving the identity proves the keys work, and caches who they belong to.
+        auth_manager.caller_identity(session)
         print("Login succesful")
         return session
-    except Exception as e:
+    except (ClientError, BotoCoreError) as e:
         print(f"Login failed: {e}")
         return None 
 
 def delete_user(username):
+    iam = iam_client()
     try:
         keys_response = iam.list_access_keys(UserName=username)
         for key in keys_response['AccessKeyMetadata']:
-            iam.delete_access_key(UserName=username, AccessKeyID=key['AccessKeyId'])
+            iam.delete_access_key(UserName=username, AccessKeyId=key['AccessKeyId'])
             print(f"Deleted access key: {key['AccessKeyId']}")
     
         inline_policies = iam.list_user_policies(UserName=username)
@@ -143,9 +161,10 @@ def delete_user(username):
         
         attached_policies = iam.list_attached_user_policies(UserName=username)
         for policy in attached_policies['AttachedPolicies']:
-            iam.detach_user_policy(Username=username, PolicyArn=policy['PolicyArn'])
+            iam.detach_user_policy(UserName=username, PolicyArn=policy['PolicyArn'])
         
-        iam.delete_user(Username=username)
+        iam.delete_user(UserName=username)
+        auth_manager.forget_capsule_user(username)
         print(f"Deleted user {username} successfully.")
     
     except ClientError as e:
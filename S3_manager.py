@@ -1,33 +1,95 @@
-import boto3
 import botocore
 import os
+from collections import namedtuple
+from datetime import datetime, timezone
+from itertools import islice
 
-def s3_menu():  
+from botocore.paginate import TokenEncoder
+
+import cache_manager
+
+import copy_manager
+import delete_manager
+import index_manager
+import pack_manager
+import presign_manager
+import schedule_manager
+import transfer_manager
+
+PAGE_SIZE = 20
+
+ObjectRecord = namedtuple('ObjectRecord', ['key', 'size', 'etag', 'last_modified', 'storage_class', 'is_prefix'])
+
+
+def s3_menu(ctx):  
     while True:
         print("\n S3 Menu")
         print("1. Bucket Operations")
         print("2. File operations")
-        print("3. Return to main menu")
+        print("3. Capsule schedule")
+        print("4. Return to main menu")
 
         try:
-            s3menu_choice = int(input("Pick a number between 1-3: ").strip())
+            s3menu_choice = int(input("Pick a number between 1-4: ").strip())
         except ValueError:
-            print("Invalid input. Please pick a valid integer between 1 to 3: ")
+            print("Invalid input. Please pick a valid integer between 1 to 4: ")
             continue  
 
         if s3menu_choice == 1:
-            bucket_operations_menu()
+            bucket_operations_menu(ctx)
         
         elif s3menu_choice == 2:
-            file_operations_menu()
+            file_operations_menu(ctx)
         
         elif s3menu_choice == 3:
+            capsule_menu(ctx)
+        
+        elif s3menu_choice == 4:
             print("Returning to main menu...")
             break 
         else:
             print("Invalid choice, please try again.")
 
-def bucket_operations_menu():
+def capsule_menu(ctx):
+    while True:
+        print("\n Capsule Schedule Menu")
+        print("1. Show sealed capsules")
+        print("2. Show released capsules")
+        print("3. Release due capsules now")
+        print("4. Keep releasing capsules in the background")
+        print("5. Return to S3 Menu")
+
+        try:
+            capsule_choice = int(input("Please pick a number between 1-5: ").strip())
+        except ValueError:
+            print("Invalid input. Please pick an integer between 1-5: ")
+            continue
+
+        if capsule_choice == 1:
+            print(f"{ctx.schedule.pending_count()} capsules are sealed.")
+            for bucket_name, key, unlock_at, attempts in ctx.schedule.upcoming():
+                retries = f" ({attempts} failed attempts)" if attempts else ""
+                print(f"{bucket_name}/{key} opens {schedule_manager.format_time(unlock_at)}{retries}")
+
+        elif capsule_choice == 2:
+            for bucket_name, key, state, location, error in ctx.schedule.recent_releases():
+                print(f"{bucket_name}/{key}: {location}" if state == 'released' else f"{bucket_name}/{key}: failed ({error})")
+
+        elif capsule_choice == 3:
+            result = ctx.schedule.run_once()
+            print(f"Released {result['released']} capsules, {result['retrying']} will be retried, {result['failed']} failed.")
+
+        elif capsule_choice == 4:
+            ctx.schedule.start()
+            print("Capsules will be released in the background while the app is open.")
+
+        elif capsule_choice == 5:
+            print("Returning to S3 Menu...")
+            break
+        else:
+            print("Invalid choice, please try again.")
+
+def bucket_operations_menu(ctx):
     while True:
         print("\n Bucket Operations Menu")
         print("1. Create Bucket")
@@ -42,13 +104,13 @@ def bucket_operations_menu():
             continue
         
         if bucket_operation_choice == 1:
-            create_bucket()
+            create_bucket(ctx)
         
         elif bucket_operation_choice == 2:
-            list_buckets()
+            list_buckets(ctx)
         
         elif bucket_operation_choice == 3:
-            delete_buckets()
+            delete_buckets(ctx)
         
         elif bucket_operation_choice == 4:
             print("Returning to S3 Menu...")
@@ -57,14 +119,8 @@ def bucket_operations_menu():
             print("Invalid choice, please try again.")
 
 
-def create_bucket():
-    session = boto3.session.Session()
-    region = session.region_name
-
-    if not region:
-        print("No default AWS region found in your config. Set one using aws configure.")
-
-    s3 = boto3.client('s3', region_name=region)
+def create_bucket(ctx):
+    region = ctx.region
     bucket_name = input("Enter a name for a new bucket: ").strip().lower()
 
     if not bucket_name or len(bucket_name) <3 or len(bucket_name) > 25:
@@ -72,23 +128,28 @@ def create_bucket():
         return
     
     try:
-        if region == 'eu-east-1': ## AWS quirk: only us-east-1 throws error if CreateBucketConfiguration is included
-            s3.create_bucket(Bucket=bucket_name)
-        else:
-            s3.create_bucket(
-                Bucket=bucket_name,
-                CreateBucketConfiguration={'LocationConstraint': region}
-            )
+        make_bucket(ctx, bucket_name)
         print(f"Bucket: {bucket_name} created successfully in region: {region}.")
     except botocore.exceptions.ClientError as e:
         print(f"Error creating bucket: {e.response['Error']['Message']}")
+
+def make_bucket(ctx, bucket_name):
+    s3 = ctx.client('s3')
+    if ctx.region == 'us-east-1': ## AWS quirk: only us-east-1 throws error if CreateBucketConfiguration is included
+        s3.create_bucket(Bucket=bucket_name)
+    else:
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={'LocationConstraint': ctx.region}
+        )
+    ctx.cache.invalidate('buckets')
     
-def list_buckets():
-    s3 = boto3.client('s3')
+def fetch_buckets(ctx):
+    return ctx.cache.get_or_load(('buckets', 'all'), lambda: ctx.client('s3').list_buckets().get('Buckets', []))
 
+def list_buckets(ctx):
     try:
-        response = s3.list_buckets()
-        buckets = response.get('Buckets', [])
+        buckets = fetch_buckets(ctx)
 
         if not buckets:
             print("No S3 buckets were found.")
@@ -104,12 +165,11 @@ def list_buckets():
         print(f"Error listing buckets: {e}")
                           
 
-def delete_buckets():
-    s3 = boto3.client('s3')
+def delete_buckets(ctx):
+    s3 = ctx.client('s3')
 
     try:
-        response = s3.list_buckets()
-        buckets = response.get('Buckets')
+        buckets = fetch_buckets(ctx)
 
         if not buckets:
             print("No buckets found to delete")
@@ -121,7 +181,7 @@ def delete_buckets():
         
         while True:
             try:
-                bucket_choice = int(input(f"Select a bucket to delete by number (1-{len(bucket)}) or 0 to  cancel: ").strip())
+                bucket_choice = int(input(f"Select a bucket to delete by number (1-{len(buckets)}) or 0 to  cancel: ").strip())
                 if bucket_choice == 0:
                     print("Deletion cancelled.")
                     return
@@ -129,7 +189,14 @@ def delete_buckets():
                     bucket_name = buckets[bucket_choice -1]['Name']
                     confirm = input(f"Are you sure you want to delete the bucket {bucket_name}? Can't be undone.(y/n): ").strip().lower()
                     if confirm == 'y':
-                        s3.delete_bucket(Bucket=bucket_name)
+                        try:
+                            s3.delete_bucket(Bucket=bucket_name)
+                            forget_bucket(ctx, bucket_name)
+                        except botocore.exceptions.ClientError as e:
+                            if e.response['Error']['Code'] != 'BucketNotEmpty':
+                                raise
+                            empty_and_delete_bucket(ctx, bucket_name)
+                            return
                         print(f"Bucket {bucket_name} was successfully deleted.")
                         return
                     elif confirm == 'n':
@@ -141,48 +208,83 @@ def delete_buckets():
                         print(f"Please choose a number between 1 and {len(buckets)}, or 0 to cancel")
             except ValueError:
                 print("Invalid input. Please enter an integer (number).")
-    except botocore.excerptions.ClientError as e:
+    except botocore.exceptions.ClientError as e:
         print(f"Error deleting buckets: {e.response['Error']['Message']}")
 
 
-def file_operations_menu():
+def forget_bucket(ctx, bucket_name):
+    ctx.cache.invalidate('buckets')
+    ctx.cache.invalidate('objects', bucket_name)
+
+
+def empty_and_delete_bucket(ctx, bucket_name):
+    confirm = input(f"Bucket {bucket_name} is not empty. Delete every object in it and then the bucket? (y/n): ").strip().lower()
+    if confirm != 'y':
+        print("Deletion cancelled")
+        return
+
+    result = delete_manager.empty_and_delete_bucket(ctx, bucket_name)
+    print(f"Deleted {result['deleted']} objects ({result['objects_per_s']:.0f} objects/s).")
+    if result['bucket_deleted']:
+        print(f"Bucket {bucket_name} was successfully deleted.")
+        return
+    print(f"{len(result['failed'])} objects could not be deleted, so the bucket was kept.")
+    for key, code in result['failed'][:PAGE_SIZE]:
+        print(f"Failed: {key} ({code})")
+
+
+def file_operations_menu(ctx):
     while True:
         print("\n File Operations Menu")
         print("1. Upload file.")
         print("2. List files.")
         print("3. Download files.")
         print("4. Delete file.")
-        print("5. Return to S3 menu.")
+        print("5. Upload directory.")
+        print("6. Sync local file index.")
+        print("7. Share files.")
+        print("8. Copy or move files.")
+        print("9. Return to S3 menu.")
 
         try:
-            file_operation_choice = int(input("Please pick an option between 1-5: ").strip())
+            file_operation_choice = int(input("Please pick an option between 1-9: ").strip())
         except ValueError:
-            print("Please enter an integer between 1-5: ")
+            print("Please enter an integer between 1-9: ")
             continue
 
         if file_operation_choice == 1:
-            upload_file()
+            upload_file(ctx)
         
         elif file_operation_choice == 2:
-            list_files()
+            list_files(ctx)
         
         elif file_operation_choice == 3:
-            download_files()
+            download_files(ctx)
         
         elif file_operation_choice == 4:
-            delete_file()
+            delete_file(ctx)
         
         elif file_operation_choice == 5:
+            upload_directory(ctx)
+        
+        elif file_operation_choice == 6:
+            sync_index(ctx)
+        
+        elif file_operation_choice == 7:
+            share_files(ctx)
+        
+        elif file_operation_choice == 8:
+            copy_files(ctx)
+
+        elif file_operation_choice == 9:
             print("Returning to S3 Menu...")
             break
         else:
-            print("Please pick a number between 1-5: ")
+            print("Please pick a number between 1-9: ")
 
 
-def upload_file():
-    s3 = boto3.client('s3')
-
-    file_path = input("Enter the full path of the file to upload (or type 'back' to return): ").strip().lower()
+def upload_file(ctx):
+    file_path = input("Enter the full path of the file to upload (or type 'back' to return): ").strip()
     if file_path == 'back':
         return 
     
@@ -196,129 +298,410 @@ def upload_file():
     if bucket_name == 'back':
         return
     
-    filename_askey = input(f"what should filename be named in the bucket? (Press enter to use {file_name}: ").strip().lower()
+    filename_askey = input(f"what should filename be named in the bucket? (Press enter to use {file_name}: ").strip()
     if not filename_askey:
         filename_askey = file_name
 
+    pack = input("Pack it into the capsule chunk store? Repeated content is only stored once and is compressed. (y/n): ").strip().lower() == 'y'
+    unlock_at = ask_date("Seal the capsule until YYYY-MM-DD? (press enter to leave it open): ")
+
     try:
-        s3.upload_file(file_path,bucket_name,filename_askey)
-        print(f"Successfully uploaded {file_path} to {bucket_name} as {filename_askey}.")
+        if pack:
+            result = pack_manager.pack_file(ctx, file_path, bucket_name, filename_askey, progress=transfer_manager.print_progress)
+            print(f"Packed {file_path} as {result['Key']}: {result['NewChunks']} of {result['Chunks']} chunks were new, "
+                  f"{format_size(result['StoredBytes'])} stored for {format_size(result['Size'])}.")
+        else:
+            result = transfer_manager.upload(ctx, file_path, bucket_name, filename_askey, progress=transfer_manager.print_progress)
+            if result['Resumed']:
+                print(f"Resumed upload, {result['Resumed']} of {result['Parts']} parts were already sent.")
+            print(f"Successfully uploaded {file_path} to {bucket_name} as {filename_askey}.")
+
+        if unlock_at:
+            schedule_manager.seal(ctx, bucket_name, result['Key'], unlock_at)
+            print(f"Capsule sealed until {schedule_manager.format_time(unlock_at.timestamp())}.")
     except botocore.exceptions.ClientError as e:
         print(f"Failed to upload {e.response['Error']['Message']}")
+    except RuntimeError as e:
+        print(f"Failed to upload: {e}")
 
-def list_files():
-    s3 = boto3.client('s3')
+def upload_directory(ctx):
+    local_dir = input("Enter the directory to upload (or type 'back' to return): ").strip()
+    if local_dir == 'back':
+        return
 
-    bucket_name = input("Please enter the bucket that you're looking for (or enter 'back' to return): ").strip().lower()
+    if not os.path.isdir(local_dir):
+        print("The directory does not exist. Please check the path again.")
+        return
+
+    bucket_name = input("Enter the name of the bucket to upload into (or type back to return): ").strip().lower()
     if bucket_name == 'back':
         return
-    
+
+    prefix = input("Upload under which key prefix? (press enter for the bucket root): ").strip()
+
+    try:
+        result = transfer_manager.sync_directory(ctx, local_dir, bucket_name, prefix=prefix)
+    except botocore.exceptions.ClientError as e:
+        print(f"Failed to sync directory: {e.response['Error']['Message']}")
+        return
+
+    print(f"Uploaded {result['uploaded']} files, skipped {result['skipped']} unchanged, {len(result['failed'])} failed.")
+    print(f"{result['files_per_s']:.1f} files/s, {result['bytes_per_s'] / transfer_manager.MB:.2f} MB/s")
+    for key, error in result['failed']:
+        print(f"Failed: {key} ({error})")
+
+def iter_objects(ctx, bucket_name, prefix='', delimiter=None, start_after=None, page_size=1000, use_cache=True):
+    # Streams the bucket one list_objects_v2 page at a time, so memory stays bounded
+    # by a single page no matter how many keys the bucket holds.
+    for records in iter_object_pages(ctx, bucket_name, prefix, delimiter, start_after, page_size, use_cache):
+        yield from records
+
+
+def iter_object_pages(ctx, bucket_name, prefix='', delimiter=None, start_after=None, page_size=1000, use_cache=True):
+    # Pages already seen are served from the metadata cache, and the paginator
+    # resumes from the continuation token of the last cached page. Bulk operations
+    # pass use_cache=False because they must see every key that exists right now.
+    cache_key = ('objects', bucket_name, prefix, delimiter, start_after, page_size)
+    page_number = 0
+    token = None
+    while use_cache:
+        cached = ctx.cache.get(cache_key + (page_number,))
+        if cached is cache_manager.MISSING:
+            break
+        records, token = cached
+        yield records
+        if token is None:
+            return
+        page_number += 1
+
+    s3 = ctx.client('s3')
+    params = {'Bucket': bucket_name, 'PaginationConfig': {'PageSize': page_size}}
+    if prefix:
+        params['Prefix'] = prefix
+    if delimiter:
+        params['Delimiter'] = delimiter
+    if start_after:
+        params['StartAfter'] = start_after
+    if token:
+        params['PaginationConfig']['StartingToken'] = TokenEncoder().encode({'ContinuationToken': token})
+
+    for page in s3.get_paginator('list_objects_v2').paginate(**params):
+        records = [ObjectRecord(common_prefix['Prefix'], 0, None, None, None, True)
+                   for common_prefix in page.get('CommonPrefixes') or []]
+        for obj in page.get('Contents') or []:
+            records.append(ObjectRecord(obj['Key'], obj['Size'], obj.get('ETag', '').strip('"'),
+                                        obj.get('LastModified'), obj.get('StorageClass'), False))
+        if use_cache:
+            ctx.cache.set(cache_key + (page_number,), (records, page.get('NextContinuationToken')))
+        yield records
+        page_number += 1
+
+
+def format_size(num_bytes):
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.2f} {unit}"
+        size /= 1024
+
+
+def describe_object(record):
+    if record.is_prefix:
+        return f"{record.key} (folder)"
+    modified = f", {record.last_modified:%Y-%m-%d}" if record.last_modified else ""
+    return f"{record.key} ({format_size(record.size)}{modified})"
+
+
+def ask_number(prompt, scale=1):
+    value = input(prompt).strip()
+    if not value:
+        return None
+    try:
+        return int(float(value) * scale)
+    except ValueError:
+        print("Not a number, ignoring that filter.")
+        return None
+
+
+def ask_date(prompt):
+    value = input(prompt).strip()
+    if not value:
+        return None
     try:
-        response = s3.list_objects_v2(Bucket=bucket_name)
-        contents = response.get('Contents')
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        print("Dates look like 2024-12-31, ignoring that filter.")
+        return None
+
+
+def choose_records(ctx, bucket_name, prefix):
+    # With a synced index the user can search it locally instead of listing the bucket.
+    if not index_manager.has_index(ctx, bucket_name):
+        return iter_objects(ctx, bucket_name, prefix=prefix)
+    if input("Search the local file index instead of listing the bucket? (y/n): ").strip().lower() != 'y':
+        return iter_objects(ctx, bucket_name, prefix=prefix)
+
+    min_size = ask_number("Minimum size in MB (press enter to skip): ", 1024 * 1024)
+    max_size = ask_number("Maximum size in MB (press enter to skip): ", 1024 * 1024)
+    after = ask_date("Modified on or after YYYY-MM-DD (press enter to skip): ")
+    before = ask_date("Modified before YYYY-MM-DD (press enter to skip): ")
+    return ctx.index.query(bucket_name, prefix, min_size, max_size, after, before)
+
+
+def sync_index(ctx):
+    bucket_name = input("Which bucket should be indexed? (or type 'back' to return): ").strip().lower()
+    if bucket_name == 'back':
+        return
+    manifest = input("S3 Inventory manifest as s3://bucket/key (press enter to list the bucket instead): ").strip()
+
+    try:
+        if manifest.startswith('s3://'):
+            manifest_bucket, _, manifest_key = manifest[len('s3://'):].partition('/')
+            result = index_manager.sync_from_inventory(ctx, manifest_bucket, manifest_key, bucket_name)
+        else:
+            result = index_manager.sync_from_listing(ctx, bucket_name)
+    except botocore.exceptions.ClientError as e:
+        print(f"Error indexing bucket: {e.response['Error']['Message']}")
+        return
+    except (RuntimeError, ValueError) as e:
+        print(f"Error indexing bucket: {e}")
+        return
+
+    print(f"Indexed {result['objects']} files from {bucket_name} ({result['objects_per_s']:.0f} files/s).")
+
+
+def ask_prefix():
+    return input("Filter by key prefix (press enter to show everything): ").strip()
+
+
+def browse_objects(records, prompt):
+    # Shows PAGE_SIZE records at a time and lets the user pick one from the current
+    # page, or ask for the next one. Returns the chosen record or None.
+    records = iter(records)
+    page = list(islice(records, PAGE_SIZE))
+    if not page:
+        return None
+
+    while True:
+        print()
+        for idx, record in enumerate(page, start=1):
+            print(f"{idx}. {describe_object(record)}")
 
-        if not contents:
+        next_page = list(islice(records, PAGE_SIZE))
+        more = bool(next_page)
+
+        while True:
+            hint = ", 'n' for next page" if more else ""
+            choice = input(f"{prompt} (1-{len(page)}{hint}, or 0 to cancel): ").strip().lower()
+            if choice == 'n' and more:
+                page = next_page
+                break
+            try:
+                file_choice = int(choice)
+            except ValueError:
+                print("Invalid input. Please enter an integer.")
+                continue
+            if file_choice == 0:
+                return None
+            if 1 <= file_choice <= len(page):
+                return page[file_choice - 1]
+            print(f"Enter a number between 1 and {len(page)} or 0 to cancel.")
+
+
+def list_files(ctx):
+    bucket_name = input("Please enter the bucket that you're looking for (or enter 'back' to return): ").strip().lower()
+    if bucket_name == 'back':
+        return
+    prefix = ask_prefix()
+
+    try:
+        records = iter_objects(ctx, bucket_name, prefix=prefix, delimiter='/')
+        page = list(islice(records, PAGE_SIZE))
+        if not page:
             print(f'No files found in bucket "{bucket_name}".')
             return
-    
+
         print(f"\nFiles in bucket {bucket_name}")
-        for idx, file in enumerate(contents, start=1):
-            filename_askey = file['Key']
-            size_kb = file['Size'] / 1024
-            print(f"{idx}. {filename_askey}. ({size_kb})")
+        idx = 0
+        while page:
+            for record in page:
+                idx += 1
+                print(f"{idx}. {describe_object(record)}")
+            page = list(islice(records, PAGE_SIZE))
+            if page and input("Press enter for more, or 'q' to stop: ").strip().lower() == 'q':
+                return
 
     except botocore.exceptions.ClientError as e:
-        print()
+        print(f"Error listing files: {e.response['Error']['Message']}")
 
-def download_files():
-    s3 = boto3.client('s3')
-    
+def download_files(ctx):
     bucket_name = input("Enter name of the bucket that you're calling from (or type 'back' to return): ").strip().lower()
     if bucket_name == 'back':
         return
+    prefix = ask_prefix()
     
     try:
-        response = s3.list_objectsv2(Bucket=bucket_name)
-        contents = response.get('Contents')
-
-        if not contents:
-            print(f"There is no file in {bucket_name}")
+        if prefix and input(f"Download every file under '{prefix}'? (y/n): ").strip().lower() == 'y':
+            local_dir = input("Which local folder should they go in? (enter for the current folder): ").strip() or '.'
+            result = transfer_manager.download_prefix(ctx, bucket_name, prefix, local_dir)
+            print(f"Downloaded {result['downloaded']} files, {len(result['failed'])} failed.")
+            print(f"{result['files_per_s']:.1f} files/s, {result['bytes_per_s'] / transfer_manager.MB:.2f} MB/s")
+            for key, error in result['failed']:
+                print(f"Failed: {key} ({error})")
             return
-        
+
         print(f"\nFiles availble in bucket: {bucket_name}.")
-        for idx, file in enumerate(contents,start=1):
-            print(f"{idx}.{file['Key']} ({file['Size'] / 1024:.2f} KB.")
+        record = browse_objects(choose_records(ctx, bucket_name, prefix), "Pick a file to download")
+        if record is None:
+            print("Download cancelled.")
+            return
 
-        while True:
-            try:
-                file_choice = int(input(f"Pick a file from (1-{len(contents)} or 0 to cancel: )").strip())
-                if file_choice == 0:
-                    print("Download cancelled.")
-                    return
-                
-                if 1 <= file_choice >= len(contents):
-                    filename_askey = contents[file_choice - 1]['Key']
-                    local_filename = input(f"What should the file be saved as locally? (enter to use {filename_askey} as default): ").strip().lower()
-                    if not local_filename:
-                        local_filename = filename_askey
-
-                    s3.download_file(bucket_name,filename_askey,local_filename)
-                    print(f"file {filename_askey} downloaded successfuly as {local_filename}")
-                    return
-                else:
-                    print(f"Enter a number between 1 and {len(contents)} or 0 to cancel: ").strip().lower() #selfnote ask why u cant do .strip().lower() again.
+        filename_askey = record.key
+        packed = filename_askey.endswith(pack_manager.MANIFEST_SUFFIX)
+        default_name = os.path.basename(filename_askey[:-len(pack_manager.MANIFEST_SUFFIX)] if packed else filename_askey)
+        local_filename = input(f"What should the file be saved as locally? (enter to use {default_name} as default): ").strip()
+        if not local_filename:
+            local_filename = default_name
 
-            except ValueError:
-                print("Invalid input, Please enter an integer.")
+        if packed:
+            pack_manager.unpack(ctx, bucket_name, filename_askey, local_filename, progress=transfer_manager.print_progress)
+        else:
+            transfer_manager.download(ctx, bucket_name, filename_askey, local_filename, progress=transfer_manager.print_progress)
+        print(f"file {filename_askey} downloaded successfuly as {local_filename}")
+
+    except botocore.exceptions.ClientError as e:
+        print(f"Error: {e.response['Error']['Message']}")
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+
+def share_files(ctx):
+    print("\n1. Download link for one file")
+    print("2. Download links for every file under a prefix")
+    print("3. Upload link for one file")
+    print("4. Browser upload form for your capsule bucket")
+    share_choice = input("Pick a number between 1-4 (or type 'back' to return): ").strip()
+    if share_choice not in ('1', '2', '3', '4'):
+        return
+
+    hours = ask_number("How many hours should the link work? (press enter for 1, at most 168): ")
+    expires = (hours or 1) * 3600
+
+    try:
+        if share_choice == '4':
+            prefix = input("Only allow uploads under which prefix? (press enter for the whole bucket): ").strip()
+            form = presign_manager.presigned_post(ctx, key_prefix=prefix, expires=expires)
+            print(f"POST files to {form['url']} with these form fields (the file goes last, as 'file'):")
+            for name, value in form['fields'].items():
+                print(f"  {name}: {value}")
+            return
+
+        bucket_name = input("Which bucket are the files in? (or type 'back' to return): ").strip().lower()
+        if bucket_name == 'back':
+            return
+
+        if share_choice == '2':
+            prefix = ask_prefix()
+            count = 0
+            for key, url in presign_manager.presign_prefix(ctx, bucket_name, prefix, expires=expires):
+                print(f"{key}: {url}")
+                count += 1
+            print(f"Created {count} download links.")
+        elif share_choice == '3':
+            key = input("What key should the uploaded file get? ").strip()
+            print(presign_manager.presign_url(ctx, bucket_name, key, method='PUT', expires=expires))
+        else:
+            record = browse_objects(choose_records(ctx, bucket_name, ask_prefix()), "Pick a file to share")
+            if record is None:
+                print("Sharing cancelled.")
+                return
+            print(presign_manager.presign_url(ctx, bucket_name, record.key, expires=expires,
+                                              download_name=os.path.basename(record.key)))
+    except botocore.exceptions.ClientError as e:
+        print(f"Error: {e.response['Error']['Message']}")
+    except ValueError as e:
+        print(f"Error: {e}")
+
+def copy_files(ctx):
+    # S3 copies the bytes itself, nothing is downloaded and uploaded again.
+    bucket_name = input("Which bucket are the files in? (or type 'back' to return): ").strip().lower()
+    if bucket_name == 'back':
+        return
+    prefix = ask_prefix()
 
+    try:
+        whole_prefix = prefix and input(f"Copy every file under '{prefix}'? (y/n): ").strip().lower() == 'y'
+        if not whole_prefix:
+            record = browse_objects(choose_records(ctx, bucket_name, prefix), "Pick a file to copy")
+            if record is None:
+                print("Copy cancelled.")
+                return
+            source_key = record.key
+
+        destination_bucket = input(f"Copy into which bucket? (enter for {bucket_name}): ").strip().lower() or bucket_name
+        default_target = prefix if whole_prefix else source_key
+        target = input(f"Copy to which {'prefix' if whole_prefix else 'key'}? (enter for {default_target}): ").strip() or default_target
+        storage_class = input("New storage class, e.g. GLACIER_IR or DEEP_ARCHIVE for sealed capsules (enter to keep it): ").strip().upper() or None
+        move = input("Remove the originals once copied? (y/n): ").strip().lower() == 'y'
+
+        if whole_prefix:
+            result = copy_manager.copy_prefix(ctx, bucket_name, prefix, destination_bucket, target,
+                                              storage_class=storage_class, move=move)
+            print(f"Copied {result['copied']} files ({result['objects_per_s']:.0f} files/s), {len(result['failed'])} failed.")
+            print(f"{format_size(result['bytes'])} copied inside S3 without passing through this machine.")
+            if move:
+                print(f"Removed {result['deleted']} originals.")
+            for key, error in result['failed']:
+                print(f"Failed: {key} ({error})")
+            return
+
+        result = copy_manager.copy_object(ctx, bucket_name, source_key, destination_bucket, target,
+                                          storage_class=storage_class, move=move)
+        print(f"{'Moved' if move else 'Copied'} {source_key} to {destination_bucket}/{target} ({format_size(result['Size'])}).")
     except botocore.exceptions.ClientError as e:
         print(f"Error: {e.response['Error']['Message']}")
+    except ValueError as e:
+        print(f"Error: {e}")
 
-def delete_file():
-    s3 = boto3.client('s3')
+def delete_file(ctx):
+    s3 = ctx.client('s3')
 
     bucket_name = input("Which bucket is the file you'd like to delete in? (or type 'back' to return): ").strip().lower()
     if bucket_name == 'back':
         return
+    prefix = ask_prefix()
     
     try:
-        response = s3.list_objectsv2(Bucket=bucket_name)
-        contents = response.get('Contents')
-
-        if not contents:
-            print(f"No contents exist in the {bucket_name}.")
+        if prefix and input(f"Delete every file under '{prefix}'? (y/n): ").strip().lower() == 'y':
+            if input("Are you sure? This can't be undone. (y/n): ").strip().lower() != 'y':
+                print("Deletion cancelled.")
+                return
+            result = delete_manager.delete_prefix(ctx, bucket_name, prefix)
+            print(f"Deleted {result['deleted']} files ({result['objects_per_s']:.0f} files/s), {len(result['failed'])} failed.")
             return
-        
+
         print(f"\nFiles in bucket {bucket_name}: ")
-        for idx,file in enumerate (contents,start=1):
-            print(f"{idx}.{file['Key']} ({file['Size'] / 1024:.2f} KB.")
+        record = browse_objects(choose_records(ctx, bucket_name, prefix), "Pick a file to delete")
+        if record is None:
+            return
 
+        filename_askey = record.key
         while True:
-            try: 
-                file_choice = int(input(f"\nPick a file to delete (1-{len(contents)} or 0 to cancel): ").strip())
-                if file_choice == 0:
-                    return
-                
-                if 1<= file_choice >= len(contents):
-                    filename_askey = contents[file_choice - 1]['Key']
-                    confirm = input("Are you sure you want to permanently delete this file? (y / n): ").strip().lower()
-                    if confirm == 'y':
-                        s3.delete_object(Bucket=bucket_name, Key=filename_askey)
-                        print(f"File {filename_askey} has been permanently deleted.")
-                        return
-                    
-                    if confirm == 'n':
-                        print("Deletion cancelled.")
-                        return
-                    
-                    else:
-                        print("Invalid input, please enter either the letter 'y' or 'n'. ")
-                else:
-                    print(f"Enter a valid number between 1-{len(contents)} or 0 to cancel.")
-            except ValueError:
-                print("Invalid input. Please enter an integer.")
+            confirm = input("Are you sure you want to permanently delete this file? (y / n): ").strip().lower()
+            if confirm == 'y':
+                s3.delete_object(Bucket=bucket_name, Key=filename_askey)
+                ctx.cache.invalidate('objects', bucket_name)
+                if index_manager.has_index(ctx, bucket_name):
+                    ctx.index.remove(bucket_name, [filename_askey])
+                print(f"File {filename_askey} has been permanently deleted.")
+                return
+            
+            if confirm == 'n':
+                print("Deletion cancelled.")
+                return
+            
+            print("Invalid input, please enter either the letter 'y' or 'n'. ")
     except botocore.exceptions.ClientError as e:
-        print(f"Error: {e.response}['Error']['Message]")
+        print(f"Error: {e.response['Error']['Message']}")
 
 
 
@@ -0,0 +1,148 @@
+import json
+import os
+import time
+
+import cache_manager
+import client_manager
+import retry_manager
+import trace_manager
+
+# Everything a logged-in user needs, resolved once at login and passed to every
+# menu and operation so nothing falls back to the default credential chain.
+# Jobs, the key index and the scheduler import their service modules on first
+# use, so logging in does not load the S3 and EC2 managers. When login hands
+# over the caller identity, clients also get the local permission check.
+
+CONFIG_PATH = os.environ.get('TIMECAPSULE_CONFIG', 'timecapsule.json')
+
+DEFAULT_SETTINGS = {
+    'region': None,
+    'max_pool_connections': client_manager.DEFAULT_MAX_POOL_CONNECTIONS,
+    'tcp_keepalive': client_manager.DEFAULT_TCP_KEEPALIVE,
+    'show_timings': False,
+    'cache_enabled': True,
+    'cache_path': None,
+    'cache_ttls': {},
+    'cache_max_entries': cache_manager.DEFAULT_MAX_ENTRIES,
+    'cache_max_bytes': cache_manager.DEFAULT_MAX_BYTES,
+    'retry_max_attempts': retry_manager.DEFAULT_MAX_ATTEMPTS,
+    'rate_limits': {},
+    # Reject calls the capsule user's policies would deny before they are sent.
+    # Only applies to users this app registered or provisioned, see auth_manager.
+    'local_permission_checks': False,
+    # Per-call latency, bytes, retries and errors, written to trace_export_path
+    # (.prom, .jsonl or .json) when the context closes.
+    'trace_enabled': False,
+    'trace_sample_rate': 1.0,
+    'trace_export_path': None,
+}
+
+
+def load_settings(path=CONFIG_PATH):
+    settings = dict(DEFAULT_SETTINGS)
+    if path and os.path.isfile(path):
+        with open(path) as config_file:
+            settings.update(json.load(config_file))
+    return settings
+
+
+class AppContext:
+    def __init__(self, session, username=None, settings=None, identity=None):
+        self.session = session
+        self.identity = identity
+        self.username = username or (identity.username if identity else None)
+        self.settings = settings if settings is not None else load_settings()
+        self.timings = {}
+
+        client_manager.configure(
+            max_pool_connections=self.settings.get('max_pool_connections'),
+            tcp_keepalive=self.settings.get('tcp_keepalive'),
+        )
+        retry_manager.configure(
+            max_attempts=self.settings.get('retry_max_attempts'),
+            rate_limits=self.settings.get('rate_limits'),
+        )
+        trace_manager.configure(
+            enabled=self.settings.get('trace_enabled'),
+            sample_rate=self.settings.get('trace_sample_rate'),
+        )
+
+        self.region = session.region_name or self.settings.get('region') or 'us-east-1'
+        self.credentials = self._resolve_credentials()
+        self._clients = {}
+        self._jobs = None
+        self._index = None
+        self._schedule = None
+        self.permissions = self._build_permissions()
+
+        self.cache = cache_manager.MetadataCache(
+            ttls=self.settings.get('cache_ttls'),
+            max_entries=self.settings.get('cache_max_entries', cache_manager.DEFAULT_MAX_ENTRIES),
+            max_bytes=self.settings.get('cache_max_bytes', cache_manager.DEFAULT_MAX_BYTES),
+            path=self.settings.get('cache_path'),
+            # A persisted cache is shared on disk, so keep each user's entries apart.
+            namespace=self.credentials.access_key if self.credentials else '',
+            enabled=self.settings.get('cache_enabled', True),
+        )
+
+    def _resolve_credentials(self):
+        start = time.perf_counter()
+        credentials = self.session.get_credentials()
+        frozen = credentials.get_frozen_credentials() if credentials else None
+        self.timings['credential_resolution'] = time.perf_counter() - start
+        if self.settings.get('show_timings'):
+            print(f"Credentials resolved in {self.timings['credential_resolution'] * 1000:.1f} ms")
+        return frozen
+
+    def _build_permissions(self):
+        # Only capsule users are checked: they are the ones whose policies are known.
+        if (self.identity is None or self.identity.kind != 'user' or not self.identity.capsule_user
+                or not self.settings.get('local_permission_checks', False)):
+            return None
+        import auth_manager
+        return auth_manager.Permissions.for_capsule_user(self.identity)
+
+    def client(self, service, **config_options):
+        key = (service, tuple(sorted(config_options.items())))
+        client = self._clients.get(key)
+        if client is None:
+            client = client_manager.get_client(service, session=self.session, region=self.region, **config_options)
+            if self.permissions is not None:
+                self.permissions.install(client)
+            self._clients[key] = client
+        return client
+
+    @property
+    def jobs(self):
+        if self._jobs is None:
+            import job_manager
+            self._jobs = job_manager.JobManager(self)
+        return self._jobs
+
+    @property
+    def index(self):
+        if self._index is None:
+            import index_manager
+            self._index = index_manager.KeyIndex(index_manager.index_path(self))
+        return self._index
+
+    @property
+    def schedule(self):
+        if self._schedule is None:
+            import schedule_manager
+            self._schedule = schedule_manager.CapsuleScheduler(self)
+        return self._schedule
+
+    def close(self):
+        if self.settings.get('show_timings') and retry_manager.metrics():
+            print(retry_manager.format_metrics())
+        if self.settings.get('show_timings') and self.permissions is not None:
+            print(f"Permission checks: {self.permissions.checked} calls checked, "
+                  f"{self.permissions.denied} denied locally")
+        if trace_manager.enabled() and self.settings.get('trace_export_path'):
+            print(f"Call traces written to {trace_manager.export(self.settings['trace_export_path'])}")
+        self.cache.close()
+        if self._index is not None:
+            self._index.close()
+        if self._schedule is not None:
+            self._schedule.close()
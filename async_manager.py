@@ -0,0 +1,464 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import time
+from contextlib import AsyncExitStack
+
+import botocore
+
+import S3_manager
+import copy_manager
+import delete_manager
+import index_manager
+import retry_manager
+import trace_manager
+import transfer_manager
+
+# Optional asyncio backend for bulk work on many small objects. One event loop
+# and one aiobotocore client replace a thread per request: concurrency is an
+# asyncio.Semaphore, and the client's connector is the shared connection pool,
+# sized to match. Needs the aiobotocore package, imported on first use.
+#
+# Work is fanned out a bounded number of tasks at a time. Cancelling a run (for
+# example Ctrl+C inside asyncio.run) cancels the tasks in flight, and each one
+# cleans up after itself: partial downloads are deleted and multipart uploads
+# are aborted so no orphaned parts are left to pay for.
+#
+# Clients built here get the same hooks as client_manager's: retry_manager's
+# rate limits and retries (waiting with asyncio.sleep), tracing, and the local
+# permission check when it is on.
+
+MB = transfer_manager.MB
+DELETE_BATCH = 1000
+
+DEFAULT_ASYNC_SETTINGS = {
+    'async_concurrency': 256,
+    'async_part_size': 16 * MB,
+    'async_multipart_threshold': 64 * MB,
+}
+
+
+def async_settings(ctx, **overrides):
+    settings = dict(DEFAULT_ASYNC_SETTINGS)
+    settings.update({name: value for name, value in ctx.settings.items() if name in settings})
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    return settings
+
+
+def aiobotocore_available():
+    return importlib.util.find_spec('aiobotocore') is not None
+
+
+def load_aiobotocore():
+    try:
+        import aiobotocore.config
+        import aiobotocore.session
+    except ImportError:
+        raise RuntimeError("The async transfer backend needs the aiobotocore package installed.") from None
+    return aiobotocore
+
+
+def _record(obj):
+    return S3_manager.ObjectRecord(obj['Key'], obj['Size'], obj.get('ETag', '').strip('"'),
+                                   obj.get('LastModified'), obj.get('StorageClass'), False)
+
+
+class AsyncS3:
+    # Use as 'async with AsyncS3(ctx) as s3'. A ready-made async client can be
+    # passed in instead of creating one, as the benchmarks do.
+    def __init__(self, ctx, concurrency=None, client=None, **overrides):
+        self.ctx = ctx
+        self.settings = async_settings(ctx, async_concurrency=concurrency, **overrides)
+        self.concurrency = self.settings['async_concurrency']
+        self.verify = transfer_manager.transfer_settings(ctx)['verify_downloads']
+        self.client = client
+        self.semaphore = None
+        self.stack = AsyncExitStack()
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        if self.client is None:
+            aiobotocore = load_aiobotocore()
+            credentials = self.ctx.credentials
+            # retry_manager takes over retries, as it does for client_manager's clients.
+            config = aiobotocore.config.AioConfig(max_pool_connections=self.concurrency,
+                                                  retries={'total_max_attempts': 1, 'mode': 'standard'})
+            session = aiobotocore.session.get_session()
+            self.client = await self.stack.enter_async_context(session.create_client(
+                's3', region_name=self.ctx.region, config=config,
+                aws_access_key_id=credentials.access_key if credentials else None,
+                aws_secret_access_key=credentials.secret_key if credentials else None,
+                aws_session_token=credentials.token if credentials else None))
+            trace_manager.install(retry_manager.install_async(self.client))
+            if self.ctx.permissions is not None:
+                self.ctx.permissions.install(self.client)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stack.aclose()
+
+    async def iter_objects(self, bucket_name, prefix=''):
+        params = {'Bucket': bucket_name, 'PaginationConfig': {'PageSize': 1000}}
+        if prefix:
+            params['Prefix'] = prefix
+        async for page in self.client.get_paginator('list_objects_v2').paginate(**params):
+            for obj in page.get('Contents') or []:
+                yield _record(obj)
+
+    async def upload_file(self, file_path, bucket_name, key):
+        size = os.path.getsize(file_path)
+        if size >= self.settings['async_multipart_threshold']:
+            return await self._multipart_upload(file_path, bucket_name, key, size)
+        async with self.semaphore:
+            with open(file_path, 'rb') as source:
+                body = source.read()
+            await self.client.put_object(Bucket=bucket_name, Key=key, Body=body)
+        return size
+
+    async def _multipart_upload(self, file_path, bucket_name, key, size):
+        part_size = transfer_manager.choose_part_size(size, self.settings['async_part_size'])
+        async with self.semaphore:
+            upload_id = (await self.client.create_multipart_upload(Bucket=bucket_name, Key=key))['UploadId']
+
+        async def send_part(number, offset):
+            async with self.semaphore:
+                with open(file_path, 'rb') as source:
+                    source.seek(offset)
+                    data = source.read(part_size)
+                response = await self.client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                                         PartNumber=number, Body=data)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        parts = [asyncio.ensure_future(send_part(number, offset))
+                 for number, offset in enumerate(range(0, size, part_size), 1)]
+        try:
+            completed = await asyncio.gather(*parts)
+            async with self.semaphore:
+                await self.client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                                            MultipartUpload={'Parts': completed})
+        except BaseException:
+            for part in parts:
+                part.cancel()
+            await asyncio.gather(*parts, return_exceptions=True)
+            # Shielded so the abort still goes out while this task is being cancelled.
+            await asyncio.shield(self.client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id))
+            raise
+        return size
+
+    async def download_file(self, bucket_name, key, local_path):
+        directory = os.path.dirname(local_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{local_path}.download"
+        written = 0
+        digest = hashlib.md5()
+        try:
+            async with self.semaphore:
+                response = await self.client.get_object(Bucket=bucket_name, Key=key)
+                # Small objects, so writing straight from the loop is cheaper than a thread hop.
+                with open(tmp_path, 'wb') as target:
+                    async with response['Body'] as body:
+                        while True:
+                            chunk = await body.read(MB)
+                            if not chunk:
+                                break
+                            target.write(chunk)
+                            digest.update(chunk)
+                            written += len(chunk)
+            # Checked against the GET's own ETag, which saves the HEAD the threaded
+            # download makes. Multipart and KMS ETags are not plain MD5s.
+            etag = response.get('ETag', '').strip('"')
+            if (self.verify and etag and '-' not in etag and response.get('ServerSideEncryption') != 'aws:kms'
+                    and digest.hexdigest() != etag):
+                raise ValueError(f"Checksum mismatch for {key}, the download was discarded.")
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return written
+
+    async def _headers(self, bucket_name, key, changes):
+        async with self.semaphore:
+            head = await self.client.head_object(Bucket=bucket_name, Key=key)
+        return copy_manager.merged_headers(head, changes)
+
+    async def copy_object(self, settings, source, record, destination_bucket, destination_key, changes):
+        # Same rules as copy_manager.copy_one, with copy_settings() for the thresholds.
+        if copy_manager.copies_in_place(source, record, destination_bucket, destination_key, changes):
+            async with self.semaphore:
+                await self.client.put_object_tagging(Bucket=source, Key=record.key,
+                                                     Tagging=copy_manager.tag_set(changes.tags))
+            return 0
+        if record.size >= settings['copy_threshold']:
+            await self._multipart_copy(settings, source, record, destination_bucket, destination_key, changes)
+            return record.size
+        headers = await self._headers(source, record.key, changes) if changes.metadata is not None else None
+        async with self.semaphore:
+            await self.client.copy_object(**copy_manager.copy_object_params(
+                source, record, destination_bucket, destination_key, changes, headers))
+        return record.size
+
+    async def _multipart_copy(self, settings, source, record, destination_bucket, destination_key, changes):
+        tags = changes.tags
+        if tags is None:
+            async with self.semaphore:
+                tag_set = (await self.client.get_object_tagging(Bucket=source, Key=record.key))['TagSet']
+            tags = {tag['Key']: tag['Value'] for tag in tag_set}
+        params = copy_manager.multipart_params(destination_bucket, destination_key, changes,
+                                               await self._headers(source, record.key, changes), tags)
+        async with self.semaphore:
+            upload_id = (await self.client.create_multipart_upload(**params))['UploadId']
+
+        async def copy_part(number, first, last):
+            async with self.semaphore:
+                response = await self.client.upload_part_copy(
+                    Bucket=destination_bucket, Key=destination_key, UploadId=upload_id, PartNumber=number,
+                    CopySource={'Bucket': source, 'Key': record.key}, CopySourceRange=f"bytes={first}-{last}",
+                    CopySourceIfMatch=f'"{record.etag}"')
+            return {'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+
+        part_size = transfer_manager.choose_part_size(record.size, settings['copy_part_size'])
+        parts = [asyncio.ensure_future(copy_part(*part)) for part in copy_manager.part_ranges(record.size, part_size)]
+        try:
+            completed = await asyncio.gather(*parts)
+            async with self.semaphore:
+                await self.client.complete_multipart_upload(Bucket=destination_bucket, Key=destination_key,
+                                                            UploadId=upload_id, MultipartUpload={'Parts': completed})
+        except BaseException:
+            for part in parts:
+                part.cancel()
+            await asyncio.gather(*parts, return_exceptions=True)
+            await asyncio.shield(self.client.abort_multipart_upload(Bucket=destination_bucket, Key=destination_key,
+                                                                    UploadId=upload_id))
+            raise
+
+    async def delete_batch(self, bucket_name, keys):
+        # delete_manager.delete_batch, retrying per-key errors with an awaited backoff.
+        pending = [{'Key': key} for key in keys]
+        failed = []
+        for attempt in range(delete_manager.MAX_ATTEMPTS):
+            async with self.semaphore:
+                response = await self.client.delete_objects(Bucket=bucket_name,
+                                                            Delete={'Objects': pending, 'Quiet': True})
+            errors = response.get('Errors', [])
+            if not errors:
+                return failed
+            pending, fatal = delete_manager.sort_errors(errors)
+            failed.extend(fatal)
+            if not pending:
+                return failed
+            await asyncio.sleep(retry_manager.backoff_delay(attempt))
+        failed.extend((target['Key'], 'RetriesExhausted') for target in pending)
+        return failed
+
+    async def fan_out(self, work, items, result, counter):
+        # Keeps at most twice the concurrency in tasks, so a million keys do not
+        # become a million pending tasks. Items are (label, args) pairs, work(*args)
+        # returns a byte count, and failures are collected per label.
+        pending = {}
+
+        def collect(done):
+            for task in done:
+                label = pending.pop(task)
+                try:
+                    result['bytes'] += task.result() or 0
+                    result[counter] += 1
+                except Exception as e:
+                    # ClientError, connection errors and local file errors alike.
+                    result['failed'].append((label, str(e)))
+
+        try:
+            async for label, args in _aiter(items):
+                if len(pending) >= self.concurrency * 2:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                pending[asyncio.ensure_future(work(*args))] = label
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        return result
+
+
+async def _aiter(items):
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def _summary(result, start, done):
+    elapsed = time.perf_counter() - start
+    result['elapsed'] = elapsed
+    result['files_per_s'] = done / elapsed if elapsed else 0.0
+    result['bytes_per_s'] = result['bytes'] / elapsed if elapsed else 0.0
+    return result
+
+
+async def download_prefix_async(ctx, bucket_name, prefix, local_dir, concurrency=None, client=None):
+    result = {'downloaded': 0, 'failed': [], 'bytes': 0}
+    start = time.perf_counter()
+    async with AsyncS3(ctx, concurrency, client) as s3:
+        async def keys():
+            async for record in s3.iter_objects(bucket_name, prefix):
+                if not record.key.endswith('/'):
+                    yield record.key, (record.key,)
+
+        async def fetch(key):
+            return await s3.download_file(bucket_name, key, transfer_manager.local_path_for(local_dir, prefix, key))
+
+        await s3.fan_out(fetch, keys(), result, 'downloaded')
+    return _summary(result, start, result['downloaded'])
+
+
+async def sync_directory_async(ctx, local_dir, bucket_name, prefix='', concurrency=None, client=None):
+    # Same skip rules as transfer_manager.sync_directory, from one listing.
+    settings = transfer_manager.transfer_settings(ctx)
+    result = {'uploaded': 0, 'skipped': 0, 'failed': [], 'bytes': 0}
+    start = time.perf_counter()
+    async with AsyncS3(ctx, concurrency, client) as s3:
+        remote = {record.key: record async for record in s3.iter_objects(bucket_name, prefix)}
+        uploaded = []
+
+        def changed():
+            for path, key in transfer_manager.walk_directory(local_dir, prefix):
+                if transfer_manager.needs_upload(path, remote.get(key), settings):
+                    yield key, (path, key)
+                else:
+                    result['skipped'] += 1
+
+        async def upload(path, key):
+            size = await s3.upload_file(path, bucket_name, key)
+            uploaded.append(index_manager.written_row(key, size))
+            return size
+
+        try:
+            await s3.fan_out(upload, changed(), result, 'uploaded')
+        finally:
+            ctx.cache.invalidate('objects', bucket_name)
+            if uploaded and index_manager.has_index(ctx, bucket_name):
+                ctx.index.upsert(bucket_name, uploaded)
+    return _summary(result, start, result['uploaded'] + result['skipped'])
+
+
+async def _delete_keys(ctx, s3, bucket_name, keys, result):
+    # A batch that fails as a whole fails every key in it, as in delete_manager,
+    # rather than whichever task happened to send it.
+    try:
+        failed = await s3.delete_batch(bucket_name, keys)
+    except botocore.exceptions.ClientError as e:
+        failed = [(key, e.response['Error']['Code']) for key in keys]
+    except botocore.exceptions.BotoCoreError as e:
+        failed = [(key, type(e).__name__) for key in keys]
+    result['failed'].extend(failed)
+    result['deleted'] += len(keys) - len(failed)
+    if len(failed) < len(keys) and index_manager.has_index(ctx, bucket_name):
+        kept = {key for key, _ in failed}
+        ctx.index.remove(bucket_name, [key for key in keys if key not in kept])
+
+
+async def copy_prefix_async(ctx, bucket_name, prefix, destination_bucket, destination_prefix=None,
+                            storage_class=None, metadata=None, tags=None, move=False, concurrency=None, client=None,
+                            **overrides):
+    # copy_manager.copy_prefix on the event loop. A move deletes the copied keys
+    # in batches as they fill up, and the rest once the copies are done.
+    settings = copy_manager.copy_settings(ctx, **overrides)
+    destination_prefix = prefix if destination_prefix is None else destination_prefix
+    changes = copy_manager.Changes(storage_class, metadata, tags)
+    copy_manager.check_locations(bucket_name, prefix, destination_bucket, destination_prefix, changes, move)
+    result = {'copied': 0, 'failed': [], 'bytes': 0, 'multipart': 0}
+    if move:
+        result['deleted'] = 0
+    copied = []
+    written = []
+    start = time.perf_counter()
+    async with AsyncS3(ctx, concurrency, client) as s3:
+        async def delete(keys):
+            await _delete_keys(ctx, s3, bucket_name, keys, result)
+
+        async def copy(record):
+            target = copy_manager.destination_key(record.key, prefix, destination_prefix)
+            size = await s3.copy_object(settings, bucket_name, record, destination_bucket, target, changes)
+            written.append(copy_manager.indexed_copy(record, target, changes))
+            result['multipart'] += record.size >= settings['copy_threshold']
+            if move:
+                copied.append(record.key)
+                if len(copied) >= DELETE_BATCH:
+                    batch = copied[:DELETE_BATCH]
+                    del copied[:DELETE_BATCH]
+                    await delete(batch)
+            return size
+
+        async def records():
+            async for record in s3.iter_objects(bucket_name, prefix):
+                yield record.key, (record,)
+
+        try:
+            await s3.fan_out(copy, records(), result, 'copied')
+            if copied:
+                await delete(copied)
+        finally:
+            ctx.cache.invalidate('objects', destination_bucket)
+            if move and destination_bucket != bucket_name:
+                ctx.cache.invalidate('objects', bucket_name)
+            if written and index_manager.has_index(ctx, destination_bucket):
+                ctx.index.upsert(destination_bucket, written)
+    _summary(result, start, result['copied'])
+    result['objects_per_s'] = result.pop('files_per_s')
+    return result
+
+
+async def delete_prefix_async(ctx, bucket_name, prefix, concurrency=None, client=None):
+    result = {'deleted': 0, 'batches': 0, 'failed': [], 'bytes': 0}
+    start = time.perf_counter()
+    async with AsyncS3(ctx, concurrency, client) as s3:
+        async def batches():
+            batch = []
+            async for record in s3.iter_objects(bucket_name, prefix):
+                batch.append(record.key)
+                if len(batch) == DELETE_BATCH:
+                    yield batch[0], (batch,)
+                    batch = []
+            if batch:
+                yield batch[0], (batch,)
+
+        async def delete(keys):
+            await _delete_keys(ctx, s3, bucket_name, keys, result)
+
+        try:
+            await s3.fan_out(delete, batches(), result, 'batches')
+        finally:
+            ctx.cache.invalidate('objects', bucket_name)
+    _summary(result, start, result['deleted'])
+    result['objects_per_s'] = result.pop('files_per_s')
+    return result
+
+
+# Blocking entry points for transfer_manager, copy_manager and delete_manager when
+# transfer_backend is 'async'. Each runs its own event loop, so they must not be
+# called from inside one.
+
+def download_prefix(ctx, bucket_name, prefix, local_dir, concurrency=None):
+    return asyncio.run(download_prefix_async(ctx, bucket_name, prefix, local_dir, concurrency))
+
+
+def sync_directory(ctx, local_dir, bucket_name, prefix='', concurrency=None):
+    return asyncio.run(sync_directory_async(ctx, local_dir, bucket_name, prefix, concurrency))
+
+
+def copy_prefix(ctx, bucket_name, prefix, destination_bucket, destination_prefix=None, storage_class=None,
+                metadata=None, tags=None, move=False, concurrency=None, **overrides):
+    return asyncio.run(copy_prefix_async(ctx, bucket_name, prefix, destination_bucket, destination_prefix,
+                                         storage_class, metadata, tags, move, concurrency, **overrides))
+
+
+def delete_prefix(ctx, bucket_name, prefix, concurrency=None):
+    return asyncio.run(delete_prefix_async(ctx, bucket_name, prefix, concurrency))
@@ -0,0 +1,268 @@
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+from botocore.awsrequest import AWSResponse
+
+import client_manager
+
+# Who is logged in and what they may do, worked out once per session. The caller
+# identity comes from one STS call at login and is cached per access key, so the
+# username is read from the ARN instead of being typed in. Capsule users only
+# have the inline policies attach_policies() writes, so those documents are
+# compiled into a local policy check that runs before every API call: a call the
+# policies would deny fails straight away with AccessDenied and never leaves the
+# machine.
+#
+# The check is only right for users whose policies are exactly those, so it is
+# limited to users this app registered or provisioned, which are remembered in a
+# small local file. Anyone else, an admin or a user with managed or group
+# policies, is never checked locally and AWS decides as usual.
+
+IDENTITY_TTL = 3600
+CAPSULE_USERS_PATH = os.environ.get('TIMECAPSULE_USERS', 'timecapsule_users.json')
+
+Identity = namedtuple('Identity', ['arn', 'account', 'user_id', 'username', 'kind', 'resolved_at', 'capsule_user'],
+                      defaults=(False,))
+
+_identities = {}
+_lock = threading.Lock()
+
+# API operations whose IAM action has a different name. The rest match.
+S3_ACTIONS = {
+    'ListObjects': 'ListBucket',
+    'ListObjectsV2': 'ListBucket',
+    'HeadBucket': 'ListBucket',
+    'ListObjectVersions': 'ListBucketVersions',
+    'ListBuckets': 'ListAllMyBuckets',
+    'HeadObject': 'GetObject',
+    'CreateMultipartUpload': 'PutObject',
+    'UploadPart': 'PutObject',
+    'UploadPartCopy': 'PutObject',
+    'CompleteMultipartUpload': 'PutObject',
+    'CopyObject': 'PutObject',
+    'DeleteObjects': 'DeleteObject',
+    'ListParts': 'ListMultipartUploadParts',
+    'ListMultipartUploads': 'ListBucketMultipartUploads',
+    'GetBucketLocation': 'GetBucketLocation',
+}
+# Calls that need no permission at all.
+ALWAYS_ALLOWED = {'sts:GetCallerIdentity'}
+
+
+def parse_arn(arn):
+    # Returns (kind, name): ('user', 'alice') for arn:aws:iam::123:user/team/alice,
+    # ('assumed-role', session name) for roles and ('root', None) for the root user.
+    resource = arn.split(':', 5)[5]
+    if resource == 'root':
+        return 'root', None
+    kind, _, rest = resource.partition('/')
+    return kind, rest.rsplit('/', 1)[-1] or None
+
+
+def caller_identity(session, refresh=False, clock=time.time):
+    credentials = session.get_credentials()
+    access_key = credentials.get_frozen_credentials().access_key if credentials else None
+    now = clock()
+    with _lock:
+        cached = _identities.get(access_key)
+    if cached is not None and not refresh and now - cached.resolved_at < IDENTITY_TTL:
+        return cached
+
+    response = client_manager.get_client('sts', session=session).get_caller_identity()
+    kind, username = parse_arn(response['Arn'])
+    identity = Identity(response['Arn'], response['Account'], response['UserId'], username, kind, now,
+                        kind == 'user' and is_capsule_user(username))
+    with _lock:
+        _identities[access_key] = identity
+    return identity
+
+
+def forget(session):
+    credentials = session.get_credentials()
+    if credentials:
+        with _lock:
+            _identities.pop(credentials.get_frozen_credentials().access_key, None)
+
+
+def registered_identity(username, clock=time.time):
+    # A user registered a moment ago has exactly the capsule policies, so there
+    # is no need to ask STS who they are.
+    return Identity(None, None, None, username, 'user', clock(), True)
+
+
+def capsule_users(path=None):
+    path = path or CAPSULE_USERS_PATH
+    if not os.path.exists(path):
+        return set()
+    with open(path) as source:
+        return set(json.load(source))
+
+
+def _save_capsule_users(users, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as target:
+        json.dump(sorted(users), target)
+    os.replace(tmp_path, path)
+
+
+def is_capsule_user(username, path=None):
+    return username in capsule_users(path)
+
+
+def remember_capsule_user(username, path=None):
+    # Called once a user has exactly the capsule policies and nothing else.
+    path = path or CAPSULE_USERS_PATH
+    with _lock:
+        users = capsule_users(path)
+        if username not in users:
+            _save_capsule_users(users | {username}, path)
+
+
+def forget_capsule_user(username, path=None):
+    path = path or CAPSULE_USERS_PATH
+    with _lock:
+        users = capsule_users(path)
+        if username in users:
+            _save_capsule_users(users - {username}, path)
+
+
+@lru_cache(maxsize=1024)
+def _pattern(text):
+    # IAM wildcards: * is any run of characters, ? is one character.
+    return re.compile(fnmatch.translate(text), re.IGNORECASE)
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+class Statement:
+    def __init__(self, document):
+        self.effect = document.get('Effect', 'Allow')
+        self.actions = [_pattern(action) for action in _as_list(document.get('Action', []))]
+        self.resources = [_pattern(resource) for resource in _as_list(document.get('Resource', '*'))]
+        self.conditions = document.get('Condition', {})
+
+    def matches(self, action, resource):
+        return (any(pattern.match(action) for pattern in self.actions)
+                and any(pattern.match(resource) for pattern in self.resources))
+
+    def condition(self, tags):
+        # True or False when it can be decided here, None when it depends on
+        # resource tags that are not known locally.
+        for operator, checks in self.conditions.items():
+            if operator not in ('StringEquals', 'StringLike'):
+                return None
+            for key, expected in checks.items():
+                if tags is None or not key.lower().startswith(('ec2:resourcetag/', 'aws:resourcetag/')):
+                    return None
+                actual = tags.get(key.split('/', 1)[1])
+                if actual is None:
+                    return False
+                if operator == 'StringEquals' and actual not in _as_list(expected):
+                    return False
+                if operator == 'StringLike' and not any(_pattern(value).match(actual) for value in _as_list(expected)):
+                    return False
+        return True
+
+
+class Permissions:
+    def __init__(self, identity, documents):
+        self.identity = identity
+        self.statements = [Statement(statement) for document in documents
+                           for statement in _as_list(document.get('Statement', []))]
+        self.checked = 0
+        self.denied = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_capsule_user(cls, identity):
+        import IAM_manager
+        return cls(identity, IAM_manager.user_policies(identity.username).values())
+
+    def allows(self, action, resource='*', tags=None):
+        # tags=None means the resource's tags are unknown, {} means it has none.
+        if action in ALWAYS_ALLOWED:
+            return True
+        allowed = False
+        for statement in self.statements:
+            if not statement.matches(action, resource):
+                continue
+            outcome = statement.condition(tags)
+            if statement.effect == 'Deny':
+                if outcome:
+                    return False
+            elif outcome is not False:
+                allowed = True
+        return allowed
+
+    def check(self, service, operation, params):
+        # Returns None when the call may go ahead, otherwise the denial message.
+        with self.lock:
+            self.checked += 1
+        for action, resource, tags in self.requests(service, operation, params):
+            if not self.allows(action, resource, tags):
+                with self.lock:
+                    self.denied += 1
+                return f"{self.identity.username} is not allowed to perform {action} on {resource} (checked locally)."
+        return None
+
+    def requests(self, service, operation, params):
+        # Yields (action, resource ARN, tags) for everything the call touches.
+        if service == 's3':
+            action = f"s3:{S3_ACTIONS.get(operation, operation)}"
+            bucket = params.get('Bucket')
+            if bucket is None:
+                yield action, '*', {}
+                return
+            if operation == 'DeleteObjects':
+                for item in params.get('Delete', {}).get('Objects', []):
+                    yield action, f"arn:aws:s3:::{bucket}/{item['Key']}", {}
+                return
+            key = params.get('Key')
+            yield action, f"arn:aws:s3:::{bucket}/{key}" if key is not None else f"arn:aws:s3:::{bucket}", {}
+            source = params.get('CopySource')
+            if source:
+                if isinstance(source, dict):
+                    source = f"{source['Bucket']}/{source['Key']}"
+                yield 's3:GetObject', f"arn:aws:s3:::{source.split('?', 1)[0].lstrip('/')}", {}
+        elif service == 'ec2':
+            action = f"ec2:{operation}"
+            instance_ids = params.get('InstanceIds')
+            if not instance_ids:
+                # Nothing specific is targeted, so no resource tag can satisfy a tag condition.
+                yield action, '*', {}
+                return
+            account = self.identity.account or '*'
+            for instance_id in instance_ids:
+                yield action, f"arn:aws:ec2:*:{account}:instance/{instance_id}", None
+        else:
+            yield f"{service}:{operation}", '*', {}
+
+    def _collect(self, params=None, model=None, context=None, **kwargs):
+        service = model.service_model.service_id.hyphenize()
+        context['timecapsule_denied'] = self.check(service, model.name, params)
+
+    def _short_circuit(self, model=None, context=None, **kwargs):
+        message = context.get('timecapsule_denied')
+        if message is None:
+            return None
+        http = AWSResponse(url='', status_code=403, headers={}, raw=None)
+        return http, {'Error': {'Code': 'AccessDenied', 'Message': message},
+                      'ResponseMetadata': {'HTTPStatusCode': 403}}
+
+    def install(self, client):
+        # The check needs the call's own parameters, which botocore only shows
+        # before they are serialised, so the verdict is noted in the request
+        # context there and acted on in before-call, where returning a response
+        # skips the HTTP request.
+        events = client.meta.events
+        events.register('before-parameter-build', self._collect, unique_id='timecapsule-permissions')
+        events.register('before-call', self._short_circuit, unique_id='timecapsule-permissions-deny')
+        return client
@@ -0,0 +1,1685 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import sys
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+
+import boto3
+import botocore
+from botocore.config import Config
+from botocore.credentials import ReadOnlyCredentials
+from botocore.awsrequest import AWSResponse
+from botocore.stub import Stubber
+
+import async_manager
+import auth_manager
+import cache_manager
+import cli
+import client_manager
+import copy_manager
+import EC2_manager
+import IAM_manager
+import S3_manager
+import job_manager
+import delete_manager
+import index_manager
+import pack_manager
+import retry_manager
+import presign_manager
+import provision_manager
+import schedule_manager
+import trace_manager
+import transfer_manager
+from app_context import AppContext
+
+# Micro-benchmarks for the managers. Everything runs against botocore's Stubber,
+# moto or in-process stand-ins so no AWS account is needed.
+# Usage: python benchmarks.py [name ...] [--scale small|large] [--save-baseline]
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace('bench_', '')] = func
+    return func
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name, **values):
+    parts = []
+    for key, value in values.items():
+        if isinstance(value, float):
+            parts.append(f"{key}={value:.4f}")
+        else:
+            parts.append(f"{key}={value}")
+    print(f"{name}: " + " ".join(parts))
+
+
+LIST_BUCKETS_RESPONSE = {'Buckets': [], 'Owner': {'ID': 'owner'}}
+
+
+@benchmark
+def bench_client_registry(repeat=50):
+    def per_action_client():
+        s3 = boto3.client('s3')
+        with Stubber(s3) as stubber:
+            stubber.add_response('list_buckets', LIST_BUCKETS_RESPONSE)
+            s3.list_buckets()
+
+    client_manager.clear_clients()
+    s3 = client_manager.get_client('s3')
+    stubber = Stubber(s3)
+    stubber.activate()
+
+    def registry_client():
+        stubber.add_response('list_buckets', LIST_BUCKETS_RESPONSE)
+        client_manager.get_client('s3').list_buckets()
+
+    without = timed(per_action_client, repeat)
+    with_registry = timed(registry_client, repeat)
+    stubber.deactivate()
+    report('client_registry', per_action_ms=without * 1000, registry_ms=with_registry * 1000,
+           speedup=without / with_registry)
+
+
+@benchmark
+def bench_credential_resolution(repeat=50):
+    # Before: every action built a client off a fresh default session, walking the
+    # credential provider chain again. After: the context resolves it once per login.
+    def per_action_chain():
+        boto3.session.Session().get_credentials().get_frozen_credentials()
+
+    ctx = AppContext(boto3.session.Session(), 'bench', settings={})
+    ctx.client('s3')
+
+    def per_action_context():
+        ctx.client('s3')
+
+    before = timed(per_action_chain, repeat)
+    after = timed(per_action_context, repeat)
+    report('credential_resolution', per_action_ms=before * 1000,
+           once_per_login_ms=ctx.timings['credential_resolution'] * 1000, context_action_ms=after * 1000)
+
+
+STARTUP_BUDGET_MS = 300
+FIRST_PROMPT = b'Which number would you like to select'
+
+
+def import_breakdown(module='main', top=8):
+    # python -X importtime writes "self | cumulative | name" lines to stderr.
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr.decode()
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def time_to_first_prompt():
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    seen = b''
+    while FIRST_PROMPT not in seen:
+        chunk = process.stdout.read1(4096)
+        if not chunk:
+            break
+        seen += chunk
+    elapsed = time.perf_counter() - start
+    process.communicate(b'3\n', timeout=10)
+    return elapsed
+
+
+@benchmark
+def bench_startup(rounds=5):
+    for cumulative_ms, name in import_breakdown():
+        report('startup_imports', module=name, cumulative_ms=cumulative_ms)
+
+    runs = sorted(time_to_first_prompt() for _ in range(rounds))
+    median_ms = runs[len(runs) // 2] * 1000
+    within = median_ms <= STARTUP_BUDGET_MS
+    report('startup', first_prompt_ms=median_ms, budget_ms=STARTUP_BUDGET_MS, within_budget=within)
+    # A startup regression fails the run, see main().
+    return within
+
+
+class StandInContext:
+    # Minimal AppContext replacement that hands out pre-built stand-in clients.
+    def __init__(self, **clients):
+        self.clients = clients
+        self.region = 'us-east-1'
+        self.username = 'bench'
+        self.settings = {}
+        self.cache = cache_manager.MetadataCache(enabled=False)
+
+    def client(self, service, **config_options):
+        return self.clients[service]
+
+
+class ListingStandIn:
+    # Generates list_objects_v2 pages lazily, like a bucket holding key_count keys.
+    def __init__(self, key_count):
+        self.key_count = key_count
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, PaginationConfig=None, Prefix='', **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+        for first in range(0, self.key_count, page_size):
+            last = min(first + page_size, self.key_count)
+            # Sizes and dates vary so index queries have something to filter on.
+            yield {'Contents': [
+                {'Key': f"{Prefix}capsule/{n % 100:02d}/{n:08d}.jpg", 'Size': 1024 * (n % 4096 + 1),
+                 'ETag': '"etag"', 'LastModified': datetime.fromtimestamp(start + n * 60, timezone.utc),
+                 'StorageClass': 'STANDARD'}
+                for n in range(first, last)
+            ]}
+
+
+@benchmark
+def bench_object_listing(key_count=500_000):
+    ctx = StandInContext(s3=ListingStandIn(key_count))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = S3_manager.iter_objects(ctx, 'bench-bucket')
+    next(records)
+    first_row = time.perf_counter() - start
+    count = 1 + sum(1 for _ in records)
+    streamed = time.perf_counter() - start
+    _, streamed_peak = tracemalloc.get_traced_memory()
+
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    materialized = list(S3_manager.iter_objects(ctx, 'bench-bucket'))
+    loaded = time.perf_counter() - start
+    _, loaded_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del materialized
+
+    report('object_listing', keys=count, first_row_ms=first_row * 1000, stream_s=streamed,
+           stream_peak_mb=streamed_peak / 2**20, full_list_s=loaded, full_list_peak_mb=loaded_peak / 2**20,
+           peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+class UploadStandIn:
+    # Local S3 stand-in: each request costs a fixed latency plus the time to push
+    # its body through a single connection of the given bandwidth.
+    def __init__(self, latency=0.01, bandwidth=100 * transfer_manager.MB):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.received = 0
+
+    def _transfer(self, size):
+        time.sleep(self.latency + size / self.bandwidth)
+        with self.lock:
+            self.received += size
+
+    def put_object(self, Bucket, Key, Body):
+        self._transfer(len(Body.read()))
+        return {'ETag': '"etag"'}
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._transfer(len(Body))
+        return {'ETag': f'"part-{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **kwargs):
+        return iter([{}])
+
+
+def make_file(directory, size):
+    path = os.path.join(directory, 'capsule.bin')
+    with open(path, 'wb') as data:
+        data.write(os.urandom(size))
+    return path
+
+
+@benchmark
+def bench_multipart_upload(file_mb=128):
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_file(directory, file_mb * transfer_manager.MB)
+        for part_mb in (8, 16, 32):
+            for concurrency in (1, 4, 8, 16):
+                ctx = StandInContext(s3=UploadStandIn())
+                ctx.settings = {'manifest_dir': directory, 'multipart_threshold': 8 * transfer_manager.MB}
+                start = time.perf_counter()
+                transfer_manager.upload(ctx, path, 'bench-bucket', 'capsule.bin',
+                                        part_size=part_mb * transfer_manager.MB, upload_concurrency=concurrency)
+                elapsed = time.perf_counter() - start
+                report('multipart_upload', part_mb=part_mb, concurrency=concurrency, mb_per_s=file_mb / elapsed)
+
+
+@benchmark
+def bench_directory_sync(file_count=10_000, workers=32):
+    with tempfile.TemporaryDirectory() as directory:
+        for n in range(file_count):
+            folder = os.path.join(directory, f"{n % 100:02d}")
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, f"{n}.txt"), 'wb') as data:
+                data.write(b'capsule' * 64)
+
+        ctx = StandInContext(s3=UploadStandIn(latency=0.002))
+        start = time.perf_counter()
+        for path, key in transfer_manager.walk_directory(directory):
+            transfer_manager.upload(ctx, path, 'bench-bucket', key)
+        loop = time.perf_counter() - start
+
+        ctx = StandInContext(s3=UploadStandIn(latency=0.002))
+        result = transfer_manager.sync_directory(ctx, directory, 'bench-bucket', workers=workers)
+
+        report('directory_sync', files=file_count, loop_s=loop, sync_s=result['elapsed'],
+               files_per_s=result['files_per_s'], mb_per_s=result['bytes_per_s'] / transfer_manager.MB,
+               speedup=loop / result['elapsed'])
+
+
+class BodyStandIn:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, chunk_size):
+        for offset in range(0, len(self.data), chunk_size):
+            yield self.data[offset:offset + chunk_size]
+
+    def read(self):
+        return self.data
+
+
+class DownloadStandIn(UploadStandIn):
+    # Serves one shared payload for every key, with the same latency/bandwidth model.
+    def __init__(self, size, key_count=1, **kwargs):
+        super().__init__(**kwargs)
+        self.payload = os.urandom(size)
+        self.etag = f'"{hashlib.md5(self.payload).hexdigest()}"'
+        self.key_count = key_count
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        return {'ContentLength': len(self.payload), 'ETag': self.etag}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        first, last = (int(value) for value in Range.split('=')[1].split('-'))
+        data = self.payload[first:last + 1]
+        self._transfer(len(data))
+        return {'Body': BodyStandIn(data)}
+
+    def paginate(self, **kwargs):
+        return iter([{'Contents': [{'Key': f"capsule/{n}.jpg", 'Size': len(self.payload)}
+                                   for n in range(self.key_count)]}])
+
+
+@benchmark
+def bench_ranged_download(large_mb=128, small_count=2000):
+    mb = transfer_manager.MB
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, 'capsule.bin')
+        for concurrency in (1, 4, 8, 16):
+            ctx = StandInContext(s3=DownloadStandIn(large_mb * mb))
+            start = time.perf_counter()
+            transfer_manager.download(ctx, 'bench-bucket', 'capsule.bin', target, download_concurrency=concurrency,
+                                      part_size=8 * mb, multipart_threshold=8 * mb)
+            elapsed = time.perf_counter() - start
+            report('ranged_download', object_mb=large_mb, concurrency=concurrency, mb_per_s=large_mb / elapsed)
+
+        for workers in (1, 16, 64):
+            ctx = StandInContext(s3=DownloadStandIn(16 * 1024, key_count=small_count, latency=0.002))
+            result = transfer_manager.download_prefix(ctx, 'bench-bucket', 'capsule/',
+                                                      os.path.join(directory, f"small-{workers}"), workers=workers)
+            report('ranged_download', small_objects=small_count, workers=workers,
+                   files_per_s=result['files_per_s'], mb_per_s=result['bytes_per_s'] / mb)
+
+
+class DeleteStandIn(ListingStandIn):
+    # Lists key_count keys and answers delete_objects after a fixed latency,
+    # failing a small share of keys with SlowDown so the retry path is exercised.
+    def __init__(self, key_count, latency=0.05, failure_rate=0.01):
+        super().__init__(key_count)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(7)
+
+    def delete_objects(self, Bucket, Delete):
+        time.sleep(self.latency)
+        errors = [{'Key': target['Key'], 'Code': 'SlowDown'} for target in Delete['Objects']
+                  if self.random.random() < self.failure_rate]
+        return {'Errors': errors}
+
+
+@benchmark
+def bench_bulk_delete(key_count=200_000):
+    for workers in (1, 8, 32):
+        ctx = StandInContext(s3=DeleteStandIn(key_count))
+        result = delete_manager.delete_prefix(ctx, 'bench-bucket', '', workers=workers)
+        report('bulk_delete', objects=result['deleted'], workers=workers, seconds=result['elapsed'],
+               objects_per_s=result['objects_per_s'], failed=len(result['failed']))
+
+
+def moto_or_skip(name):
+    try:
+        from moto import mock_aws
+    except ImportError:
+        print(f"{name}: skipped, moto is not installed")
+        return None
+    return isolated(mock_aws())
+
+
+@contextlib.contextmanager
+def isolated(mock):
+    # Clients and the default session made before the mock started would still
+    # talk to AWS, with whatever credentials the environment has, so they are
+    # dropped on the way in and the mocked ones on the way out.
+    client_manager.reset()
+    try:
+        with mock:
+            yield mock
+    finally:
+        client_manager.reset()
+
+
+def seed_instances(ec2, count, tagged_share=0.5):
+    tagged = int(count * tagged_share)
+    for first in range(0, count, 500):
+        batch = min(500, count - first)
+        tags = [{'Key': 'Name', 'Value': f"capsule-{first}"}]
+        if first < tagged:
+            tags.append({'Key': 'Project', 'Value': EC2_manager.PROJECT_TAG})
+        ec2.run_instances(ImageId='ami-12345678', MinCount=batch, MaxCount=batch, InstanceType='t2.micro',
+                          TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}])
+
+
+@benchmark
+def bench_instance_listing(instance_count=5000):
+    mock = moto_or_skip('instance_listing')
+    if mock is None:
+        return
+    with mock:
+        ctx = AppContext(boto3.session.Session(), 'bench', settings={})
+        ec2 = ctx.client('ec2')
+        seed_instances(ec2, instance_count)
+
+        def unfiltered_scan():
+            rows = []
+            for reservation in ec2.describe_instances()['Reservations']:
+                for instance in reservation['Instances']:
+                    name = 'N/A'
+                    for tag in instance.get('Tags', []):
+                        if tag['Key'] == 'Name':
+                            name = tag['Value']
+                    rows.append({'InstanceId': instance['InstanceId'], 'State': instance['State']['Name'], 'Name': name})
+            return rows
+
+        start = time.perf_counter()
+        rows = unfiltered_scan()
+        scan = time.perf_counter() - start
+
+        start = time.perf_counter()
+        table = EC2_manager.query_instances(ctx, EC2_manager.instance_filters())
+        query = time.perf_counter() - start
+
+        target = table[-1].instance_id
+        linear = timed(lambda: next(row for row in rows if row['InstanceId'] == target), 200)
+        indexed = timed(lambda: table.get(target), 200)
+
+        report('instance_listing', instances=instance_count, unfiltered_rows=len(rows), unfiltered_s=scan,
+               filtered_rows=len(table), filtered_s=query, linear_lookup_us=linear * 1e6, indexed_lookup_us=indexed * 1e6)
+
+
+class FleetStandIn:
+    # Instances reach their target state transition seconds after the request;
+    # every API call costs latency seconds.
+    def __init__(self, instance_ids, transition=0.2, latency=0.005):
+        self.transition = transition
+        self.latency = latency
+        self.changed = {instance_id: (0.0, 'stopped') for instance_id in instance_ids}
+        self.calls = 0
+
+    def _request(self, instance_ids, state):
+        time.sleep(self.latency)
+        self.calls += 1
+        for instance_id in instance_ids:
+            self.changed[instance_id] = (time.perf_counter(), state)
+
+    def start_instances(self, InstanceIds):
+        self._request(InstanceIds, 'running')
+
+    def stop_instances(self, InstanceIds):
+        self._request(InstanceIds, 'stopped')
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, InstanceIds):
+        time.sleep(self.latency)
+        self.calls += 1
+        now = time.perf_counter()
+        instances = []
+        for instance_id in InstanceIds:
+            changed, state = self.changed[instance_id]
+            instances.append([instance_id, state if now - changed >= self.transition else 'pending'])
+        return FleetPages(instances)
+
+
+class FleetPages:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def search(self, expression):
+        return iter(self.rows)
+
+
+@benchmark
+def bench_fleet_actions(instance_count=50, delay=0.05):
+    instance_ids = [f"i-{n:017x}" for n in range(instance_count)]
+
+    stand_in = FleetStandIn(instance_ids)
+    ctx = StandInContext(ec2=stand_in)
+    start = time.perf_counter()
+    for instance_id in instance_ids:
+        EC2_manager.fleet_action(ctx, 'start', [instance_id], delay=delay)
+    sequential = time.perf_counter() - start
+    sequential_calls = stand_in.calls
+
+    stand_in = FleetStandIn(instance_ids)
+    ctx = StandInContext(ec2=stand_in)
+    start = time.perf_counter()
+    results = EC2_manager.fleet_action(ctx, 'start', instance_ids, delay=delay)
+    fleet = time.perf_counter() - start
+
+    report('fleet_actions', instances=instance_count, sequential_s=sequential, sequential_calls=sequential_calls,
+           fleet_s=fleet, fleet_calls=stand_in.calls, succeeded=sum(r['ok'] for r in results.values()),
+           speedup=sequential / fleet)
+
+
+class FakeClock:
+    # Stands in for job_manager.RealClock, sleeping only advances the counter.
+    def __init__(self):
+        self.current = 0.0
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.current += seconds
+
+
+class SimulatedFleet:
+    # Each instance reaches its target a fixed number of simulated seconds after
+    # it was requested, on the shared fake clock.
+    def __init__(self, clock, ready_after):
+        self.clock = clock
+        self.ready_after = ready_after
+        self.calls = 0
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, InstanceIds):
+        self.calls += 1
+        now = self.clock.now()
+        return FleetPages([[instance_id, 'running' if now >= self.ready_after[instance_id] else 'pending']
+                           for instance_id in InstanceIds])
+
+
+@benchmark
+def bench_job_poller(job_count=50, instances_per_job=10):
+    rng = random.Random(11)
+    clock = FakeClock()
+    ready_after = {}
+    batches = []
+    for job in range(job_count):
+        ids = [f"i-{job:04d}{n:013x}" for n in range(instances_per_job)]
+        ready_after.update({instance_id: rng.uniform(20, 120) for instance_id in ids})
+        batches.append(ids)
+
+    # One default waiter per job, polling every 15 s, one after the other.
+    fleet = SimulatedFleet(clock, ready_after)
+    for ids in batches:
+        EC2_manager.wait_for_fleet(fleet, ids, 'running', delay=15, sleep=clock.sleep)
+    waiter_seconds, waiter_calls = clock.now(), fleet.calls
+
+    clock.current = 0.0
+    fleet = SimulatedFleet(clock, ready_after)
+    manager = job_manager.JobManager(StandInContext(ec2=fleet), clock=clock, start_thread=False)
+    jobs = [manager.submit('start', ids, 'running', notify=False) for ids in batches]
+    while manager.poller.active_jobs():
+        manager.poller.run_once()
+    last_done = max(job.finished for job in jobs)
+    all_ok = all(result['ok'] for job in jobs for result in job.snapshot().values())
+
+    report('job_poller', jobs=job_count, instances=len(ready_after), sequential_waiters_s=waiter_seconds,
+           waiter_describe_calls=waiter_calls, shared_poller_s=last_done, poller_describe_calls=fleet.calls,
+           all_ok=all_ok)
+    return all_ok
+
+
+class LaunchSimulator(SimulatedFleet):
+    # Boots each launched instance after a random 20-90 simulated seconds.
+    def __init__(self, clock, seed=5):
+        super().__init__(clock, {})
+        self.rng = random.Random(seed)
+        self.launched = 0
+
+    def run_instances(self, MaxCount, **kwargs):
+        self.calls += 1
+        instances = []
+        for _ in range(MaxCount):
+            self.launched += 1
+            instance_id = f"i-{self.launched:017x}"
+            self.ready_after[instance_id] = self.clock.now() + self.rng.uniform(20, 90)
+            instances.append({'InstanceId': instance_id})
+        return {'Instances': instances}
+
+    def create_tags(self, **kwargs):
+        self.calls += 1
+
+
+@benchmark
+def bench_bulk_launch(count=50):
+    clock = FakeClock()
+    fleet = LaunchSimulator(clock)
+    ctx = StandInContext(ec2=fleet)
+    ctx.jobs = job_manager.JobManager(ctx, clock=clock, start_thread=False)
+
+    # Old flow: one launch and one blocking wait per instance.
+    for number in range(count):
+        job = EC2_manager.provision_instances(ctx, f"worker-{number}", 1, notify=False)
+        while not job.done:
+            ctx.jobs.poller.run_once()
+    sequential_s = clock.now()
+
+    clock.current = 0.0
+    job = EC2_manager.provision_instances(ctx, 'worker', count, notify=False)
+    while not job.done:
+        ctx.jobs.poller.run_once()
+    latencies = EC2_manager.launch_latencies(job)
+
+    report('bulk_launch', instances=count, sequential_s=sequential_s, batch_s=job.finished,
+           p50_s=latencies['p50'], p90_s=latencies['p90'], p99_s=latencies['p99'])
+
+
+class NavigationStandIn(ListingStandIn):
+    # Every listing call costs latency seconds, like a round trip to S3.
+    def __init__(self, key_count, latency=0.03):
+        super().__init__(key_count)
+        self.latency = latency
+        self.calls = 0
+
+    def list_buckets(self):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'Buckets': [{'Name': f"timecapsule-{n}"} for n in range(20)]}
+
+    def paginate(self, **kwargs):
+        for page in super().paginate(**kwargs):
+            self.calls += 1
+            time.sleep(self.latency)
+            yield page
+
+
+@benchmark
+def bench_metadata_cache(rounds=20, key_count=5000):
+    def navigate(ctx):
+        # List buckets, open one, page through the first few screens, go back.
+        S3_manager.fetch_buckets(ctx)
+        S3_manager.fetch_buckets(ctx)
+        records = S3_manager.iter_objects(ctx, 'timecapsule-1')
+        for _ in range(3 * S3_manager.PAGE_SIZE):
+            next(records)
+
+    for cached in (False, True):
+        stand_in = NavigationStandIn(key_count)
+        ctx = StandInContext(s3=stand_in)
+        ctx.cache = cache_manager.MetadataCache(enabled=cached)
+        elapsed = timed(lambda: navigate(ctx), rounds)
+        stats = ctx.cache.stats()
+        report('metadata_cache', cached=cached, navigation_ms=elapsed * 1000, api_calls=stand_in.calls,
+               hits=stats['hits'], misses=stats['misses'])
+
+
+class ChunkStoreStandIn(UploadStandIn):
+    # In-memory bucket for the pack pipeline, with the same latency/bandwidth model.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._transfer(len(Body))
+        self.objects[Key] = Body
+        return {'ETag': '"etag"'}
+
+    def get_object(self, Bucket, Key):
+        data = self.objects[Key]
+        self._transfer(len(data))
+        return {'Body': BodyStandIn(data)}
+
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        return iter([{'Contents': [{'Key': key, 'Size': len(data)} for key, data in self.objects.items()
+                                   if key.startswith(Prefix)]}])
+
+
+def synthetic_corpus(directory, base_mb, rng):
+    # Photos (incompressible), documents (compressible), exact copies of both in
+    # other capsules, and edited copies with a few bytes inserted near the start.
+    mb = transfer_manager.MB
+    words = [rng.randbytes(rng.randint(3, 9)).hex().encode() for _ in range(2000)]
+    originals = {
+        'photo.jpg': rng.randbytes(base_mb * mb),
+        'letter.txt': b' '.join(rng.choice(words) for _ in range(base_mb * mb // 12))[:base_mb * mb],
+    }
+    files = []
+    for capsule in range(3):
+        for name, data in originals.items():
+            if capsule == 2:
+                data = data[:1000] + b'edited' + data[1000:]
+            path = os.path.join(directory, f"{capsule}-{name}")
+            with open(path, 'wb') as target:
+                target.write(data)
+            files.append(path)
+    return files
+
+
+@benchmark
+def bench_capsule_packing(base_mb=8):
+    with tempfile.TemporaryDirectory() as directory:
+        files = synthetic_corpus(directory, base_mb, random.Random(14))
+        stand_in = ChunkStoreStandIn()
+        ctx = StandInContext(s3=stand_in)
+        total = sum(os.path.getsize(path) for path in files)
+
+        start = time.perf_counter()
+        known = pack_manager.known_chunks(ctx, 'bench-bucket', pack_manager.pack_settings(ctx))
+        results = [pack_manager.pack_file(ctx, path, 'bench-bucket', os.path.basename(path), known=known)
+                   for path in files]
+        packed = time.perf_counter() - start
+
+        new_bytes = sum(result['NewBytes'] for result in results)
+        stored = sum(result['StoredBytes'] for result in results)
+
+        start = time.perf_counter()
+        out_path = os.path.join(directory, 'restored')
+        for path in files:
+            pack_manager.unpack(ctx, 'bench-bucket', pack_manager.manifest_key_for(os.path.basename(path)), out_path)
+        unpacked = time.perf_counter() - start
+
+        mb = transfer_manager.MB
+        report('capsule_packing', codec=pack_manager.pack_settings(ctx)['pack_codec'], corpus_mb=total / mb,
+               dedup_ratio=total / new_bytes, compression_ratio=new_bytes / stored, stored_mb=stored / mb,
+               pack_mb_s=total / mb / packed, unpack_mb_s=total / mb / unpacked)
+
+
+@benchmark
+def bench_capsule_scheduler(capsule_count=1_000_000, release_count=100_000, rounds=1000):
+    rng = random.Random(15)
+    horizon = 10 * 365 * 24 * 3600
+    capsules = [('bench-bucket', f"capsule/{n:08d}.jpg", rng.uniform(0, horizon)) for n in range(capsule_count)]
+    clock = FakeClock()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'schedule.db')
+        ctx = StandInContext()
+        scheduler = schedule_manager.CapsuleScheduler(ctx, path=path, clock=clock, release=lambda bucket, key: key)
+        start = time.perf_counter()
+        scheduler.schedule_many(capsules)
+        scheduled = time.perf_counter() - start
+        scheduler.close()
+
+        start = time.perf_counter()
+        scheduler = schedule_manager.CapsuleScheduler(ctx, path=path, clock=clock, release=lambda bucket, key: key)
+        reloaded = time.perf_counter() - start
+        next_due_us = timed(scheduler.next_due, rounds) * 1_000_000
+        push_us = timed(lambda: scheduler.schedule('bench-bucket', 'late.jpg', rng.uniform(0, horizon)), rounds) * 1_000_000
+
+        # Move the fake clock to the point where release_count capsules are due.
+        clock.current = sorted(unlock_at for _, _, unlock_at in capsules)[release_count - 1]
+        start = time.perf_counter()
+        result = scheduler.run_once()
+        released = time.perf_counter() - start
+        scheduler.close()
+
+    report('capsule_scheduler', capsules=capsule_count, schedule_s=scheduled, restart_s=reloaded,
+           next_due_us=next_due_us, schedule_one_us=push_us, released=result['released'],
+           releases_per_s=result['released'] / released,
+           peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+@benchmark
+def bench_presigned_urls(key_count=20_000):
+    ctx = StandInContext(s3=ListingStandIn(key_count))
+    ctx.credentials = ReadOnlyCredentials('AKIDBENCH', 'bench-secret', None)
+    s3 = boto3.client('s3', region_name='us-east-1', config=Config(signature_version='s3v4'))
+    keys = [record.key for record in S3_manager.iter_objects(ctx, 'bench-bucket')]
+
+    sample = keys[:2000]
+    start = time.perf_counter()
+    for key in sample:
+        s3.generate_presigned_url('get_object', Params={'Bucket': 'bench-bucket', 'Key': key}, ExpiresIn=3600)
+    botocore_rate = len(sample) / (time.perf_counter() - start)
+
+    presign_manager.signing_key.cache_clear()
+    start = time.perf_counter()
+    for key in sample:
+        presign_manager.presign_url(ctx, 'bench-bucket', key)
+    single_rate = len(sample) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in presign_manager.presign_prefix(ctx, 'bench-bucket', ''))
+    batch_elapsed = time.perf_counter() - start
+
+    cache = presign_manager.signing_key.cache_info()
+    report('presigned_urls', botocore_urls_per_s=botocore_rate, single_urls_per_s=single_rate,
+           batch_urls_per_s=count / batch_elapsed, batch_ms=batch_elapsed * 1000, urls=count,
+           key_derivations=cache.misses, key_cache_hits=cache.hits)
+
+
+class RawBody:
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, **kwargs):
+        yield self.data
+
+
+class ThrottlingEndpoint:
+    # Answers every request locally and throttles with 503 SlowDown whenever
+    # requests arrive faster than server_rate, like S3 does per prefix.
+    def __init__(self, server_rate):
+        self.rate = server_rate
+        self.burst = server_rate / 10
+        self.tokens = self.burst
+        self.updated = time.perf_counter()
+        self.served = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, request, **kwargs):
+        with self.lock:
+            now = time.perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            allowed = self.tokens >= 1
+            if allowed:
+                self.tokens -= 1
+                self.served += 1
+            else:
+                self.throttled += 1
+        if allowed:
+            return AWSResponse(request.url, 200, {}, RawBody(b'<ListBucketResult></ListBucketResult>'))
+        return AWSResponse(request.url, 503, {}, RawBody(
+            b'<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'))
+
+
+@benchmark
+def bench_adaptive_retry(server_rate=200, threads=16, seconds=3.0):
+    for client_limit in (None, server_rate * 0.9, server_rate * 2):
+        client_manager.clear_clients()
+        retry_manager.configure(rate_limits={'s3': client_limit})
+        retry_manager.reset_metrics()
+        s3 = client_manager.get_client('s3', region=None)
+        endpoint = ThrottlingEndpoint(server_rate)
+        s3.meta.events.register('before-send.s3', endpoint)
+
+        done = {'calls': 0, 'failed': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def hammer():
+            while time.perf_counter() < deadline:
+                try:
+                    s3.list_objects_v2(Bucket='bench-bucket')
+                    outcome = 'calls'
+                except botocore.exceptions.ClientError:
+                    outcome = 'failed'
+                with lock:
+                    done[outcome] += 1
+
+        workers = [threading.Thread(target=hammer) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        counters = retry_manager.metrics()['s3']
+        report('adaptive_retry', client_limit=client_limit, server_rate=server_rate,
+               calls_per_s=done['calls'] / elapsed, failed=done['failed'], throttled=endpoint.throttled,
+               retries=counters['retries'], backoff_s=counters['backoff_seconds'],
+               limited_s=counters['limited_seconds'])
+    client_manager.clear_clients()
+    retry_manager.configure(rate_limits={})
+
+
+def scripted_job(paths, bucket_name, op_count):
+    # One bucket, then uploads that each get listed or deleted afterwards.
+    operations = [{'id': 'bucket', 'op': 's3.mb', 'args': {'bucket': bucket_name}}]
+    uploads = op_count // 2
+    for n in range(uploads):
+        operations.append({'id': f"up-{n}", 'op': 's3.cp', 'after': ['bucket'],
+                           'args': {'source': paths[n], 'destination': f"s3://{bucket_name}/{n % 10}/"}})
+    for n in range(op_count - 1 - uploads):
+        if n % 2:
+            operations.append({'id': f"rm-{n}", 'op': 's3.rm', 'after': [f"up-{n}"],
+                               'args': {'target': f"s3://{bucket_name}/{n % 10}/{os.path.basename(paths[n])}"}})
+        else:
+            operations.append({'id': f"ls-{n}", 'op': 's3.ls', 'after': [f"up-{n}"],
+                               'args': {'bucket': bucket_name, 'prefix': f"{n % 10}/"}})
+    return operations
+
+
+@benchmark
+def bench_batch_cli(op_count=1000):
+    mock = moto_or_skip('batch_cli')
+    if mock is None:
+        return
+    with mock, tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for n in range(op_count // 2):
+            paths.append(os.path.join(directory, f"capsule-{n}.txt"))
+            with open(paths[-1], 'wb') as data:
+                data.write(os.urandom(1024))
+
+        ctx = AppContext(boto3.session.Session(), 'bench', settings={'cache_enabled': False})
+        for workers in (1, 16):
+            operations = scripted_job(paths, f"bench-batch-{workers}", op_count)
+            start = time.perf_counter()
+            cli.plan(operations)
+            planned = time.perf_counter() - start
+
+            lines = []
+            summary = cli.run_batch(ctx, operations, lambda **fields: lines.append(fields), workers)
+            report('batch_cli', workers=workers, operations=summary['operations'], failed=summary['failed'],
+                   plan_ms=planned * 1000, seconds=summary['elapsed'], ops_per_s=summary['ops_per_s'],
+                   json_lines=len(lines))
+
+
+@benchmark
+def bench_key_index(key_count=1_000_000, rounds=20):
+    ctx = StandInContext(s3=ListingStandIn(key_count))
+    with tempfile.TemporaryDirectory() as tmp:
+        ctx.settings['index_path'] = os.path.join(tmp, 'index.db')
+        ctx.index = index_manager.KeyIndex(ctx.settings['index_path'])
+
+        result = index_manager.sync_from_listing(ctx, 'bench-bucket')
+        report('key_index', phase='ingest', objects=result['objects'], seconds=result['elapsed'],
+               objects_per_s=result['objects_per_s'], db_mb=os.path.getsize(ctx.settings['index_path']) / transfer_manager.MB)
+
+        since = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        queries = {
+            'prefix': lambda: list(ctx.index.query('bench-bucket', 'capsule/42/')),
+            'size': lambda: list(ctx.index.query('bench-bucket', min_size=4000 * 1024, limit=1000)),
+            'modified': lambda: list(ctx.index.query('bench-bucket', modified_after=since, limit=1000)),
+        }
+        for name, query in queries.items():
+            elapsed = timed(query, rounds)
+            report('key_index', phase='query', query=name, ms=elapsed * 1000, rows=len(query()))
+        ctx.index.close()
+
+
+@contextlib.contextmanager
+def capsule_user_registry():
+    # Keeps the users benchmarks create out of the real capsule user registry.
+    previous = auth_manager.CAPSULE_USERS_PATH
+    with tempfile.TemporaryDirectory() as directory:
+        auth_manager.CAPSULE_USERS_PATH = os.path.join(directory, 'capsule_users.json')
+        try:
+            yield auth_manager.CAPSULE_USERS_PATH
+        finally:
+            auth_manager.CAPSULE_USERS_PATH = previous
+
+
+@benchmark
+def bench_bulk_provisioning(user_count=500):
+    mock = moto_or_skip('bulk_provisioning')
+    if mock is None:
+        return
+    # moto answers instantly, so the IAM limiter is lifted to measure the
+    # pipeline itself. Against AWS the 10 requests/s default is the ceiling.
+    retry_manager.configure(rate_limits={'iam': None})
+    try:
+        with mock, tempfile.TemporaryDirectory() as tmp, capsule_user_registry():
+            ctx = AppContext(boto3.session.Session(), 'bench', settings={'cache_enabled': False})
+            for workers in (1, 16):
+                journal = os.path.join(tmp, f"journal-{workers}.jsonl")
+                users = [f"bench-{workers}-{n}" for n in range(user_count)]
+                retry_manager.reset_metrics()
+                result = provision_manager.provision_users(ctx, users, provision_journal=journal,
+                                                           provision_workers=workers)
+                calls = retry_manager.metrics()['iam']['attempts']
+                report('bulk_provisioning', phase='provision', workers=workers, users=result['users'],
+                       failed=result['failed'], calls=calls, seconds=result['elapsed'],
+                       users_per_s=result['users_per_s'], at_default_limit_s=calls / 10)
+
+                # A rerun with the same journal has nothing left to do.
+                retry_manager.reset_metrics()
+                rerun = provision_manager.provision_users(ctx, users, provision_journal=journal,
+                                                          provision_workers=workers)
+                report('bulk_provisioning', phase='resume', workers=workers, users=rerun['users'],
+                       calls=retry_manager.metrics().get('iam', {}).get('attempts', 0), seconds=rerun['elapsed'])
+
+                result = provision_manager.teardown_users(ctx, provision_journal=journal, provision_workers=workers)
+                report('bulk_provisioning', phase='teardown', workers=workers, users=result['users'],
+                       failed=result['failed'], seconds=result['elapsed'], users_per_s=result['users_per_s'])
+    finally:
+        retry_manager.configure(rate_limits={})
+
+
+def capsule_session(ctx, other_bucket, uploads):
+    # One menu session: the calls a capsule user's choices turn into, including
+    # the ones their policies deny (other buckets, listing all buckets, EC2
+    # calls without an Owner-tagged instance).
+    own_bucket = f"timecapsule-{ctx.username}"
+    steps = [
+        lambda s3, ec2: s3.list_buckets(),
+        lambda s3, ec2: s3.create_bucket(Bucket=own_bucket),
+        lambda s3, ec2: s3.list_objects_v2(Bucket=own_bucket),
+        lambda s3, ec2: s3.list_objects_v2(Bucket=other_bucket),
+        lambda s3, ec2: s3.head_object(Bucket=other_bucket, Key='capsule.txt'),
+        lambda s3, ec2: ec2.describe_instances(),
+        lambda s3, ec2: ec2.run_instances(ImageId='ami-12345678', MinCount=1, MaxCount=1),
+    ]
+    steps += [lambda s3, ec2, n=n: s3.put_object(Bucket=own_bucket, Key=f"capsule-{n}.txt", Body=b'x')
+              for n in range(uploads)]
+    denied = 0
+    for step in steps:
+        try:
+            step(ctx.client('s3'), ctx.client('ec2'))
+        except botocore.exceptions.ClientError as e:
+            denied += e.response['Error']['Code'] == 'AccessDenied'
+    return len(steps), denied
+
+
+def wire_calls():
+    return sum(counters['attempts'] for counters in retry_manager.metrics().values())
+
+
+@benchmark
+def bench_identity_cache(sessions=10, uploads=10, checks=100_000):
+    mock = moto_or_skip('identity_cache')
+    if mock is None:
+        return
+    with mock, capsule_user_registry():
+        admin = boto3.session.Session()
+        admin.client('s3').create_bucket(Bucket='timecapsule-someone-else')
+        IAM_manager.create_user('alice')
+        access_key, secret_key = IAM_manager.create_access_keys('alice')
+        IAM_manager.attach_policies('alice')
+        settings = {'cache_enabled': False, 'local_permission_checks': True}
+
+        # Before: every login asks STS, the username is typed in and every
+        # call goes to AWS to find out whether it is allowed.
+        retry_manager.reset_metrics()
+        for _ in range(sessions):
+            session = IAM_manager.create_user_session(access_key, secret_key)
+            auth_manager.caller_identity(session, refresh=True)
+            capsule_session(AppContext(session, 'alice', settings=settings), 'timecapsule-someone-else', uploads)
+        before = wire_calls()
+
+        retry_manager.reset_metrics()
+        auth_manager.forget(IAM_manager.create_user_session(access_key, secret_key))
+        denied = actions = 0
+        for _ in range(sessions):
+            session = IAM_manager.create_user_session(access_key, secret_key)
+            ctx = AppContext(session, identity=auth_manager.caller_identity(session), settings=settings)
+            count, refused = capsule_session(ctx, 'timecapsule-someone-else', uploads)
+            actions += count
+            denied += refused
+        after = wire_calls()
+        report('identity_cache', sessions=sessions, actions=actions, calls_before=before, calls_after=after,
+               saved_per_session=(before - after) / sessions, denied_locally=denied)
+
+        params = {'Bucket': 'timecapsule-someone-else', 'Key': 'capsule.txt'}
+        elapsed = timed(lambda: [ctx.permissions.check('s3', 'GetObject', params) for _ in range(checks)], 1)
+        report('identity_cache', phase='local_check', checks=checks, us_per_check=elapsed / checks * 1e6)
+
+
+def client_bytes():
+    # Request and response body bytes the client moved, from the trace counters.
+    return sum(stats['bytes_sent'] + stats['bytes_received'] for stats in trace_manager.snapshot())
+
+
+@benchmark
+def bench_server_side_copy(object_count=500, large_mb=64):
+    # Reorganising a prefix by downloading and uploading it again, against the
+    # server-side copy engine. Traced client bytes show what never left S3.
+    with moto_backend('server_side_copy') as backend:
+        if backend is None:
+            return
+        ctx = AppContext(boto3.session.Session(), 'bench', settings={'cache_enabled': False})
+        s3 = ctx.client('s3')
+        for bucket_name in ('bench-copy-source', 'bench-copy-target'):
+            S3_manager.make_bucket(ctx, bucket_name)
+        rng = random.Random(7)
+        for n in range(object_count):
+            s3.put_object(Bucket='bench-copy-source', Key=f"capsule/{n:05d}.jpg",
+                          Body=rng.randbytes(rng.randrange(1024, 64 * 1024)))
+        trace_manager.configure(enabled=True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            trace_manager.reset()
+            start = time.perf_counter()
+            transfer_manager.download_prefix(ctx, 'bench-copy-source', 'capsule/', directory)
+            transfer_manager.sync_directory(ctx, directory, 'bench-copy-target', prefix='roundtrip/')
+            elapsed = time.perf_counter() - start
+            report('server_side_copy', backend=backend, mode='download_upload', objects=object_count,
+                   objects_per_s=object_count / elapsed, client_mb=client_bytes() / transfer_manager.MB)
+
+        for mode, options in (('copy', {}),
+                              ('glacier_ir', {'storage_class': 'GLACIER_IR', 'tags': {'timecapsule-state': 'sealed'}}),
+                              ('move', {'move': True})):
+            trace_manager.reset()
+            result = copy_manager.copy_prefix(ctx, 'bench-copy-source', 'capsule/', 'bench-copy-target',
+                                              f"{mode}/", **options)
+            report('server_side_copy', backend=backend, mode=mode, objects=result['copied'],
+                   objects_per_s=result['objects_per_s'], server_side_mb=result['bytes'] / transfer_manager.MB,
+                   client_mb=client_bytes() / transfer_manager.MB, deleted=result.get('deleted', 0),
+                   failed=len(result['failed']))
+        left = sum(1 for _ in S3_manager.iter_objects(ctx, 'bench-copy-source', 'capsule/', use_cache=False))
+
+        s3.put_object(Bucket='bench-copy-source', Key='large.bin', Body=rng.randbytes(large_mb * transfer_manager.MB))
+        trace_manager.reset()
+        start = time.perf_counter()
+        result = copy_manager.copy_object(ctx, 'bench-copy-source', 'large.bin', 'bench-copy-target', 'large.bin',
+                                          copy_threshold=16 * transfer_manager.MB,
+                                          copy_part_size=8 * transfer_manager.MB)
+        elapsed = time.perf_counter() - start
+        trace_manager.configure(enabled=False)
+        parts = [stats['count'] for stats in trace_manager.snapshot() if stats['operation'] == 'UploadPartCopy']
+        report('server_side_copy', backend=backend, mode='multipart_copy', object_mb=large_mb,
+               parts=sum(parts), mb_per_s=result['Size'] / transfer_manager.MB / elapsed,
+               client_mb=client_bytes() / transfer_manager.MB, source_left_after_move=left)
+        trace_manager.reset()
+
+
+TRACE_OVERHEAD_BUDGET = 0.10
+HEAD_OBJECT_RESPONSE = {'ContentLength': 1024, 'ETag': '"etag"', 'ResponseMetadata': {
+    'HTTPStatusCode': 200, 'HTTPHeaders': {'content-length': '0'}, 'RetryAttempts': 0}}
+
+
+@benchmark
+def bench_trace_overhead(calls=5000, rounds=7):
+    # Stubbed calls never touch the network, so this is the worst case: the
+    # hooks' cost against the cheapest call botocore can make. Modes are
+    # interleaved and the best round of each kept, to keep machine noise out.
+    trace_manager.configure(enabled=False)
+    client_manager.clear_clients()
+    s3 = client_manager.get_client('s3')
+    stubber = Stubber(s3)
+    stubber.activate()
+
+    def loop():
+        for _ in range(calls):
+            stubber.add_response('head_object', HEAD_OBJECT_RESPONSE)
+            s3.head_object(Bucket='bench-bucket', Key='capsule.txt')
+
+    loop()
+    modes = {'off': None, 'sampled': 0.01, 'on': 1.0}
+    results = dict.fromkeys(modes, float('inf'))
+    for _ in range(rounds):
+        for name, rate in modes.items():
+            trace_manager.configure(enabled=rate is not None, sample_rate=rate)
+            results[name] = min(results[name], timed(loop, 1) / calls)
+    trace_manager.configure(enabled=False)
+    stubber.deactivate()
+
+    overhead = results['on'] / results['off'] - 1
+    report('trace_overhead', off_us=results['off'] * 1e6, sampled_us=results['sampled'] * 1e6,
+           on_us=results['on'] * 1e6, overhead=overhead, budget=TRACE_OVERHEAD_BUDGET,
+           spans=len(trace_manager.spans()), within_budget=overhead <= TRACE_OVERHEAD_BUDGET)
+    trace_manager.reset()
+    return overhead <= TRACE_OVERHEAD_BUDGET
+
+
+class AsyncBodyStandIn:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    async def read(self, size):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class AsyncPages:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for page in self.pages:
+            yield page
+
+
+class AsyncObjectStandIn:
+    # Async twin of UploadStandIn/DownloadStandIn: the same fixed latency per
+    # request, awaited instead of slept, so many requests overlap on one thread.
+    def __init__(self, size, key_count, latency):
+        self.payload = os.urandom(size)
+        self.etag = f'"{hashlib.md5(self.payload).hexdigest()}"'
+        self.key_count = key_count
+        self.latency = latency
+        self.received = 0
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Prefix='', **kwargs):
+        return AsyncPages([{'Contents': [{'Key': f"{Prefix}{n}.jpg", 'Size': len(self.payload), 'ETag': self.etag}
+                                         for n in range(self.key_count)]}])
+
+    async def put_object(self, Bucket, Key, Body):
+        await asyncio.sleep(self.latency)
+        self.received += len(Body)
+        return {'ETag': self.etag}
+
+    async def get_object(self, Bucket, Key):
+        await asyncio.sleep(self.latency)
+        return {'Body': AsyncBodyStandIn(self.payload), 'ETag': self.etag}
+
+
+def small_files(directory, count, size):
+    payload = os.urandom(size)
+    for n in range(count):
+        with open(os.path.join(directory, f"{n}.jpg"), 'wb') as data:
+            data.write(payload)
+
+
+@benchmark
+def bench_async_backend(object_count=4096, object_kb=16, latency=0.02):
+    # Small-object uploads and downloads through the thread-pool backend and the
+    # asyncio backend at the same concurrency. Both talk to stand-ins with the
+    # same per-request latency, so the difference is what each backend costs to
+    # keep that many requests in flight. Peak RSS is per process, so compare the
+    # thread counts instead.
+    size = object_kb * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source')
+        os.makedirs(source)
+        small_files(source, object_count, size)
+        for concurrency in (64, 256, 1024, 2048):
+            ctx = StandInContext(s3=UploadStandIn(latency=latency))
+            threaded_up = transfer_manager.sync_directory(ctx, source, 'bench-bucket', workers=concurrency)
+            ctx = StandInContext(s3=DownloadStandIn(size, key_count=object_count, latency=latency))
+            threaded_down = transfer_manager.download_prefix(ctx, 'bench-bucket', 'capsule/',
+                                                             os.path.join(directory, f"threads-{concurrency}"),
+                                                             workers=concurrency)
+
+            ctx = StandInContext()
+            async_up = asyncio.run(async_manager.sync_directory_async(
+                ctx, source, 'bench-bucket', concurrency=concurrency, client=AsyncObjectStandIn(size, 0, latency)))
+            async_down = asyncio.run(async_manager.download_prefix_async(
+                ctx, 'bench-bucket', 'capsule/', os.path.join(directory, f"async-{concurrency}"),
+                concurrency=concurrency, client=AsyncObjectStandIn(size, object_count, latency)))
+
+            report('async_backend', objects=object_count, concurrency=concurrency,
+                   threads_upload_ops=threaded_up['files_per_s'], async_upload_ops=async_up['files_per_s'],
+                   threads_download_ops=threaded_down['files_per_s'], async_download_ops=async_down['files_per_s'],
+                   failed=len(threaded_up['failed']) + len(threaded_down['failed']) + len(async_up['failed'])
+                   + len(async_down['failed']))
+
+
+# Scenario suite: the non-interactive functions behind the S3 and EC2 menus,
+# driven against seeded fixtures at several sizes. Every scenario reports
+# throughput, p50/p99 latency per unit of work and peak traced memory, and the
+# results can be saved as a JSON baseline and compared on later runs:
+#
+#   python benchmarks.py suite --save-baseline
+#   python benchmarks.py suite                   # flags regressions, exits 1
+#   python benchmarks.py suite --scale large     # adds 1M keys, 5k instances, 2 GB
+
+SCALES = {
+    'small': {'bucket_keys': (1_000, 100_000), 'fleet_sizes': (10, 1_000), 'object_mb': (256,),
+              'small_objects': 500, 'moto_fleet_sizes': (10, 100)},
+    'large': {'bucket_keys': (1_000, 100_000, 1_000_000), 'fleet_sizes': (10, 1_000, 5_000),
+              'object_mb': (256, 2048), 'small_objects': 2_000, 'moto_fleet_sizes': (10, 1_000)},
+}
+SUITE = {'scale': 'small', 'seed': 1234, 'repeat': 3}
+SUITE_RESULTS = {}
+BASELINE_PATH = 'benchmark_baselines.json'
+DEFAULT_TOLERANCE = 0.25
+# Which way is better for each recorded metric.
+HIGHER_IS_BETTER = {'throughput': True, 'p50_ms': False, 'p99_ms': False, 'peak_mb': False}
+
+
+def suite_scale():
+    return SCALES[SUITE['scale']]
+
+
+def measure(run, setup=None, repeat=None, memory=True):
+    # run() does one pass and returns (items processed, per-unit latencies).
+    # Timed passes run without tracemalloc, then one extra pass measures memory.
+    repeat = repeat or SUITE['repeat']
+    latencies, items, elapsed = [], 0, 0.0
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        count, samples = run(state) if setup else run()
+        elapsed += time.perf_counter() - start
+        items += count
+        latencies.extend(samples)
+
+    peak = None
+    if memory:
+        state = setup() if setup else None
+        tracemalloc.start()
+        run(state) if setup else run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'throughput': items / elapsed if elapsed else 0.0,
+            'p50_ms': EC2_manager.percentile(latencies, 50) * 1000,
+            'p99_ms': EC2_manager.percentile(latencies, 99) * 1000,
+            'peak_mb': peak / transfer_manager.MB if peak is not None else None}
+
+
+def record(name, result, **params):
+    key = name + ''.join(f" {field}={value}" for field, value in sorted(params.items()))
+    SUITE_RESULTS[key] = {metric: value for metric, value in result.items() if value is not None}
+    report(name, **params, **result)
+
+
+def timed_pages(pages):
+    # Latency of producing each page, i.e. one request plus parsing it.
+    latencies, count = [], 0
+    start = time.perf_counter()
+    for page in pages:
+        now = time.perf_counter()
+        latencies.append(now - start)
+        count += len(page)
+        start = now
+    return count, latencies
+
+
+def seeded_object_pages(rng, key_count, page_size=1000):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    pages = []
+    for first in range(0, key_count, page_size):
+        last = min(first + page_size, key_count)
+        page = {'KeyCount': last - first, 'IsTruncated': last < key_count, 'Contents': [
+            {'Key': f"capsule/{rng.randrange(100):02d}/{n:08d}.jpg", 'Size': rng.randrange(1, 8 * 2**20),
+             'ETag': '"etag"', 'LastModified': datetime.fromtimestamp(start + rng.randrange(10**8), timezone.utc),
+             'StorageClass': 'STANDARD'}
+            for n in range(first, last)]}
+        if last < key_count:
+            page['NextContinuationToken'] = f"token-{last}"
+        pages.append(page)
+    return pages
+
+
+def stubbed_context(service):
+    ctx = AppContext(boto3.session.Session(), 'bench', settings={'cache_enabled': False})
+    client = ctx.client(service)
+    return ctx, client
+
+
+@benchmark
+def bench_suite_s3_listing():
+    ctx, s3 = stubbed_context('s3')
+    for key_count in suite_scale()['bucket_keys']:
+        pages = seeded_object_pages(random.Random(SUITE['seed']), key_count)
+
+        def setup():
+            stubber = Stubber(s3)
+            for page in pages:
+                stubber.add_response('list_objects_v2', page)
+            stubber.activate()
+            return stubber
+
+        def run(stubber):
+            try:
+                return timed_pages(S3_manager.iter_object_pages(ctx, 'bench-bucket', use_cache=False))
+            finally:
+                stubber.deactivate()
+
+        record('suite_s3_listing', measure(run, setup, repeat=1 if key_count >= 1_000_000 else None),
+               backend='stubber', keys=key_count)
+
+
+def seeded_reservations(rng, instance_count, page_size=1000):
+    states = ['running', 'stopped', 'pending', 'stopping']
+    pages = []
+    for first in range(0, instance_count, page_size):
+        last = min(first + page_size, instance_count)
+        instances = [{'InstanceId': f"i-{n:017x}", 'InstanceType': 't2.micro',
+                      'State': {'Name': rng.choice(states), 'Code': 16},
+                      'Tags': [{'Key': 'Name', 'Value': f"capsule-{n}"},
+                               {'Key': 'Project', 'Value': EC2_manager.PROJECT_TAG}],
+                      'PublicIpAddress': f"10.0.{n // 256 % 256}.{n % 256}"}
+                     for n in range(first, last)]
+        page = {'Reservations': [{'ReservationId': f"r-{first:017x}", 'Instances': instances}]}
+        if last < instance_count:
+            page['NextToken'] = f"token-{last}"
+        pages.append(page)
+    return pages
+
+
+@benchmark
+def bench_suite_ec2_listing():
+    ctx, ec2 = stubbed_context('ec2')
+    filters = EC2_manager.instance_filters()
+    for instance_count in suite_scale()['fleet_sizes']:
+        pages = seeded_reservations(random.Random(SUITE['seed']), instance_count)
+
+        def setup():
+            stubber = Stubber(ec2)
+            for page in pages:
+                stubber.add_response('describe_instances', page)
+            stubber.activate()
+            return stubber
+
+        def run(stubber):
+            try:
+                start = time.perf_counter()
+                table = EC2_manager.load_instances(ctx, filters)
+                return len(table), [time.perf_counter() - start]
+            finally:
+                stubber.deactivate()
+
+        record('suite_ec2_listing', measure(run, setup), backend='stubber', instances=instance_count)
+
+
+class LargeObjectStandIn(UploadStandIn):
+    # A multi-GB object served from one seeded 1 MB block, so neither side has
+    # to hold the whole object in memory.
+    def __init__(self, size, seed, **kwargs):
+        super().__init__(**kwargs)
+        self.size = size
+        self.block = random.Random(seed).randbytes(transfer_manager.MB)
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        return {'ContentLength': self.size, 'ETag': '"large-object"'}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        first, last = (int(value) for value in Range.split('=')[1].split('-'))
+        self._transfer(last - first + 1)
+        return {'Body': BlockBody(self.block, first, last + 1)}
+
+
+class BlockBody:
+    def __init__(self, block, first, end):
+        self.block, self.first, self.end = block, first, end
+
+    def iter_chunks(self, chunk_size):
+        size = len(self.block)
+        offset = self.first
+        while offset < self.end:
+            start = offset % size
+            piece = self.block[start:min(size, start + chunk_size, start + self.end - offset)]
+            yield piece
+            offset += len(piece)
+
+
+def write_seeded_file(path, size, seed):
+    block = random.Random(seed).randbytes(transfer_manager.MB)
+    with open(path, 'wb') as target:
+        for offset in range(0, size, len(block)):
+            target.write(block[:size - offset])
+
+
+@benchmark
+def bench_suite_s3_transfer(part_mb=16, concurrency=8):
+    mb = transfer_manager.MB
+    with tempfile.TemporaryDirectory() as directory:
+        for object_mb in suite_scale()['object_mb']:
+            path = os.path.join(directory, 'capsule.bin')
+            write_seeded_file(path, object_mb * mb, SUITE['seed'])
+            settings = {'manifest_dir': directory, 'multipart_threshold': 8 * mb, 'verify_downloads': False}
+
+            def upload():
+                ctx = StandInContext(s3=UploadStandIn(latency=0.005, bandwidth=1024 * mb))
+                ctx.settings = settings
+                start = time.perf_counter()
+                transfer_manager.upload(ctx, path, 'bench-bucket', 'capsule.bin',
+                                        part_size=part_mb * mb, upload_concurrency=concurrency)
+                return object_mb, [time.perf_counter() - start]
+
+            def download():
+                ctx = StandInContext(s3=LargeObjectStandIn(object_mb * mb, SUITE['seed'], latency=0.005,
+                                                           bandwidth=1024 * mb))
+                ctx.settings = settings
+                start = time.perf_counter()
+                transfer_manager.download(ctx, 'bench-bucket', 'capsule.bin', os.path.join(directory, 'copy.bin'),
+                                          part_size=part_mb * mb, download_concurrency=concurrency)
+                return object_mb, [time.perf_counter() - start]
+
+            record('suite_s3_transfer', measure(upload), backend='stand-in', op='upload', object_mb=object_mb)
+            record('suite_s3_transfer', measure(download), backend='stand-in', op='download', object_mb=object_mb)
+            os.remove(path)
+
+
+@contextlib.contextmanager
+def moto_backend(name):
+    # Prefers moto's HTTP server, so requests go through a real socket and
+    # connection pool, and falls back to in-process mocking without moto[server].
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            from moto.server import ThreadedMotoServer
+    except ImportError:
+        mock = moto_or_skip(name)
+        if mock is None:
+            yield None
+            return
+        with mock:
+            yield 'moto'
+        return
+
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    previous = os.environ.get('AWS_ENDPOINT_URL')
+    os.environ['AWS_ENDPOINT_URL'] = f"http://{host}:{port}"
+    client_manager.reset()
+    try:
+        yield 'moto-server'
+    finally:
+        server.stop()
+        client_manager.reset()
+        if previous is None:
+            os.environ.pop('AWS_ENDPOINT_URL', None)
+        else:
+            os.environ['AWS_ENDPOINT_URL'] = previous
+
+
+def per_call(call, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        call(item)
+        latencies.append(time.perf_counter() - start)
+    return len(latencies), latencies
+
+
+@benchmark
+def bench_suite_s3_objects():
+    count = suite_scale()['small_objects']
+    with moto_backend('suite_s3_objects') as backend:
+        if backend is None:
+            return
+        ctx = AppContext(boto3.session.Session(), 'bench', settings={'cache_enabled': False})
+        s3 = ctx.client('s3')
+        S3_manager.make_bucket(ctx, 'bench-suite')
+        rng = random.Random(SUITE['seed'])
+        bodies = [rng.randbytes(rng.randrange(1024, 64 * 1024)) for _ in range(count)]
+        keys = [f"capsule/{n:06d}.jpg" for n in range(count)]
+
+        def put():
+            return per_call(lambda n: s3.put_object(Bucket='bench-suite', Key=keys[n], Body=bodies[n]), range(count))
+
+        record('suite_s3_objects', measure(put, memory=False), backend=backend, op='put', objects=count)
+        record('suite_s3_objects', measure(lambda: per_call(
+            lambda key: s3.get_object(Bucket='bench-suite', Key=key)['Body'].read(), keys), memory=False),
+            backend=backend, op='get', objects=count)
+        record('suite_s3_objects', measure(lambda: timed_pages(
+            S3_manager.iter_object_pages(ctx, 'bench-suite', page_size=100, use_cache=False))),
+            backend=backend, op='list', objects=count)
+
+        def delete(_):
+            result = delete_manager.delete_prefix(ctx, 'bench-suite', 'capsule/')
+            return result['deleted'], [result['elapsed']]
+
+        record('suite_s3_objects', measure(delete, setup=put, repeat=1, memory=False),
+               backend=backend, op='delete', objects=count)
+
+
+@benchmark
+def bench_suite_ec2_fleet():
+    with moto_backend('suite_ec2_fleet') as backend:
+        if backend is None:
+            return
+        ctx = AppContext(boto3.session.Session(), 'bench', settings={'cache_enabled': False})
+        for instance_count in suite_scale()['moto_fleet_sizes']:
+            launched = []
+
+            def launch():
+                start = time.perf_counter()
+                job = EC2_manager.provision_instances(ctx, 'bench', count=instance_count, notify=False)
+                launched.append(job.instance_ids)
+                return instance_count, [time.perf_counter() - start]
+
+            def stop():
+                start = time.perf_counter()
+                EC2_manager.fleet_action(ctx, 'stop', launched[-1], wait=False)
+                return instance_count, [time.perf_counter() - start]
+
+            record('suite_ec2_fleet', measure(launch, repeat=1, memory=False), backend=backend, op='launch',
+                   instances=instance_count)
+            record('suite_ec2_fleet', measure(stop, memory=False), backend=backend, op='stop',
+                   instances=instance_count)
+        ctx.close()
+
+
+def compare(results, baseline, tolerance):
+    # A metric regresses when it is worse than the baseline by more than the
+    # tolerance. Latency and memory are lower-is-better, throughput higher.
+    regressions = []
+    for key, metrics in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric, value in metrics.items():
+            before = previous.get(metric)
+            if not before or metric not in HIGHER_IS_BETTER:
+                continue
+            change = value / before - 1
+            worse = -change if HIGHER_IS_BETTER[metric] else change
+            if worse > tolerance:
+                regressions.append((key, metric, before, value, change))
+    return regressions
+
+
+def machine_id():
+    return f"{platform.node()}/{platform.machine()}/python{platform.python_version()}"
+
+
+def load_baseline(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as source:
+        return json.load(source)
+
+
+def save_baseline(path, results):
+    baseline = load_baseline(path) or {'results': {}}
+    baseline.update({'machine': machine_id(), 'saved_at': datetime.now(timezone.utc).isoformat()})
+    baseline['results'].update(results)
+    with open(f"{path}.tmp", 'w') as target:
+        json.dump(baseline, target, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def check_baseline(path, tolerance):
+    baseline = load_baseline(path)
+    if baseline is None:
+        print(f"No baseline at {path}, run with --save-baseline to create one.")
+        return True
+    if baseline.get('machine') != machine_id():
+        print(f"Baseline was recorded on {baseline.get('machine')}, comparing anyway.")
+    regressions = compare(SUITE_RESULTS, baseline['results'], tolerance)
+    for key, metric, before, value, change in regressions:
+        print(f"REGRESSION {key}: {metric} {before:.4f} -> {value:.4f} ({change:+.0%})")
+    if not regressions:
+        print(f"No regressions beyond {tolerance:.0%} against {path}.")
+    return not regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for the TimeCapsule managers.")
+    parser.add_argument('names', nargs='*', help="benchmarks to run, 'suite' for every suite_ scenario")
+    parser.add_argument('--scale', choices=SCALES, default=SUITE['scale'])
+    parser.add_argument('--seed', type=int, default=SUITE['seed'])
+    parser.add_argument('--repeat', type=int, default=SUITE['repeat'])
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+    SUITE.update(scale=args.scale, seed=args.seed, repeat=args.repeat)
+
+    selected = []
+    for name in args.names or list(BENCHMARKS):
+        if name == 'suite':
+            selected.extend(candidate for candidate in BENCHMARKS if candidate.startswith('suite_'))
+        elif name in BENCHMARKS:
+            selected.append(name)
+        else:
+            print(f"Unknown benchmark {name}. Choose from: suite, {', '.join(BENCHMARKS)}")
+            return 1
+
+    status = 0
+    for name in selected:
+        if BENCHMARKS[name]() is False:
+            status = 1
+    if SUITE_RESULTS:
+        if args.save_baseline:
+            save_baseline(args.baseline, SUITE_RESULTS)
+            print(f"Saved {len(SUITE_RESULTS)} results to {args.baseline}.")
+        elif not check_baseline(args.baseline, args.tolerance):
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
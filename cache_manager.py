@@ -0,0 +1,177 @@
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Short-lived cache for bucket, object and instance listings so menu navigation
+# does not re-list from AWS on every step. Keys are tuples that start with the
+# resource kind and name, e.g. ('objects', bucket, prefix, ...), which is what
+# invalidate() works on when our own mutations change a resource.
+
+MISSING = object()
+
+DEFAULT_TTLS = {
+    'buckets': 300,
+    'objects': 60,
+    'instances': 30,
+}
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+FLUSH_EVERY = 100
+
+
+class MetadataCache:
+    def __init__(self, ttls=None, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 path=None, namespace='', enabled=True, clock=time.time):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.enabled = enabled
+        self.clock = clock
+
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+        self.db = None
+        self.dirty = set()
+        self.deleted = set()
+        if enabled and path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                            "namespace TEXT, key TEXT, expires REAL, value BLOB, PRIMARY KEY (namespace, key))")
+            self._load()
+
+    def _load(self):
+        # A restarted CLI starts warm with whatever has not expired yet.
+        now = self.clock()
+        self.db.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        rows = self.db.execute("SELECT key, expires, value FROM cache WHERE namespace = ? ORDER BY expires",
+                               (self.namespace,))
+        for stored_key, expires, blob in rows:
+            try:
+                value = pickle.loads(blob)
+            except Exception:
+                continue
+            self._store(tuple(json.loads(stored_key)), value, expires, len(blob))
+        self.db.commit()
+
+    def _group(self, key):
+        return key[:2]
+
+    def _store(self, key, value, expires, size):
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (expires, size, value)
+        self.groups.setdefault(self._group(key), set()).add(key)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest = next(iter(self.entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        group = self.groups.get(self._group(key))
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self.groups[self._group(key)]
+        self.dirty.discard(key)
+        if self.db is not None:
+            self.deleted.add(key)
+
+    def get(self, key):
+        if not self.enabled:
+            return MISSING
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            if entry[0] <= self.clock():
+                self._drop(key)
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return value
+        if ttl is None:
+            ttl = self.ttls.get(key[0], DEFAULT_TTL)
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._store(key, value, self.clock() + ttl, len(blob))
+            if self.db is not None and key in self.entries:
+                self.deleted.discard(key)
+                self.dirty.add(key)
+                if len(self.dirty) >= FLUSH_EVERY:
+                    self.flush()
+        return value
+
+    def get_or_load(self, key, loader, ttl=None):
+        value = self.get(key)
+        if value is MISSING:
+            value = self.set(key, loader(), ttl)
+        return value
+
+    def invalidate(self, kind, name=None):
+        with self.lock:
+            if name is not None:
+                groups = [(kind, name)]
+            else:
+                groups = [group for group in self.groups if group[0] == kind]
+            for group in groups:
+                for key in list(self.groups.get(group, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._drop(key)
+
+    def flush(self):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?",
+                                [(self.namespace, json.dumps(key)) for key in self.deleted])
+            rows = []
+            for key in self.dirty:
+                expires, _, value = self.entries[key]
+                rows.append((self.namespace, json.dumps(key), expires,
+                             pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            self.db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", rows)
+            self.db.commit()
+            self.dirty.clear()
+            self.deleted.clear()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+            }
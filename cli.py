@@ -0,0 +1,413 @@
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+import botocore
+
+import EC2_manager
+import S3_manager
+import copy_manager
+import delete_manager
+import index_manager
+import provision_manager
+import transfer_manager
+from app_context import AppContext
+
+# Non-interactive front end. Every subcommand is one operation from OPERATIONS,
+# and a batch job file is a list of the same operations with optional
+# dependencies between them. All of them share one AppContext, and every result
+# is printed as one JSON object per line.
+#
+#   python cli.py s3 cp photo.jpg s3://timecapsule-alice/2024/photo.jpg
+#   python cli.py batch jobs.yaml --workers 16
+
+DEFAULT_WORKERS = 8
+
+
+class OperationFailed(Exception):
+    # An operation that ran but did not get its work done, reported like an AWS
+    # error. Anything else escaping an operation is a bug and is not caught.
+    pass
+
+
+def split_s3_url(url):
+    if not url.startswith('s3://'):
+        return None, None
+    bucket_name, _, key = url[len('s3://'):].partition('/')
+    return bucket_name, key
+
+
+def op_s3_mb(ctx, bucket):
+    S3_manager.make_bucket(ctx, bucket)
+    return {'bucket': bucket, 'region': ctx.region}
+
+
+def op_s3_ls(ctx, bucket=None, prefix='', recursive=False):
+    if not bucket:
+        for entry in S3_manager.fetch_buckets(ctx):
+            yield {'bucket': entry['Name'], 'created': entry.get('CreationDate')}
+        return
+    delimiter = None if recursive else '/'
+    for record in S3_manager.iter_objects(ctx, bucket, prefix=prefix, delimiter=delimiter):
+        yield record._asdict()
+
+
+def server_side_copy(ctx, source, destination, storage_class, recursive, move):
+    source_bucket, source_key = split_s3_url(source)
+    target_bucket, target_key = split_s3_url(destination)
+    if recursive:
+        return copy_manager.copy_prefix(ctx, source_bucket, source_key, target_bucket, target_key,
+                                        storage_class=storage_class, move=move)
+    if not target_key or target_key.endswith('/'):
+        target_key += source_key.rsplit('/', 1)[-1]
+    return copy_manager.copy_object(ctx, source_bucket, source_key, target_bucket, target_key,
+                                    storage_class=storage_class, move=move)
+
+
+def op_s3_cp(ctx, source, destination, storage_class=None, recursive=False):
+    source_bucket, source_key = split_s3_url(source)
+    target_bucket, target_key = split_s3_url(destination)
+    if source_bucket and target_bucket:
+        return server_side_copy(ctx, source, destination, storage_class, recursive, move=False)
+    if source_bucket and not target_bucket:
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(source_key))
+        return transfer_manager.download(ctx, source_bucket, source_key, destination)
+    if target_bucket and not source_bucket:
+        if not target_key or target_key.endswith('/'):
+            target_key += os.path.basename(source)
+        return transfer_manager.upload(ctx, source, target_bucket, target_key)
+    raise ValueError("cp copies between a local path and an s3:// URL, or between two s3:// URLs.")
+
+
+def op_s3_mv(ctx, source, destination, storage_class=None, recursive=False):
+    if not split_s3_url(source)[0] or not split_s3_url(destination)[0]:
+        raise ValueError("mv moves objects between two s3:// URLs.")
+    return server_side_copy(ctx, source, destination, storage_class, recursive, move=True)
+
+
+def op_s3_sync(ctx, source, destination):
+    bucket_name, prefix = split_s3_url(destination)
+    if not bucket_name or not os.path.isdir(source):
+        raise ValueError("sync uploads a local directory to an s3:// URL.")
+    return transfer_manager.sync_directory(ctx, source, bucket_name, prefix=prefix)
+
+
+def op_s3_rm(ctx, target, recursive=False):
+    bucket_name, key = split_s3_url(target)
+    if not bucket_name:
+        raise ValueError("rm needs an s3:// URL.")
+    if recursive:
+        return delete_manager.delete_prefix(ctx, bucket_name, key)
+    ctx.client('s3').delete_object(Bucket=bucket_name, Key=key)
+    ctx.cache.invalidate('objects', bucket_name)
+    if index_manager.has_index(ctx, bucket_name):
+        ctx.index.remove(bucket_name, [key])
+    return {'bucket': bucket_name, 'key': key, 'deleted': True}
+
+
+def op_ec2_launch(ctx, name, count=1, wait=True):
+    try:
+        job = EC2_manager.provision_instances(ctx, name, count, notify=False)
+    except RuntimeError as e:
+        # A partial launch, with capacity for fewer instances than asked for.
+        raise OperationFailed(str(e)) from e
+    if wait:
+        job.wait()
+    return {'job': job.id, 'instances': job.instance_ids, 'results': job.snapshot()}
+
+
+def fleet_op(action):
+    def run(ctx, instance_ids=None, tags=None, wait=True):
+        return EC2_manager.fleet_action(ctx, action, instance_ids, tags, wait=wait)
+    return run
+
+
+def op_iam_register(ctx, username):
+    key = provision_manager.register_user(ctx, username)
+    return {'username': username, 'access_key_id': key['AccessKeyId'], 'secret_access_key': key['SecretAccessKey']}
+
+
+def op_iam_provision(ctx, users=None, users_file=None, journal=None, workers=None):
+    usernames = list(users or []) + (provision_manager.read_user_list(users_file) if users_file else [])
+    summary = provision_manager.provision_users(ctx, usernames, provision_journal=journal,
+                                                provision_workers=workers)
+    if summary['failed']:
+        raise OperationFailed(f"{summary['failed']} of {summary['users']} users failed, rerun to resume: "
+                           f"{summary['errors']}")
+    return summary
+
+
+def op_iam_teardown(ctx, users=None, users_file=None, journal=None, workers=None):
+    usernames = list(users or []) + (provision_manager.read_user_list(users_file) if users_file else [])
+    summary = provision_manager.teardown_users(ctx, usernames or None, provision_journal=journal,
+                                               provision_workers=workers)
+    if summary['failed']:
+        raise OperationFailed(f"{summary['failed']} of {summary['users']} users failed: {summary['errors']}")
+    return summary
+
+
+OPERATIONS = {
+    's3.mb': op_s3_mb,
+    's3.ls': op_s3_ls,
+    's3.cp': op_s3_cp,
+    's3.mv': op_s3_mv,
+    's3.sync': op_s3_sync,
+    's3.rm': op_s3_rm,
+    'ec2.launch': op_ec2_launch,
+    'ec2.start': fleet_op('start'),
+    'ec2.stop': fleet_op('stop'),
+    'iam.register': op_iam_register,
+    'iam.provision': op_iam_provision,
+    'iam.teardown': op_iam_teardown,
+}
+
+
+class JsonLines:
+    # Worker threads finish in any order, so whole lines are written under a lock.
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def __call__(self, **fields):
+        line = json.dumps(fields, default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+def load_job_file(path):
+    with open(path) as job_file:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("YAML job files need the PyYAML package installed, or use JSON.") from None
+            job = yaml.safe_load(job_file)
+        else:
+            job = json.load(job_file)
+    return job if isinstance(job, dict) else {'operations': job}
+
+
+def check_args(step):
+    if not isinstance(step['args'], dict):
+        raise ValueError(f"{step['id']}: args must be a mapping of argument names to values.")
+    try:
+        inspect.signature(OPERATIONS[step['op']]).bind(None, **step['args'])
+    except TypeError as e:
+        raise ValueError(f"{step['id']}: {step['op']} {e}.") from None
+
+
+def plan(operations):
+    # Normalises the operations and orders them so every operation comes after
+    # the ones it depends on. Unknown operations, arguments the operation does
+    # not take, missing dependencies and cycles are rejected before anything runs.
+    steps = {}
+    for number, operation in enumerate(operations, start=1):
+        step = {
+            'id': str(operation.get('id') or f"op-{number}"),
+            'op': operation.get('op'),
+            'args': operation.get('args') or {},
+            'after': [str(name) for name in operation.get('after') or []],
+        }
+        if step['op'] not in OPERATIONS:
+            raise ValueError(f"{step['id']}: unknown operation {step['op']!r}.")
+        check_args(step)
+        if step['id'] in steps:
+            raise ValueError(f"Operation id {step['id']} is used twice.")
+        steps[step['id']] = step
+
+    waiting = {}
+    dependents = {name: [] for name in steps}
+    for step in steps.values():
+        for name in set(step['after']):
+            if name not in steps:
+                raise ValueError(f"{step['id']} runs after {name}, which is not in the job.")
+            dependents[name].append(step['id'])
+        waiting[step['id']] = len(set(step['after']))
+
+    ready = deque(name for name, count in waiting.items() if count == 0)
+    ordered = []
+    while ready:
+        name = ready.popleft()
+        ordered.append(steps[name])
+        for child in dependents[name]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                ready.append(child)
+    if len(ordered) != len(steps):
+        stuck = sorted(name for name, count in waiting.items() if count)
+        raise ValueError(f"Dependency cycle between: {', '.join(stuck)}.")
+    return ordered
+
+
+def execute(ctx, step, emit):
+    start = time.perf_counter()
+    try:
+        result = OPERATIONS[step['op']](ctx, **step['args'])
+        if result is None or isinstance(result, dict):
+            summary = result
+        else:
+            records = 0
+            for record in result:
+                emit(id=step['id'], op=step['op'], record=record)
+                records += 1
+            summary = {'records': records}
+    except botocore.exceptions.ClientError as e:
+        emit(id=step['id'], op=step['op'], status='error', code=e.response['Error']['Code'],
+             error=e.response['Error']['Message'], elapsed=time.perf_counter() - start)
+        return False
+    except (botocore.exceptions.BotoCoreError, OSError, OperationFailed, ValueError) as e:
+        emit(id=step['id'], op=step['op'], status='error', error=str(e), elapsed=time.perf_counter() - start)
+        return False
+    emit(id=step['id'], op=step['op'], status='ok', result=summary, elapsed=time.perf_counter() - start)
+    return True
+
+
+def run_batch(ctx, operations, emit, workers=DEFAULT_WORKERS):
+    ordered = plan(operations)
+    remaining = {step['id']: set(step['after']) for step in ordered}
+    dependents = {step['id']: [] for step in ordered}
+    for step in ordered:
+        for name in set(step['after']):
+            dependents[name].append(step['id'])
+    steps = {step['id']: step for step in ordered}
+    ready = deque(step['id'] for step in ordered if not step['after'])
+    outcome = {}
+
+    def skip(name, reason):
+        # Everything downstream of a failure is skipped rather than run.
+        pending = deque([(name, reason)])
+        while pending:
+            name, reason = pending.popleft()
+            if name in outcome:
+                continue
+            outcome[name] = False
+            emit(id=name, op=steps[name]['op'], status='skipped', error=f"{reason} failed")
+            pending.extend((child, name) for child in dependents[name])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while ready or running:
+            while ready:
+                name = ready.popleft()
+                running[pool.submit(execute, ctx, steps[name], emit)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                outcome[name] = future.result()
+                for child in dependents[name]:
+                    if not outcome[name]:
+                        skip(child, name)
+                        continue
+                    remaining[child].discard(name)
+                    if not remaining[child] and child not in outcome:
+                        ready.append(child)
+    elapsed = time.perf_counter() - start
+
+    succeeded = sum(1 for ok in outcome.values() if ok)
+    return {'operations': len(ordered), 'succeeded': succeeded, 'failed': len(ordered) - succeeded,
+            'elapsed': elapsed, 'ops_per_s': len(ordered) / elapsed if elapsed else 0.0}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description="Digital Time Capsule without the menus.")
+    parser.add_argument('--profile', help="AWS profile to use")
+    parser.add_argument('--region', help="AWS region to use")
+    parser.add_argument('--username', default=os.environ.get('TIMECAPSULE_USER'),
+                        help="owner recorded on launched instances")
+    groups = parser.add_subparsers(dest='group', required=True)
+
+    s3 = groups.add_parser('s3').add_subparsers(dest='command', required=True)
+    command = s3.add_parser('mb', help="create a bucket")
+    command.add_argument('bucket')
+    command.set_defaults(op='s3.mb', fields=('bucket',))
+    command = s3.add_parser('ls', help="list buckets, or the objects in one")
+    command.add_argument('bucket', nargs='?')
+    command.add_argument('prefix', nargs='?', default='')
+    command.add_argument('--recursive', action='store_true')
+    command.set_defaults(op='s3.ls', fields=('bucket', 'prefix', 'recursive'))
+    for action, text in (('cp', "upload or download one file, or copy within S3"),
+                         ('mv', "move objects within S3")):
+        command = s3.add_parser(action, help=text)
+        command.add_argument('source')
+        command.add_argument('destination')
+        command.add_argument('--storage-class', choices=copy_manager.STORAGE_CLASSES,
+                             help="storage class for S3 to S3 copies")
+        command.add_argument('--recursive', action='store_true', help="copy every key under the source prefix")
+        command.set_defaults(op=f"s3.{action}", fields=('source', 'destination', 'storage_class', 'recursive'))
+    command = s3.add_parser('sync', help="upload new and changed files from a directory")
+    command.add_argument('source')
+    command.add_argument('destination')
+    command.set_defaults(op='s3.sync', fields=('source', 'destination'))
+    command = s3.add_parser('rm', help="delete an object, or a whole prefix with --recursive")
+    command.add_argument('target')
+    command.add_argument('--recursive', action='store_true')
+    command.set_defaults(op='s3.rm', fields=('target', 'recursive'))
+
+    ec2 = groups.add_parser('ec2').add_subparsers(dest='command', required=True)
+    command = ec2.add_parser('launch', help="launch capsule instances")
+    command.add_argument('name')
+    command.add_argument('--count', type=int, default=1)
+    command.add_argument('--no-wait', dest='wait', action='store_false')
+    command.set_defaults(op='ec2.launch', fields=('name', 'count', 'wait'))
+    for action in ('start', 'stop'):
+        command = ec2.add_parser(action, help=f"{action} instances")
+        command.add_argument('instance_ids', nargs='+')
+        command.add_argument('--no-wait', dest='wait', action='store_false')
+        command.set_defaults(op=f"ec2.{action}", fields=('instance_ids', 'wait'))
+
+    iam = groups.add_parser('iam').add_subparsers(dest='command', required=True)
+    command = iam.add_parser('register', help="create a capsule user with keys and policies")
+    command.add_argument('username')
+    command.set_defaults(op='iam.register', fields=('username',))
+    for action, text in (('provision', "create many capsule users, resuming from the journal"),
+                         ('teardown', "delete users with their keys and policies")):
+        command = iam.add_parser(action, help=text)
+        command.add_argument('users', nargs='*')
+        command.add_argument('--users-file', help="file with one username per line")
+        command.add_argument('--journal', help="state journal to resume from")
+        command.add_argument('--workers', type=int)
+        command.set_defaults(op=f"iam.{action}", fields=('users', 'users_file', 'journal', 'workers'))
+
+    batch = groups.add_parser('batch', help="run a JSON or YAML job file")
+    batch.add_argument('job_file')
+    batch.add_argument('--workers', type=int)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    emit = JsonLines(sys.stdout)
+    session = boto3.session.Session(profile_name=args.profile, region_name=args.region)
+    ctx = AppContext(session, args.username)
+
+    # The managers print progress for the menus, keep that off the JSON stream.
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.group == 'batch':
+                job = load_job_file(args.job_file)
+                workers = args.workers or job.get('workers') or DEFAULT_WORKERS
+                summary = run_batch(ctx, job.get('operations') or [], emit, workers)
+                emit(status='done', **summary)
+                return 0 if not summary['failed'] else 1
+            step = {'id': args.op, 'op': args.op, 'args': {field: getattr(args, field) for field in args.fields}}
+            return 0 if execute(ctx, step, emit) else 1
+    except (OSError, RuntimeError, ValueError) as e:
+        emit(status='error', error=str(e))
+        return 2
+    finally:
+        ctx.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
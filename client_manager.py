@@ -0,0 +1,90 @@
+import threading
+
+import boto3
+from botocore.config import Config
+
+import retry_manager
+import trace_manager
+
+# One pooled client per (session, service, region, config) for the whole process.
+# boto3 clients are thread-safe, so the same client can be shared by every menu
+# action and worker thread instead of reloading service models on each call.
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_TCP_KEEPALIVE = True
+
+_clients = {}
+_lock = threading.Lock()
+_default_session = None
+_settings = {
+    'max_pool_connections': DEFAULT_MAX_POOL_CONNECTIONS,
+    'tcp_keepalive': DEFAULT_TCP_KEEPALIVE,
+    # retry_manager does the retrying, botocore only makes the single attempt.
+    'retries': {'total_max_attempts': 1, 'mode': 'standard'},
+}
+
+
+def configure(max_pool_connections=None, tcp_keepalive=None):
+    # Only affects clients created after the call, existing ones keep their pool.
+    if max_pool_connections is not None:
+        _settings['max_pool_connections'] = int(max_pool_connections)
+    if tcp_keepalive is not None:
+        _settings['tcp_keepalive'] = bool(tcp_keepalive)
+
+
+def _get_default_session():
+    global _default_session
+    if _default_session is None:
+        _default_session = boto3.session.Session()
+    return _default_session
+
+
+def _config_key(config_options):
+    options = dict(_settings)
+    options.update(config_options or {})
+    return tuple(sorted((name, repr(value)) for name, value in options.items())), options
+
+
+def get_client(service, session=None, region=None, **config_options):
+    if session is None:
+        session = _get_default_session()
+    if region is None:
+        region = session.region_name
+
+    config_key, options = _config_key(config_options)
+    key = (session, service, region, config_key)
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = session.client(service, region_name=region, config=Config(**options))
+            client = trace_manager.install(retry_manager.install(client))
+            _clients[key] = client
+    return client
+
+
+def clear_clients():
+    with _lock:
+        _clients.clear()
+
+
+def reset():
+    # Also forgets the default session, whose credentials and event handlers
+    # were fixed when it was created (for example before moto started).
+    global _default_session
+    with _lock:
+        _clients.clear()
+        _default_session = None
+
+
+def clients():
+    with _lock:
+        return list(_clients.values())
+
+
+def client_count():
+    return len(_clients)
@@ -0,0 +1,295 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import botocore
+
+import S3_manager
+import delete_manager
+import index_manager
+import transfer_manager
+
+# Server-side copy, move and storage-class migration. Keys stream from the
+# paginated listing into a bounded pool and S3 copies the bytes itself, so
+# nothing passes through this machine: copy_object up to 5 GB, and above that a
+# multipart upload whose parts are upload_part_copy ranges of the source, sent
+# side by side. A move deletes each source key once its copy has landed, through
+# delete_manager's batched deletes running alongside the copies.
+
+MB = transfer_manager.MB
+GB = 1024 * MB
+COPY_OBJECT_LIMIT = 5 * GB
+
+DEFAULT_COPY_SETTINGS = {
+    'copy_workers': 16,
+    'copy_part_size': 512 * MB,
+    'copy_part_workers': 8,
+    # Objects at or above this use multipart copy. copy_object refuses anything
+    # over 5 GB, so it can be lowered but not raised past that.
+    'copy_threshold': COPY_OBJECT_LIMIT,
+}
+
+STORAGE_CLASSES = ('STANDARD', 'STANDARD_IA', 'ONEZONE_IA', 'INTELLIGENT_TIERING', 'GLACIER_IR', 'GLACIER',
+                   'DEEP_ARCHIVE')
+
+# Headers a metadata rewrite has to carry over, because MetadataDirective=REPLACE
+# resets everything it is not given.
+CARRIED_HEADERS = ('ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage', 'CacheControl')
+
+
+def copy_settings(ctx, **overrides):
+    settings = dict(DEFAULT_COPY_SETTINGS)
+    settings.update({name: value for name, value in ctx.settings.items() if name in settings})
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    settings['copy_threshold'] = min(settings['copy_threshold'], COPY_OBJECT_LIMIT)
+    return settings
+
+
+class Changes:
+    # What a copy rewrites on the way. None leaves that part as the source has it.
+    def __init__(self, storage_class=None, metadata=None, tags=None):
+        if storage_class is not None and storage_class not in STORAGE_CLASSES:
+            raise ValueError(f"Unknown storage class {storage_class}, use one of {', '.join(STORAGE_CLASSES)}.")
+        self.storage_class = storage_class
+        self.metadata = metadata
+        self.tags = tags
+
+    def rewrites_object(self):
+        return self.storage_class is not None or self.metadata is not None
+
+
+def merged_headers(head, changes):
+    # Content headers and user metadata of the source, with the requested
+    # metadata merged over it.
+    headers = {name: head[name] for name in CARRIED_HEADERS if head.get(name)}
+    headers['Metadata'] = dict(head.get('Metadata', {}), **(changes.metadata or {}))
+    return headers
+
+
+def _head_headers(s3, bucket_name, key, changes):
+    return merged_headers(s3.head_object(Bucket=bucket_name, Key=key), changes)
+
+
+def _source_tags(s3, bucket_name, key):
+    tag_set = s3.get_object_tagging(Bucket=bucket_name, Key=key)['TagSet']
+    return {tag['Key']: tag['Value'] for tag in tag_set}
+
+
+def copy_object_params(source, record, destination_bucket, destination_key, changes, headers=None):
+    # headers are the merged_headers() of the source, needed only for a metadata rewrite.
+    params = {'Bucket': destination_bucket, 'Key': destination_key,
+              'CopySource': {'Bucket': source, 'Key': record.key}}
+    if record.etag:
+        # The copy fails rather than picking up a version written after the listing.
+        params['CopySourceIfMatch'] = f'"{record.etag}"'
+    if changes.storage_class:
+        params['StorageClass'] = changes.storage_class
+    if headers is not None:
+        params.update(headers, MetadataDirective='REPLACE')
+    if changes.tags is not None:
+        params.update(Tagging=urlencode(changes.tags), TaggingDirective='REPLACE')
+    return params
+
+
+def multipart_params(destination_bucket, destination_key, changes, headers, tags):
+    # create_multipart_upload starts from nothing, so headers, metadata and tags
+    # come from the source unless they are being replaced.
+    params = {'Bucket': destination_bucket, 'Key': destination_key, **headers}
+    if changes.storage_class:
+        params['StorageClass'] = changes.storage_class
+    if tags:
+        params['Tagging'] = urlencode(tags)
+    return params
+
+
+def part_ranges(size, part_size):
+    # (part number, first byte, last byte) for each upload_part_copy.
+    return [(number, first, min(first + part_size, size) - 1)
+            for number, first in enumerate(range(0, size, part_size), 1)]
+
+
+def copy_small(s3, source, record, destination_bucket, destination_key, changes):
+    headers = _head_headers(s3, source, record.key, changes) if changes.metadata is not None else None
+    s3.copy_object(**copy_object_params(source, record, destination_bucket, destination_key, changes, headers))
+
+
+def copy_large(s3, settings, parts, source, record, destination_bucket, destination_key, changes):
+    tags = changes.tags if changes.tags is not None else _source_tags(s3, source, record.key)
+    params = multipart_params(destination_bucket, destination_key, changes,
+                              _head_headers(s3, source, record.key, changes), tags)
+    upload_id = s3.create_multipart_upload(**params)['UploadId']
+    futures = []
+
+    def copy_part(number, first, last):
+        response = s3.upload_part_copy(Bucket=destination_bucket, Key=destination_key, UploadId=upload_id,
+                                       PartNumber=number, CopySource={'Bucket': source, 'Key': record.key},
+                                       CopySourceRange=f"bytes={first}-{last}",
+                                       CopySourceIfMatch=f'"{record.etag}"')
+        return {'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+
+    try:
+        part_size = transfer_manager.choose_part_size(record.size, settings['copy_part_size'])
+        futures = [parts.submit(copy_part, *part) for part in part_ranges(record.size, part_size)]
+        completed = [future.result() for future in futures]
+        s3.complete_multipart_upload(Bucket=destination_bucket, Key=destination_key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': completed})
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        s3.abort_multipart_upload(Bucket=destination_bucket, Key=destination_key, UploadId=upload_id)
+        raise
+
+
+def tag_set(tags):
+    return {'TagSet': [{'Key': name, 'Value': value} for name, value in tags.items()]}
+
+
+def copies_in_place(source, record, destination_bucket, destination_key, changes):
+    # Copying an object onto itself is only allowed when the object changes,
+    # and new tags alone do not need a copy.
+    return source == destination_bucket and record.key == destination_key and not changes.rewrites_object()
+
+
+def copy_one(s3, settings, parts, source, record, destination_bucket, destination_key, changes):
+    if copies_in_place(source, record, destination_bucket, destination_key, changes):
+        s3.put_object_tagging(Bucket=source, Key=record.key, Tagging=tag_set(changes.tags))
+        return 0
+    if record.size >= settings['copy_threshold']:
+        copy_large(s3, settings, parts, source, record, destination_bucket, destination_key, changes)
+    else:
+        copy_small(s3, source, record, destination_bucket, destination_key, changes)
+    return record.size
+
+
+def indexed_copy(record, destination_key, changes):
+    # The copy's ETag is not the source's once S3 rewrites it, so it is left for the next sync.
+    return index_manager.written_row(destination_key, record.size, None,
+                                     changes.storage_class or record.storage_class)
+
+
+def destination_key(key, prefix, destination_prefix):
+    return f"{destination_prefix}{key[len(prefix):]}"
+
+
+def check_locations(bucket_name, prefix, destination_bucket, destination_prefix, changes, move, listing=True):
+    if bucket_name != destination_bucket or prefix != destination_prefix:
+        if listing and bucket_name == destination_bucket and destination_prefix.startswith(prefix):
+            # The listing would run into the copies and copy them again.
+            raise ValueError(f"Cannot copy {prefix or 'the bucket root'} into {destination_prefix}, "
+                             f"which is inside it.")
+        return
+    if move:
+        raise ValueError("Moving objects onto themselves would delete them.")
+    if not changes.rewrites_object() and changes.tags is None:
+        raise ValueError("Copying objects onto themselves needs a storage class, metadata or tags to change.")
+
+
+def _deleter(ctx, bucket_name, moved, workers, result):
+    # Runs delete_manager over the keys whose copy has landed, as they arrive.
+    # Anything unexpected is handed back to copy_prefix to raise.
+    try:
+        result.update(delete_manager.delete_objects(ctx, bucket_name, iter(moved.get, None), workers))
+    except Exception as e:
+        result['error'] = e
+
+
+def copy_prefix(ctx, bucket_name, prefix, destination_bucket, destination_prefix=None, storage_class=None,
+                metadata=None, tags=None, move=False, workers=None, **overrides):
+    settings = copy_settings(ctx, **overrides)
+    workers = workers or settings['copy_workers']
+    destination_prefix = prefix if destination_prefix is None else destination_prefix
+    changes = Changes(storage_class, metadata, tags)
+    check_locations(bucket_name, prefix, destination_bucket, destination_prefix, changes, move)
+    if transfer_manager.transfer_settings(ctx)['transfer_backend'] == 'async':
+        import async_manager
+        return async_manager.copy_prefix(ctx, bucket_name, prefix, destination_bucket, destination_prefix,
+                                         storage_class, metadata, tags, move, concurrency=workers, **overrides)
+
+    s3 = ctx.client('s3')
+    result = {'copied': 0, 'failed': [], 'bytes': 0, 'multipart': 0}
+    indexed = index_manager.has_index(ctx, destination_bucket)
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+    moved = queue.Queue()
+    deleted = {}
+    deleter = None
+    if move:
+        deleter = threading.Thread(target=_deleter, name='copy-move-delete',
+                                   args=(ctx, bucket_name, moved, delete_manager.DEFAULT_DELETE_WORKERS, deleted))
+        deleter.start()
+
+    def copy_record(parts, record):
+        target = destination_key(record.key, prefix, destination_prefix)
+        try:
+            copied = copy_one(s3, settings, parts, bucket_name, record, destination_bucket, target, changes)
+            if indexed:
+                ctx.index.upsert(destination_bucket, [indexed_copy(record, target, changes)])
+            with lock:
+                result['copied'] += 1
+                result['bytes'] += copied
+                result['multipart'] += record.size >= settings['copy_threshold']
+            if move:
+                moved.put({'Key': record.key})
+        except botocore.exceptions.ClientError as e:
+            with lock:
+                result['failed'].append((record.key, e.response['Error']['Code']))
+        except botocore.exceptions.BotoCoreError as e:
+            # Connection errors that outlived the retries.
+            with lock:
+                result['failed'].append((record.key, type(e).__name__))
+        finally:
+            slots.release()
+
+    unexpected = transfer_manager.WorkerErrors()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=settings['copy_part_workers']) as parts, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix, use_cache=False):
+                slots.acquire()
+                pool.submit(copy_record, parts, record).add_done_callback(unexpected)
+    finally:
+        if deleter is not None:
+            moved.put(None)
+            deleter.join()
+    elapsed = time.perf_counter() - start
+    unexpected.check()
+    if 'error' in deleted:
+        raise deleted['error']
+    ctx.cache.invalidate('objects', destination_bucket)
+    if move and destination_bucket != bucket_name:
+        ctx.cache.invalidate('objects', bucket_name)
+
+    if move:
+        result['deleted'] = deleted.get('deleted', 0)
+        result['failed'].extend(deleted.get('failed', []))
+    result['elapsed'] = elapsed
+    result['objects_per_s'] = result['copied'] / elapsed if elapsed else 0.0
+    # Every copied byte stayed inside S3, so this is also what the client saved.
+    result['bytes_per_s'] = result['bytes'] / elapsed if elapsed else 0.0
+    return result
+
+
+def copy_object(ctx, bucket_name, key, destination_bucket, destination_key, storage_class=None, metadata=None,
+                tags=None, move=False, **overrides):
+    settings = copy_settings(ctx, **overrides)
+    changes = Changes(storage_class, metadata, tags)
+    check_locations(bucket_name, key, destination_bucket, destination_key, changes, move, listing=False)
+    s3 = ctx.client('s3')
+    head = s3.head_object(Bucket=bucket_name, Key=key)
+    record = S3_manager.ObjectRecord(key, head['ContentLength'], head['ETag'].strip('"'), head.get('LastModified'),
+                                     head.get('StorageClass'), False)
+    with ThreadPoolExecutor(max_workers=settings['copy_part_workers']) as parts:
+        copied = copy_one(s3, settings, parts, bucket_name, record, destination_bucket, destination_key, changes)
+    if move:
+        s3.delete_object(Bucket=bucket_name, Key=key)
+    ctx.cache.invalidate('objects', destination_bucket)
+    if move and destination_bucket != bucket_name:
+        ctx.cache.invalidate('objects', bucket_name)
+    if index_manager.has_index(ctx, destination_bucket):
+        ctx.index.upsert(destination_bucket, [indexed_copy(record, destination_key, changes)])
+    if move and index_manager.has_index(ctx, bucket_name):
+        ctx.index.remove(bucket_name, [key])
+    return {'Bucket': destination_bucket, 'Key': destination_key, 'Size': copied}
@@ -0,0 +1,160 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import botocore
+
+import S3_manager
+import index_manager
+import retry_manager
+import transfer_manager
+
+# Bulk deletion: keys (or versions) stream from the paginator into 1,000-key
+# delete_objects batches that run concurrently, retrying per-key failures.
+
+BATCH_SIZE = 1000
+DEFAULT_DELETE_WORKERS = 8
+MAX_ATTEMPTS = 5
+
+
+def batched(items, size=BATCH_SIZE):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_keys(ctx, bucket_name, prefix=''):
+    for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix, use_cache=False):
+        yield {'Key': record.key}
+
+
+def iter_versions(ctx, bucket_name, prefix=''):
+    # Versioned buckets keep every old version and delete marker, all of which
+    # have to go before the bucket can be deleted.
+    paginator = ctx.client('s3').get_paginator('list_object_versions')
+    params = {'Bucket': bucket_name}
+    if prefix:
+        params['Prefix'] = prefix
+    for page in paginator.paginate(**params):
+        for version in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            yield {'Key': version['Key'], 'VersionId': version['VersionId']}
+
+
+def is_versioned(ctx, bucket_name):
+    status = ctx.client('s3').get_bucket_versioning(Bucket=bucket_name).get('Status')
+    return status in ('Enabled', 'Suspended')
+
+
+def sort_errors(errors):
+    # Splits a delete_objects Errors list into targets worth retrying and
+    # (key, code) failures.
+    retry, failed = [], []
+    for error in errors:
+        target = {'Key': error['Key']}
+        if error.get('VersionId'):
+            target['VersionId'] = error['VersionId']
+        if retry_manager.classify_code(error.get('Code')) != 'fatal':
+            retry.append(target)
+        else:
+            failed.append((error['Key'], error.get('Code')))
+    return retry, failed
+
+
+def delete_batch(s3, bucket_name, objects, sleep=time.sleep):
+    pending = objects
+    failed = []
+    for attempt in range(MAX_ATTEMPTS):
+        response = s3.delete_objects(Bucket=bucket_name, Delete={'Objects': pending, 'Quiet': True})
+        errors = response.get('Errors', [])
+        if not errors:
+            return len(objects) - len(failed), failed
+
+        retry, fatal = sort_errors(errors)
+        failed.extend(fatal)
+        if not retry:
+            break
+        pending = retry
+        sleep(retry_manager.backoff_delay(attempt))
+    else:
+        failed.extend((target['Key'], 'RetriesExhausted') for target in pending)
+
+    return len(objects) - len(failed), failed
+
+
+def delete_objects(ctx, bucket_name, objects, workers=DEFAULT_DELETE_WORKERS):
+    s3 = ctx.client('s3')
+    result = {'deleted': 0, 'failed': []}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+    indexed = index_manager.has_index(ctx, bucket_name)
+
+    def run_batch(batch):
+        try:
+            deleted, failed = delete_batch(s3, bucket_name, batch)
+        except botocore.exceptions.ClientError as e:
+            deleted, failed = 0, [(target['Key'], e.response['Error']['Code']) for target in batch]
+        except botocore.exceptions.BotoCoreError as e:
+            # Connection errors that outlived the retries fail the whole batch.
+            deleted, failed = 0, [(target['Key'], type(e).__name__) for target in batch]
+        finally:
+            slots.release()
+        if indexed and deleted:
+            kept = {key for key, _ in failed}
+            ctx.index.remove(bucket_name, [target['Key'] for target in batch if target['Key'] not in kept])
+        with lock:
+            result['deleted'] += deleted
+            result['failed'].extend(failed)
+
+    unexpected = transfer_manager.WorkerErrors()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batched(objects):
+            slots.acquire()
+            pool.submit(run_batch, batch).add_done_callback(unexpected)
+    elapsed = time.perf_counter() - start
+    unexpected.check()
+    ctx.cache.invalidate('objects', bucket_name)
+
+    result['elapsed'] = elapsed
+    result['objects_per_s'] = result['deleted'] / elapsed if elapsed else 0.0
+    return result
+
+
+def delete_prefix(ctx, bucket_name, prefix, workers=DEFAULT_DELETE_WORKERS):
+    if transfer_manager.transfer_settings(ctx)['transfer_backend'] == 'async':
+        import async_manager
+        return async_manager.delete_prefix(ctx, bucket_name, prefix, concurrency=workers)
+    return delete_objects(ctx, bucket_name, iter_keys(ctx, bucket_name, prefix), workers)
+
+
+def abort_multipart_uploads(ctx, bucket_name):
+    s3 = ctx.client('s3')
+    aborted = 0
+    for page in s3.get_paginator('list_multipart_uploads').paginate(Bucket=bucket_name):
+        for upload in page.get('Uploads', []):
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+            aborted += 1
+    return aborted
+
+
+def empty_bucket(ctx, bucket_name, workers=DEFAULT_DELETE_WORKERS):
+    if is_versioned(ctx, bucket_name):
+        objects = iter_versions(ctx, bucket_name)
+    else:
+        objects = iter_keys(ctx, bucket_name)
+    result = delete_objects(ctx, bucket_name, objects, workers)
+    result['aborted_uploads'] = abort_multipart_uploads(ctx, bucket_name)
+    return result
+
+
+def empty_and_delete_bucket(ctx, bucket_name, workers=DEFAULT_DELETE_WORKERS):
+    result = empty_bucket(ctx, bucket_name, workers)
+    if not result['failed']:
+        ctx.client('s3').delete_bucket(Bucket=bucket_name)
+        ctx.cache.invalidate('buckets')
+    result['bucket_deleted'] = not result['failed']
+    return result
@@ -0,0 +1,249 @@
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import unquote
+
+import S3_manager
+
+# Local SQLite index of capsule bucket keys. It is filled from a paginated
+# listing or from an S3 Inventory report, and answers prefix, size and date
+# queries without any API calls. Uploads, copies and deletes made through this
+# app update it as they go, so it only drifts from changes made elsewhere.
+
+INSERT_BATCH = 5000
+DEFAULT_INDEX_PATH = 'timecapsule_index.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified REAL,
+    storage_class TEXT,
+    generation INTEGER NOT NULL,
+    PRIMARY KEY (bucket, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS objects_by_size ON objects (bucket, size);
+CREATE INDEX IF NOT EXISTS objects_by_modified ON objects (bucket, last_modified);
+CREATE TABLE IF NOT EXISTS syncs (
+    bucket TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    source TEXT NOT NULL,
+    objects INTEGER NOT NULL
+);
+"""
+
+
+def prefix_upper_bound(prefix):
+    # Every key starting with prefix sorts before this, so a prefix search is a
+    # range scan over the primary key.
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+def to_timestamp(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+
+class KeyIndex:
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # Queries are lazy, so each reading thread gets its own connection
+        # rather than holding a cursor on the shared one while others write.
+        # WAL lets them read alongside the writer.
+        self.local = threading.local()
+        self.readers = []
+
+    def close(self):
+        with self.lock:
+            for reader in self.readers:
+                reader.close()
+            self.readers = []
+            self.db.close()
+
+    def _reader(self):
+        reader = getattr(self.local, 'db', None)
+        if reader is None:
+            reader = self.local.db = sqlite3.connect(self.path, check_same_thread=False)
+            with self.lock:
+                self.readers.append(reader)
+        return reader
+
+    def last_sync(self, bucket_name):
+        with self.lock:
+            row = self.db.execute("SELECT synced_at, source, objects FROM syncs WHERE bucket = ?",
+                                  (bucket_name,)).fetchone()
+        if row is None:
+            return None
+        return {'synced_at': row[0], 'source': row[1], 'objects': row[2]}
+
+    def _next_generation(self, bucket_name):
+        row = self.db.execute("SELECT generation FROM syncs WHERE bucket = ?", (bucket_name,)).fetchone()
+        return (row[0] if row else 0) + 1
+
+    def ingest(self, bucket_name, rows, source, prefix=''):
+        # rows are (key, size, etag, last_modified, storage_class). Keys that were
+        # not seen in this pass (within the prefix) are pruned afterwards, so a
+        # re-sync also picks up deletions.
+        start = time.perf_counter()
+        count = 0
+        with self.lock:
+            try:
+                generation = self._next_generation(bucket_name)
+                batch = []
+                for key, size, etag, last_modified, storage_class in rows:
+                    batch.append((bucket_name, key, size, etag, to_timestamp(last_modified), storage_class,
+                                  generation))
+                    if len(batch) >= INSERT_BATCH:
+                        self._write(batch)
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    self._write(batch)
+                    count += len(batch)
+
+                where, params = self._prefix_clause(bucket_name, prefix)
+                self.db.execute(f"DELETE FROM objects WHERE {where} AND generation < ?", params + [generation])
+                total = self.db.execute("SELECT COUNT(*) FROM objects WHERE bucket = ?",
+                                        (bucket_name,)).fetchone()[0]
+                self.db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?)",
+                                (bucket_name, generation, time.time(), source, total))
+                self.db.commit()
+            except BaseException:
+                # The rows come from a network listing, which can fail partway.
+                # Without this the next unrelated commit would keep half a sync.
+                self.db.rollback()
+                raise
+
+        elapsed = time.perf_counter() - start
+        return {'objects': count, 'elapsed': elapsed, 'objects_per_s': count / elapsed if elapsed else 0.0}
+
+    def upsert(self, bucket_name, rows):
+        # Same rows as ingest, for objects written since the last sync. They join
+        # the current generation, so the next sync keeps or prunes them as usual.
+        with self.lock:
+            row = self.db.execute("SELECT generation FROM syncs WHERE bucket = ?", (bucket_name,)).fetchone()
+            generation = row[0] if row else 0
+            self._write([(bucket_name, key, size, etag, to_timestamp(last_modified), storage_class, generation)
+                         for key, size, etag, last_modified, storage_class in rows])
+            self.db.commit()
+
+    def remove(self, bucket_name, keys):
+        with self.lock:
+            self.db.executemany("DELETE FROM objects WHERE bucket = ? AND key = ?", [(bucket_name, key) for key in keys])
+            self.db.commit()
+
+    def _write(self, batch):
+        self.db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+
+    def _prefix_clause(self, bucket_name, prefix):
+        if not prefix:
+            return "bucket = ?", [bucket_name]
+        return "bucket = ? AND key >= ? AND key < ?", [bucket_name, prefix, prefix_upper_bound(prefix)]
+
+    def query(self, bucket_name, prefix='', min_size=None, max_size=None, modified_after=None,
+              modified_before=None, order='key', limit=None):
+        where, params = self._prefix_clause(bucket_name, prefix)
+        if min_size is not None:
+            where += " AND size >= ?"
+            params.append(min_size)
+        if max_size is not None:
+            where += " AND size <= ?"
+            params.append(max_size)
+        if modified_after is not None:
+            where += " AND last_modified >= ?"
+            params.append(to_timestamp(modified_after))
+        if modified_before is not None:
+            where += " AND last_modified < ?"
+            params.append(to_timestamp(modified_before))
+
+        order_by = {'key': 'key', 'size': 'size DESC', 'modified': 'last_modified DESC'}[order]
+        sql = f"SELECT key, size, etag, last_modified, storage_class FROM objects WHERE {where} ORDER BY {order_by}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        for key, size, etag, last_modified, storage_class in self._reader().execute(sql, params):
+            modified = datetime.fromtimestamp(last_modified, timezone.utc) if last_modified is not None else None
+            yield S3_manager.ObjectRecord(key, size, etag, modified, storage_class, False)
+
+
+def index_path(ctx):
+    return ctx.settings.get('index_path') or DEFAULT_INDEX_PATH
+
+
+def has_index(ctx, bucket_name):
+    # Avoids creating an empty index file just to find out nothing was synced.
+    return os.path.exists(index_path(ctx)) and ctx.index.last_sync(bucket_name) is not None
+
+
+def written_row(key, size, etag=None, storage_class=None):
+    # An index row for an object this app has just written.
+    return key, size, etag, datetime.now(timezone.utc), storage_class or 'STANDARD'
+
+
+def listing_rows(ctx, bucket_name, prefix=''):
+    for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix, use_cache=False):
+        if not record.is_prefix:
+            yield record.key, record.size, record.etag, record.last_modified, record.storage_class
+
+
+def sync_from_listing(ctx, bucket_name, prefix=''):
+    return ctx.index.ingest(bucket_name, listing_rows(ctx, bucket_name, prefix), 'listing', prefix)
+
+
+def inventory_rows(ctx, manifest, bucket_name):
+    s3 = ctx.client('s3')
+    destination = manifest['destinationBucket'].split(':::')[-1]
+    file_format = manifest['fileFormat'].upper()
+    columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+
+    for inventory_file in manifest['files']:
+        body = s3.get_object(Bucket=destination, Key=inventory_file['key'])['Body']
+        if file_format == 'CSV':
+            reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding='utf-8'))
+            records = (dict(zip(columns, row)) for row in reader)
+        elif file_format == 'PARQUET':
+            records = parquet_records(body)
+        else:
+            raise ValueError(f"Unsupported inventory format {manifest['fileFormat']}.")
+
+        for record in records:
+            if record.get('Bucket', bucket_name) != bucket_name:
+                continue
+            # Inventory CSV keys are URL-encoded.
+            key = unquote(record['Key']) if file_format == 'CSV' else record['Key']
+            yield (key, int(record.get('Size') or 0), (record.get('ETag') or '').strip('"'),
+                   record.get('LastModifiedDate'), record.get('StorageClass'))
+
+
+def parquet_records(body):
+    try:
+        import pyarrow.parquet as parquet
+    except ImportError:
+        raise RuntimeError("Parquet inventory reports need the pyarrow package installed.") from None
+    table = parquet.read_table(io.BytesIO(body.read()))
+    for batch in table.to_batches():
+        yield from batch.to_pylist()
+
+
+def sync_from_inventory(ctx, manifest_bucket, manifest_key, bucket_name):
+    body = ctx.client('s3').get_object(Bucket=manifest_bucket, Key=manifest_key)['Body']
+    manifest = json.load(body)
+    return ctx.index.ingest(bucket_name, inventory_rows(ctx, manifest, bucket_name), 'inventory')
@@ -0,0 +1,265 @@
+import itertools
+import threading
+import time
+
+import botocore
+
+import EC2_manager
+
+# Background jobs for EC2 state transitions. Actions return a Job straight away
+# and one shared poller thread checks every pending instance of every job with a
+# single batched describe call per tick, backing off while nothing changes.
+
+MIN_DELAY = 2
+MAX_DELAY = 15
+JOB_TIMEOUT = 900
+# A describe call fails as a whole when one ID in it is unknown. Those IDs are
+# isolated so the rest of the batch still gets its answer. New instances can be
+# briefly unknown, so NotFound only fails an instance after a grace period.
+NOT_FOUND_GRACE = 60
+MALFORMED = 'InvalidInstanceID.Malformed'
+NOT_FOUND = 'InvalidInstanceID.NotFound'
+
+
+class RealClock:
+    def __init__(self):
+        self.wakeup = threading.Event()
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        # Returns early when new work arrives so fresh jobs get polled promptly.
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def wake(self):
+        self.wakeup.set()
+
+
+class SleepClock:
+    # Tells the time by adding up what it slept, so a caller that passes in its
+    # own sleep function (as tests and benchmarks do) also controls timeouts.
+    def __init__(self, sleep=time.sleep):
+        self.elapsed = 0.0
+        self._sleep = sleep
+
+    def now(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self._sleep(seconds)
+        self.elapsed += seconds
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, action, instance_ids, target, failed_states=(), started=0.0, timeout=JOB_TIMEOUT, settle=0):
+        self.id = next(self._ids)
+        self.action = action
+        self.instance_ids = list(instance_ids)
+        self.target = target
+        self.failed_states = set(failed_states)
+        self.started = started
+        # Reboots report ok until they actually go down, so give them time first.
+        self.not_before = started + settle
+        self.deadline = started + timeout
+        self.finished = None
+        self.results = {}
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def pending(self):
+        with self.lock:
+            return [instance_id for instance_id in self.instance_ids if instance_id not in self.results]
+
+    def snapshot(self):
+        # The poller thread records results while the menu reads them.
+        with self.lock:
+            return dict(self.results)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def record(self, instance_id, state, ok, error=None, at=None):
+        result = {'state': state, 'ok': ok}
+        if error:
+            result['error'] = error
+        if at is not None:
+            result['at'] = at
+        with self.lock:
+            self.results[instance_id] = result
+
+    def finish(self, now):
+        self.finished = now
+        self._done.set()
+        # Callbacks run on the poller thread, so one that fails must not take the
+        # poller, and every other job with it, down.
+        for callback in self.callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"\n[Job {self.id}: follow-up after {self.action} failed: {e}]")
+
+    def progress(self):
+        finished = len(self.snapshot())
+        status = 'done' if self.done else 'running'
+        return f"Job {self.id}: {self.action} {finished}/{len(self.instance_ids)} instances ({status})"
+
+
+def describe_isolating(describe, ec2, instance_ids):
+    # Returns (states, unknown) where unknown maps IDs EC2 rejected to the error
+    # code. A rejected batch is split in half until the bad IDs are on their own.
+    try:
+        return describe(ec2, instance_ids), {}
+    except botocore.exceptions.ClientError as e:
+        code = e.response['Error']['Code']
+        if code not in (NOT_FOUND, MALFORMED):
+            raise
+        if len(instance_ids) == 1:
+            return {}, {instance_ids[0]: code}
+    middle = len(instance_ids) // 2
+    states, unknown = describe_isolating(describe, ec2, instance_ids[:middle])
+    more_states, more_unknown = describe_isolating(describe, ec2, instance_ids[middle:])
+    states.update(more_states)
+    unknown.update(more_unknown)
+    return states, unknown
+
+
+class InstancePoller:
+    def __init__(self, ec2, clock=None, min_delay=MIN_DELAY, max_delay=MAX_DELAY):
+        self.ec2 = ec2
+        self.clock = clock or RealClock()
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, job):
+        with self.lock:
+            self.jobs.append(job)
+            self.delay = self.min_delay
+        if hasattr(self.clock, 'wake'):
+            self.clock.wake()
+        return job
+
+    def active_jobs(self):
+        with self.lock:
+            return [job for job in self.jobs if not job.done]
+
+    def due_jobs(self):
+        now = self.clock.now()
+        return [job for job in self.active_jobs() if now >= job.not_before]
+
+    def tick(self):
+        # Polls every pending instance of every active job once. Returns True when
+        # anything changed so the caller can reset its backoff.
+        jobs = self.due_jobs()
+        if not jobs:
+            return False
+
+        by_kind = {'state': set(), 'ok': set()}
+        for job in jobs:
+            kind = 'ok' if job.target == 'ok' else 'state'
+            by_kind[kind].update(job.pending)
+
+        seen = {'state': {}, 'ok': {}}
+        unknown = {}
+        for kind, describe in (('state', EC2_manager.describe_states), ('ok', EC2_manager.describe_status)):
+            if not by_kind[kind]:
+                continue
+            try:
+                seen[kind], missing = describe_isolating(describe, self.ec2, sorted(by_kind[kind]))
+                unknown.update(missing)
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError):
+                # Throttling, connection errors and the like count as a missed
+                # tick, this kind is asked again next time.
+                pass
+
+        now = self.clock.now()
+        changed = False
+        for job in jobs:
+            states = seen['ok' if job.target == 'ok' else 'state']
+            for instance_id in job.pending:
+                state = states.get(instance_id)
+                code = unknown.get(instance_id)
+                if code == MALFORMED or (code == NOT_FOUND and now - job.started >= NOT_FOUND_GRACE):
+                    job.record(instance_id, None, False, f"instance is unknown to EC2 ({code})", at=now)
+                    changed = True
+                elif state == job.target:
+                    job.record(instance_id, state, True, at=now)
+                    changed = True
+                elif state in job.failed_states:
+                    job.record(instance_id, state, False, f"instance is {state}", at=now)
+                    changed = True
+                elif now >= job.deadline:
+                    job.record(instance_id, state, False, 'timed out waiting')
+                    changed = True
+            if not job.pending:
+                job.finish(now)
+        return changed
+
+    def run_once(self):
+        changed = self.tick()
+        # Adaptive backoff: poll quickly while things move, slow down while idle.
+        self.delay = self.min_delay if changed else min(self.delay * 2, self.max_delay)
+        self.clock.sleep(self.delay)
+
+    def run(self):
+        while True:
+            if self.active_jobs():
+                self.run_once()
+            else:
+                self.clock.sleep(self.max_delay)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='instance-poller', daemon=True)
+            self.thread.start()
+
+
+class JobManager:
+    def __init__(self, ctx, clock=None, start_thread=True):
+        self.ctx = ctx
+        self.poller = InstancePoller(ctx.client('ec2'), clock)
+        self.start_thread = start_thread
+        self.jobs = []
+
+    def submit(self, action, instance_ids, target, failed_states=(), results=None, notify=True, settle=0, started=None):
+        if started is None:
+            started = self.poller.clock.now()
+        job = Job(action, instance_ids, target, failed_states, started=started, settle=settle)
+        for instance_id, result in (results or {}).items():
+            job.record(instance_id, result['state'], result['ok'], result.get('error'))
+        # Instance states changed, so cached listings are stale once the job ends.
+        job.callbacks.append(lambda finished: self.ctx.cache.invalidate('instances'))
+        if notify:
+            job.callbacks.append(lambda finished: print(f"\n[{finished.progress()}]"))
+        self.jobs.append(job)
+
+        if not job.pending:
+            job.finish(job.started)
+            return job
+        self.poller.submit(job)
+        if self.start_thread:
+            self.poller.start()
+        return job
+
+    def show(self):
+        if not self.jobs:
+            print("No background jobs yet.")
+            return
+        for job in self.jobs:
+            print(job.progress())
+            for instance_id, result in job.snapshot().items():
+                detail = result['state'] if result['ok'] else f"failed ({result.get('error')})"
+                print(f"  {instance_id}: {detail}")
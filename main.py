@@ -1,7 +1,7 @@
 import sys
-import EC2_manager
-import S3_manager
-import IAM_manager
+
+# Service modules pull in boto3 and botocore, so they are imported where they
+# are first needed and the login menu appears without waiting for them.
 
 
 def login_menu():
@@ -28,18 +28,28 @@ def login_menu():
             sys.exit()
         else:
             print("Invalid option. Choose an integer 1-3. ")
-            return 
+            continue
         
 
 def handle_login():
+    import IAM_manager
+    import auth_manager
+
     session = IAM_manager.login()  # login() returns session or None
     if session:
-        username = input("Please enter your username for verification: ").strip()
-        return username, session
+        # login() already resolved the caller, so this comes from the cache.
+        identity = auth_manager.caller_identity(session)
+        if identity.username is None:
+            identity = identity._replace(username=input("Please enter your username for verification: ").strip())
+        print(f"Logged in as {identity.username}")
+        return identity, session
     print("Login failed. Try again.")
     return None, None
 
 def register_login():
+    import IAM_manager
+    import auth_manager
+
     username = IAM_manager.register_user()  # returns username or None
     if username:
         access_key, secret_key = IAM_manager.create_access_keys(username)
@@ -47,7 +57,7 @@ def register_login():
             session = IAM_manager.create_user_session(access_key, secret_key)
             if session:
                 IAM_manager.attach_policies(username)
-                return username, session
+                return auth_manager.registered_identity(username), session
     print("Registration failed. Try again.")
     return None, None
 
@@ -55,7 +65,7 @@ def register_login():
 
 ####
 
-def main_menu():
+def main_menu(ctx):
     while True:
         print("\n DIGITAL TIME CAPSULE MENU")
         print("1. EC2 Menu")
@@ -70,10 +80,12 @@ def main_menu():
             continue
 
         if choice == 1:
-            EC2_manager.ec2_menu()
+            import EC2_manager
+            EC2_manager.ec2_menu(ctx)
         
         elif choice == 2:
-            S3_manager.s3_menu()
+            import S3_manager
+            S3_manager.s3_menu(ctx)
         
         elif choice == 3:
             print("Logging out...")
@@ -81,12 +93,17 @@ def main_menu():
         
         elif choice == 4:
             print("Goodbye")
-            break
+            sys.exit()
         else:
             print("Invalid choice please select a number between 1 and 4.")
 
 if __name__ == "__main__":
     while True:
-        username, session = login_menu()
+        identity, session = login_menu()
         if session:
-            main_menu(session, username)
+            from app_context import AppContext
+            ctx = AppContext(session, identity=identity)
+            try:
+                main_menu(ctx)
+            finally:
+                ctx.close()
@@ -0,0 +1,339 @@
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+
+import S3_manager
+import index_manager
+import transfer_manager
+
+# Capsule packing: files are cut into content-defined chunks, each chunk is
+# stored once under its SHA-256 in the bucket's chunk store, and a small JSON
+# manifest per capsule lists the chunks needed to rebuild it. Every stage is a
+# generator over one chunk at a time, so whole files are never held in memory.
+
+KB = 1024
+MB = 1024 * KB
+MANIFEST_SUFFIX = '.tcpack'
+MANIFEST_FORMAT = 1
+# Stored raw when compression saves less than this fraction of the chunk.
+MIN_SAVING = 0.03
+
+DEFAULT_PACK_SETTINGS = {
+    'chunk_min_size': 256 * KB,
+    'chunk_avg_size': 1 * MB,
+    'chunk_max_size': 4 * MB,
+    'pack_codec': None,
+    'pack_level': 3,
+    'chunk_prefix': '.chunks/',
+    'pack_workers': 8,
+}
+
+# Gear table for the rolling hash, derived from a fixed seed so chunk
+# boundaries are the same on every machine.
+GEAR = [int.from_bytes(hashlib.sha256(b'timecapsule-gear-%d' % n).digest()[:8], 'big') for n in range(256)]
+
+
+def pack_settings(ctx, **overrides):
+    settings = dict(DEFAULT_PACK_SETTINGS)
+    settings.update({name: value for name, value in ctx.settings.items() if name in settings})
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    if not settings['pack_codec']:
+        settings['pack_codec'] = 'zstd' if zstd_available() else 'gzip'
+    return settings
+
+
+def zstd_available():
+    return importlib.util.find_spec('zstandard') is not None
+
+
+def load_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd chunks need the zstandard package installed.") from None
+    return zstandard
+
+
+def compress(data, codec, level):
+    if codec == 'zstd':
+        return load_zstd().ZstdCompressor(level=level).compress(data)
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    raise ValueError(f"Unknown pack codec {codec}.")
+
+
+def decompressor(codec):
+    if codec == 'zstd':
+        return load_zstd().ZstdDecompressor().decompressobj()
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    if codec == 'raw':
+        return None
+    raise ValueError(f"Unknown pack codec {codec}.")
+
+
+def masks(avg_size):
+    # FastCDC normalised chunking: a stricter mask before the average size and a
+    # looser one after it pulls chunk sizes towards the average.
+    bits = max(avg_size.bit_length() - 1, 3)
+    return (1 << (bits + 2)) - 1, (1 << (bits - 2)) - 1
+
+
+def find_cut(data, min_size, avg_size, max_size):
+    length = len(data)
+    if length <= min_size:
+        return length
+    end = min(length, max_size)
+    normal = min(end, avg_size)
+    mask_strict, mask_loose = masks(avg_size)
+    gear = GEAR
+    # Shifting right keeps the fingerprint within 65 bits without masking, and
+    # the low bits checked below cover the last 64 bytes.
+    fingerprint = 0
+
+    view = memoryview(data)
+    for offset, byte in enumerate(view[min_size:normal], min_size):
+        fingerprint = (fingerprint >> 1) + gear[byte]
+        if not fingerprint & mask_strict:
+            return offset + 1
+    for offset, byte in enumerate(view[normal:end], normal):
+        fingerprint = (fingerprint >> 1) + gear[byte]
+        if not fingerprint & mask_loose:
+            return offset + 1
+    return end
+
+
+def iter_chunks(source, settings):
+    # Boundaries depend only on nearby content, so an insertion near the start of
+    # a file only changes the chunks around it and the rest still deduplicate.
+    min_size, avg_size, max_size = settings['chunk_min_size'], settings['chunk_avg_size'], settings['chunk_max_size']
+    buffer = b''
+    at_end = False
+    while True:
+        while not at_end and len(buffer) < max_size:
+            block = source.read(max_size)
+            if block:
+                buffer += block
+            else:
+                at_end = True
+        if not buffer:
+            return
+        cut = find_cut(buffer, min_size, avg_size, max_size)
+        yield buffer[:cut]
+        buffer = buffer[cut:]
+
+
+def hash_chunks(chunks, file_hash):
+    for chunk in chunks:
+        file_hash.update(chunk)
+        yield hashlib.sha256(chunk).hexdigest(), chunk
+
+
+def new_chunks(hashed, known, entries, stats):
+    # Records every chunk in the manifest but only passes on chunks the store
+    # has not seen, including repeats inside the same file.
+    for digest, chunk in hashed:
+        entries.append((digest, len(chunk)))
+        stats['size'] += len(chunk)
+        if digest in known:
+            stats['dedup_bytes'] += len(chunk)
+            continue
+        known[digest] = None
+        yield digest, chunk
+
+
+def compress_chunks(chunks, codec, level):
+    for digest, chunk in chunks:
+        payload = compress(chunk, codec, level)
+        if len(payload) > len(chunk) * (1 - MIN_SAVING):
+            yield digest, 'raw', chunk, len(chunk)
+        else:
+            yield digest, codec, payload, len(chunk)
+
+
+def chunk_key(settings, digest, codec):
+    return f"{settings['chunk_prefix']}{digest[:2]}/{digest}.{codec}"
+
+
+def known_chunks(ctx, bucket_name, settings):
+    # One paginated listing of the chunk store, mapping digest -> stored key.
+    known = {}
+    prefix = settings['chunk_prefix']
+    for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix, use_cache=False):
+        if record.is_prefix:
+            continue
+        digest = record.key.rsplit('/', 1)[-1].split('.')[0]
+        known[digest] = record.key
+    return known
+
+
+def manifest_key_for(key):
+    return key if key.endswith(MANIFEST_SUFFIX) else f"{key}{MANIFEST_SUFFIX}"
+
+
+def pack_file(ctx, file_path, bucket_name, key, known=None, progress=None, **overrides):
+    settings = pack_settings(ctx, **overrides)
+    s3 = ctx.client('s3')
+    if known is None:
+        known = known_chunks(ctx, bucket_name, settings)
+
+    entries = []
+    stats = {'size': 0, 'dedup_bytes': 0, 'new_chunks': 0, 'new_bytes': 0, 'stored_bytes': 0}
+    lock = threading.Lock()
+    failed = []
+    stored = []
+    workers = settings['pack_workers']
+    slots = threading.BoundedSemaphore(workers * 2)
+    file_hash = hashlib.sha256()
+
+    def store(digest, codec, payload, raw_size):
+        object_key = chunk_key(settings, digest, codec)
+        try:
+            s3.put_object(Bucket=bucket_name, Key=object_key, Body=payload)
+            with lock:
+                known[digest] = object_key
+                stats['new_chunks'] += 1
+                stats['new_bytes'] += raw_size
+                stats['stored_bytes'] += len(payload)
+                stored.append(index_manager.written_row(object_key, len(payload)))
+                if progress:
+                    progress(stats['dedup_bytes'] + stats['new_bytes'], file_size)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            with lock:
+                known.pop(digest, None)
+                failed.append(e)
+        finally:
+            slots.release()
+
+    file_size = os.path.getsize(file_path)
+    unexpected = transfer_manager.WorkerErrors()
+    start = time.perf_counter()
+    with open(file_path, 'rb') as source, ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = iter_chunks(source, settings)
+        pipeline = compress_chunks(new_chunks(hash_chunks(chunks, file_hash), known, entries, stats),
+                                   settings['pack_codec'], settings['pack_level'])
+        for item in pipeline:
+            slots.acquire()
+            pool.submit(store, *item).add_done_callback(unexpected)
+    # Chunks that made it are indexed even if the pack fails, a rerun reuses them.
+    indexed = index_manager.has_index(ctx, bucket_name)
+    if indexed and stored:
+        ctx.index.upsert(bucket_name, stored)
+    unexpected.check()
+    if failed:
+        raise failed[0]
+    # A chunk without a stored key would make the capsule impossible to unpack.
+    missing = {digest for digest, _ in entries if known.get(digest) is None}
+    if missing:
+        raise RuntimeError(f"{len(missing)} chunks of {file_path} were not stored, the manifest was not written.")
+
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'name': os.path.basename(file_path),
+        'size': stats['size'],
+        'sha256': file_hash.hexdigest(),
+        'chunks': [[known[digest], size] for digest, size in entries],
+    }
+    manifest_key = manifest_key_for(key)
+    body = json.dumps(manifest).encode()
+    s3.put_object(Bucket=bucket_name, Key=manifest_key, Body=body, ContentType='application/json')
+    ctx.cache.invalidate('objects', bucket_name)
+    if indexed:
+        ctx.index.upsert(bucket_name, [index_manager.written_row(manifest_key, len(body))])
+    if progress:
+        progress(file_size, file_size)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'Bucket': bucket_name,
+        'Key': manifest_key,
+        'Size': stats['size'],
+        'Chunks': len(entries),
+        'NewChunks': stats['new_chunks'],
+        'NewBytes': stats['new_bytes'],
+        'StoredBytes': stats['stored_bytes'],
+        'DedupBytes': stats['dedup_bytes'],
+        'elapsed': elapsed,
+        'bytes_per_s': stats['size'] / elapsed if elapsed else 0.0,
+    }
+
+
+def load_manifest(ctx, bucket_name, manifest_key):
+    body = ctx.client('s3').get_object(Bucket=bucket_name, Key=manifest_key)['Body']
+    manifest = json.load(body)
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError(f"{manifest_key} is not a capsule pack manifest this version can read.")
+    return manifest
+
+
+def fetch_chunk(s3, bucket_name, object_key, size):
+    codec = object_key.rsplit('.', 1)[-1]
+    body = s3.get_object(Bucket=bucket_name, Key=object_key)['Body']
+    inflater = decompressor(codec)
+    parts = []
+    for block in body.iter_chunks(MB):
+        parts.append(inflater.decompress(block) if inflater else block)
+    data = b''.join(parts)
+    if len(data) != size:
+        raise ValueError(f"Chunk {object_key} is {len(data)} bytes, the manifest expects {size}.")
+    return data
+
+
+def unpack(ctx, bucket_name, manifest_key, local_path, progress=None, **overrides):
+    # Chunks are fetched a few at a time ahead of the writer and written in order,
+    # so memory stays at a handful of chunks whatever the capsule size.
+    settings = pack_settings(ctx, **overrides)
+    s3 = ctx.client('s3')
+    manifest = load_manifest(ctx, bucket_name, manifest_key)
+    workers = settings['pack_workers']
+    file_hash = hashlib.sha256()
+    written = 0
+
+    start = time.perf_counter()
+    tmp_path = f"{local_path}.part"
+    try:
+        with open(tmp_path, 'wb') as target, ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+
+            def write_next():
+                nonlocal written
+                data = pending.popleft().result()
+                target.write(data)
+                file_hash.update(data)
+                written += len(data)
+                if progress:
+                    progress(written, manifest['size'])
+
+            try:
+                for object_key, size in manifest['chunks']:
+                    pending.append(pool.submit(fetch_chunk, s3, bucket_name, object_key, size))
+                    if len(pending) >= workers:
+                        write_next()
+                while pending:
+                    write_next()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+        if file_hash.hexdigest() != manifest['sha256']:
+            raise ValueError(f"Unpacked {manifest_key} does not match its checksum.")
+    except BaseException:
+        # A partial file is never left behind, whatever stopped the unpack.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, local_path)
+
+    elapsed = time.perf_counter() - start
+    return {'Size': written, 'Chunks': len(manifest['chunks']), 'elapsed': elapsed,
+            'bytes_per_s': written / elapsed if elapsed else 0.0}
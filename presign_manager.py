@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from urllib.parse import quote
+
+import S3_manager
+
+# Presigned S3 links so capsules can be shared with people who have no AWS
+# credentials. URLs are signed locally with SigV4 query authentication from the
+# context's frozen credentials. The derived signing key only changes per
+# day/region/service, so it is cached and each URL costs a couple of HMACs.
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+MAX_EXPIRES = 7 * 24 * 3600
+DEFAULT_EXPIRES = 3600
+DEFAULT_MAX_UPLOAD_SIZE = 5 * 1024 * 1024 * 1024
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=64)
+def signing_key(secret_key, datestamp, region, service='s3'):
+    date_key = _hmac(f"AWS4{secret_key}".encode(), datestamp)
+    return _hmac(_hmac(_hmac(date_key, region), service), 'aws4_request')
+
+
+def _encode(value):
+    return quote(str(value), safe='-_.~')
+
+
+def s3_host(bucket_name, region):
+    # Dotted bucket names do not match the wildcard certificate, so they go
+    # path-style. Everything else uses the virtual-hosted form.
+    endpoint = 's3.amazonaws.com' if region == 'us-east-1' else f"s3.{region}.amazonaws.com"
+    if '.' in bucket_name:
+        return endpoint, f"/{bucket_name}/"
+    return f"{bucket_name}.{endpoint}", '/'
+
+
+def check_expires(expires):
+    if not 0 < expires <= MAX_EXPIRES:
+        raise ValueError(f"Presigned links can last between 1 second and {MAX_EXPIRES // 86400} days.")
+
+
+class UrlSigner:
+    # Holds everything that is the same for a batch of URLs: credentials, region
+    # and the signing timestamp, so only the per-key work is left in sign().
+    def __init__(self, credentials, region, expires=DEFAULT_EXPIRES, now=None):
+        check_expires(expires)
+        if credentials is None:
+            raise ValueError("No AWS credentials are available to sign links with.")
+        now = now or datetime.now(timezone.utc)
+        self.region = region
+        self.expires = expires
+        self.amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        datestamp = now.strftime('%Y%m%d')
+        self.scope = f"{datestamp}/{region}/s3/aws4_request"
+        self.key = signing_key(credentials.secret_key, datestamp, region)
+        self.base_query = {
+            'X-Amz-Algorithm': ALGORITHM,
+            'X-Amz-Credential': f"{credentials.access_key}/{self.scope}",
+            'X-Amz-Date': self.amz_date,
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        if credentials.token:
+            self.base_query['X-Amz-Security-Token'] = credentials.token
+
+    def sign(self, bucket_name, key, method='GET', params=None):
+        host, path_prefix = s3_host(bucket_name, self.region)
+        path = path_prefix + quote(key, safe='/~')
+        query = dict(self.base_query)
+        query.update(params or {})
+        canonical_query = '&'.join(f"{_encode(name)}={_encode(value)}" for name, value in sorted(query.items()))
+
+        canonical_request = f"{method}\n{path}\n{canonical_query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+        string_to_sign = (f"{ALGORITHM}\n{self.amz_date}\n{self.scope}\n"
+                          f"{hashlib.sha256(canonical_request.encode()).hexdigest()}")
+        signature = hmac.new(self.key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return f"https://{host}{path}?{canonical_query}&X-Amz-Signature={signature}"
+
+
+def presign_url(ctx, bucket_name, key, method='GET', expires=DEFAULT_EXPIRES, download_name=None):
+    params = {}
+    if download_name and method == 'GET':
+        params['response-content-disposition'] = f'attachment; filename="{download_name}"'
+    return UrlSigner(ctx.credentials, ctx.region, expires).sign(bucket_name, key, method, params)
+
+
+def presign_prefix(ctx, bucket_name, prefix, method='GET', expires=DEFAULT_EXPIRES):
+    # Keys stream from the paginator and are signed as they arrive, all with one
+    # timestamp and one signing key.
+    signer = UrlSigner(ctx.credentials, ctx.region, expires)
+    for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix):
+        if not record.is_prefix:
+            yield record.key, signer.sign(bucket_name, record.key, method)
+
+
+def capsule_bucket(ctx):
+    return f"timecapsule-{ctx.username}"
+
+
+def presigned_post(ctx, bucket_name=None, key_prefix='', expires=DEFAULT_EXPIRES,
+                   max_size=DEFAULT_MAX_UPLOAD_SIZE, now=None):
+    # A browser form posts straight to S3 with these fields, so uploads never
+    # pass through this machine. The policy pins the bucket, the key prefix and
+    # the size limit. Uploads go to the user's own capsule bucket by default.
+    check_expires(expires)
+    if ctx.credentials is None:
+        raise ValueError("No AWS credentials are available to sign links with.")
+    bucket_name = bucket_name or capsule_bucket(ctx)
+    now = now or datetime.now(timezone.utc)
+    datestamp = now.strftime('%Y%m%d')
+    credential = f"{ctx.credentials.access_key}/{datestamp}/{ctx.region}/s3/aws4_request"
+
+    fields = {
+        'key': f"{key_prefix}${{filename}}",
+        'x-amz-algorithm': ALGORITHM,
+        'x-amz-credential': credential,
+        'x-amz-date': now.strftime('%Y%m%dT%H%M%SZ'),
+    }
+    if ctx.credentials.token:
+        fields['x-amz-security-token'] = ctx.credentials.token
+
+    conditions = [{'bucket': bucket_name}, ['starts-with', '$key', key_prefix], ['content-length-range', 0, max_size]]
+    conditions.extend({name: value} for name, value in fields.items() if name != 'key')
+    policy = {
+        'expiration': (now + timedelta(seconds=expires)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'conditions': conditions,
+    }
+    fields['policy'] = base64.b64encode(json.dumps(policy).encode()).decode()
+    key = signing_key(ctx.credentials.secret_key, datestamp, ctx.region)
+    fields['x-amz-signature'] = hmac.new(key, fields['policy'].encode(), hashlib.sha256).hexdigest()
+
+    host, path = s3_host(bucket_name, ctx.region)
+    return {'url': f"https://{host}{path}", 'fields': fields}
@@ -0,0 +1,247 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import botocore
+
+import IAM_manager
+import auth_manager
+import retry_manager
+
+# Bulk onboarding and offboarding of capsule users. Each user goes through
+# create user -> put both inline policies -> create access key, users run side
+# by side on a bounded pool, and every IAM call goes through the shared 'iam'
+# rate limiter in retry_manager. Finished steps are appended to a local journal,
+# so a rerun after a crash or a throttling storm skips everything already done.
+
+DEFAULT_PROVISION_SETTINGS = {
+    'provision_journal': 'timecapsule_provision.jsonl',
+    'provision_workers': 8,
+    # IAM is eventually consistent: a user created a moment ago can still be
+    # NoSuchEntity to the next call, so dependent steps wait and retry.
+    'consistency_attempts': 6,
+}
+
+
+def provision_settings(ctx, **overrides):
+    settings = dict(DEFAULT_PROVISION_SETTINGS)
+    settings.update({name: value for name, value in ctx.settings.items() if name in settings})
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    return settings
+
+
+def error_code(error):
+    return error.response.get('Error', {}).get('Code')
+
+
+class Journal:
+    # Append-only JSON lines, one per finished step, replayed on open. The key
+    # step holds the secret key, so the file is created readable by its owner only.
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self.lock = threading.Lock()
+        torn = False
+        if os.path.exists(path):
+            with open(path) as existing:
+                for line in existing:
+                    torn = not line.endswith('\n')
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        continue  # half-written last line from an interrupted run
+        self.stream = os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a')
+        if torn:
+            self.stream.write('\n')
+
+    def _apply(self, entry):
+        if entry['step'] == 'deleted':
+            self.state.pop(entry['user'], None)
+        else:
+            self.state.setdefault(entry['user'], {})[entry['step']] = entry.get('data', {})
+
+    def get(self, username, step):
+        # The step's recorded data, or None if it has not finished yet.
+        with self.lock:
+            return self.state.get(username, {}).get(step)
+
+    def record(self, username, step, **data):
+        entry = {'user': username, 'step': step, 'at': time.time(), 'data': data}
+        with self.lock:
+            self.stream.write(json.dumps(entry) + '\n')
+            self.stream.flush()
+            self._apply(entry)
+
+    def created_users(self):
+        # Users this journal created, not ones that already existed and were adopted.
+        with self.lock:
+            return [username for username, steps in self.state.items() if steps.get('user', {}).get('created')]
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+def _when_visible(settings, call, **kwargs):
+    for attempt in range(settings['consistency_attempts']):
+        try:
+            return call(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if error_code(e) != 'NoSuchEntity' or attempt + 1 == settings['consistency_attempts']:
+                raise
+            time.sleep(retry_manager.backoff_delay(attempt + 1))
+
+
+def _create_key(iam, settings, journal, username):
+    # A key created right before a crash never reached the journal and its
+    # secret is gone. 'key_started' marks that this may have happened, and then
+    # leftovers on a user this run created are replaced. Users that already
+    # existed keep their keys.
+    if journal.get(username, 'key_started') is not None and journal.get(username, 'user').get('created'):
+        existing = _when_visible(settings, iam.list_access_keys, UserName=username)['AccessKeyMetadata']
+        for key in existing:
+            iam.delete_access_key(UserName=username, AccessKeyId=key['AccessKeyId'])
+    journal.record(username, 'key_started')
+    key = _when_visible(settings, iam.create_access_key, UserName=username)['AccessKey']
+    return {'AccessKeyId': key['AccessKeyId'], 'SecretAccessKey': key['SecretAccessKey']}
+
+
+def put_policies(iam, settings, username):
+    # put_user_policy overwrites, so repeating it after a partial run is safe.
+    for policy_name, document in IAM_manager.user_policies(username).items():
+        _when_visible(settings, iam.put_user_policy, UserName=username, PolicyName=policy_name,
+                      PolicyDocument=json.dumps(document))
+
+
+def register_user(ctx, username, **overrides):
+    # A single new user through the context's own session. Unlike provision_user
+    # an existing name is an error (EntityAlreadyExists), never adopted.
+    settings = provision_settings(ctx, **overrides)
+    iam = ctx.client('iam')
+    iam.create_user(UserName=username)
+    put_policies(iam, settings, username)
+    auth_manager.remember_capsule_user(username)
+    key = _when_visible(settings, iam.create_access_key, UserName=username)['AccessKey']
+    return {'AccessKeyId': key['AccessKeyId'], 'SecretAccessKey': key['SecretAccessKey']}
+
+
+def provision_user(iam, settings, journal, username):
+    if journal.get(username, 'user') is None:
+        try:
+            iam.create_user(UserName=username)
+            created = True
+        except botocore.exceptions.ClientError as e:
+            if error_code(e) != 'EntityAlreadyExists':
+                raise
+            created = False
+        journal.record(username, 'user', created=created)
+
+    if journal.get(username, 'policies') is None:
+        put_policies(iam, settings, username)
+        journal.record(username, 'policies')
+        # Adopted users may have other policies too, so only new ones get the local check.
+        if journal.get(username, 'user').get('created'):
+            auth_manager.remember_capsule_user(username)
+
+    key = journal.get(username, 'key')
+    if key is None:
+        key = _create_key(iam, settings, journal, username)
+        journal.record(username, 'key', **key)
+    return key
+
+
+def _run(usernames, work, workers, progress):
+    # Shared driver: one task per user, failures are collected per user so one
+    # bad name does not stop the rest of the cohort.
+    usernames = list(dict.fromkeys(usernames))
+    results, errors = {}, {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(work, username): username for username in usernames}
+        for done, future in enumerate(as_completed(futures), 1):
+            username = futures[future]
+            try:
+                results[username] = future.result()
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                errors[username] = str(e)
+            if progress:
+                progress(done, len(usernames))
+    elapsed = time.perf_counter() - start
+    return results, {'users': len(usernames), 'succeeded': len(results), 'failed': len(errors),
+                     'errors': errors, 'elapsed': elapsed,
+                     'users_per_s': len(usernames) / elapsed if elapsed else 0.0}
+
+
+def provision_users(ctx, usernames, progress=None, **overrides):
+    settings = provision_settings(ctx, **overrides)
+    iam = ctx.client('iam')
+    journal = Journal(settings['provision_journal'])
+    try:
+        keys, summary = _run(usernames, lambda username: provision_user(iam, settings, journal, username),
+                             settings['provision_workers'], progress)
+    finally:
+        journal.close()
+    summary['keys'] = keys
+    return summary
+
+
+def _ignore_missing(call, **kwargs):
+    try:
+        call(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        if error_code(e) != 'NoSuchEntity':
+            raise
+
+
+def teardown_user(iam, journal, parts, username):
+    # Keys and policies are independent of each other, so they are removed side
+    # by side on the parts pool and the user goes once they are all gone.
+    try:
+        keys = iam.list_access_keys(UserName=username)['AccessKeyMetadata']
+        inline = iam.list_user_policies(UserName=username)['PolicyNames']
+        attached = iam.list_attached_user_policies(UserName=username)['AttachedPolicies']
+    except botocore.exceptions.ClientError as e:
+        if error_code(e) != 'NoSuchEntity':
+            raise
+        auth_manager.forget_capsule_user(username)
+        journal.record(username, 'deleted')
+        return 'missing'
+
+    futures = [parts.submit(_ignore_missing, iam.delete_access_key, UserName=username, AccessKeyId=key['AccessKeyId'])
+               for key in keys]
+    futures += [parts.submit(_ignore_missing, iam.delete_user_policy, UserName=username, PolicyName=policy_name)
+                for policy_name in inline]
+    futures += [parts.submit(_ignore_missing, iam.detach_user_policy, UserName=username, PolicyArn=policy['PolicyArn'])
+                for policy in attached]
+    for future in futures:
+        future.result()
+    _ignore_missing(iam.delete_user, UserName=username)
+    auth_manager.forget_capsule_user(username)
+    journal.record(username, 'deleted')
+    return 'deleted'
+
+
+def teardown_users(ctx, usernames=None, progress=None, **overrides):
+    # Without a list, every user the journal created and has not deleted yet is
+    # torn down. Users that existed before provisioning are only removed by name.
+    settings = provision_settings(ctx, **overrides)
+    iam = ctx.client('iam')
+    journal = Journal(settings['provision_journal'])
+    workers = settings['provision_workers']
+    try:
+        with ThreadPoolExecutor(max_workers=workers * 2) as parts:
+            outcomes, summary = _run(usernames if usernames is not None else journal.created_users(),
+                                     lambda username: teardown_user(iam, journal, parts, username),
+                                     workers, progress)
+    finally:
+        journal.close()
+    summary['missing'] = sum(1 for outcome in outcomes.values() if outcome == 'missing')
+    return summary
+
+
+def read_user_list(path):
+    # One username per line, blank lines and # comments skipped.
+    with open(path) as source:
+        return [line.strip() for line in source if line.strip() and not line.lstrip().startswith('#')]
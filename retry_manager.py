@@ -0,0 +1,250 @@
+import asyncio
+import random
+import threading
+import time
+
+import botocore
+
+# Shared resilience layer for every client handed out by client_manager. Each
+# HTTP attempt first takes a token from the rate limiter for its service or API,
+# and botocore's own retry handler is replaced by one that classifies the error,
+# backs off with full jitter and slows the limiter down when AWS throttles us.
+
+THROTTLE_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+    'BandwidthLimitExceeded', 'EC2ThrottledException', 'ProvisionedThroughputExceededException',
+}
+TRANSIENT_CODES = {
+    'RequestTimeout', 'RequestTimeoutException', 'PriorRequestNotComplete', 'InternalError',
+    'InternalFailure', 'ServiceUnavailable', 'Unavailable', 'OperationAborted', 'IDPCommunicationError',
+}
+TRANSIENT_STATUS = {500, 502, 503, 504}
+TRANSIENT_EXCEPTIONS = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 20.0
+# Requests per second, per service or per 'service.Operation'. S3 scales per
+# prefix on its own, so it is only limited when configured.
+DEFAULT_RATE_LIMITS = {
+    'ec2': 50,
+    'ec2.RunInstances': 2,
+    'iam': 10,
+    'sts': 10,
+}
+# Adaptive limiting: cut the rate when throttled (at most once per window, as a
+# burst of throttles is one signal), then win it back a little every second.
+THROTTLE_FACTOR = 0.7
+THROTTLE_WINDOW = 0.5
+RECOVERY_PER_SECOND = 0.1
+# Burst allowance as a fraction of a second's worth of requests.
+BURST_SECONDS = 0.1
+MIN_RATE_FACTOR = 0.05
+
+_settings = {
+    'max_attempts': DEFAULT_MAX_ATTEMPTS,
+    'base_delay': DEFAULT_BASE_DELAY,
+    'max_delay': DEFAULT_MAX_DELAY,
+    'rate_limits': dict(DEFAULT_RATE_LIMITS),
+}
+_limiters = {}
+_metrics = {}
+_lock = threading.Lock()
+COUNTERS = ('attempts', 'retries', 'throttles', 'transient', 'fatal', 'gave_up', 'backoff_seconds', 'limited_seconds')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate * BURST_SECONDS, 1))
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.last_throttle = None
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + elapsed * self.max_rate * RECOVERY_PER_SECOND)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token, possibly from the future, and returns how long to wait
+        # before using it. Reservations queue up behind each other at exactly
+        # the current rate.
+        with self.lock:
+            self._refill(self.clock())
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            if self.last_throttle is not None and now - self.last_throttle < THROTTLE_WINDOW:
+                return
+            self.last_throttle = now
+            self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate * THROTTLE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+
+
+def configure(max_attempts=None, base_delay=None, max_delay=None, rate_limits=None):
+    # Like client_manager.configure this is process-wide. New limits replace the
+    # existing limiters, so they apply to clients that already exist too.
+    if max_attempts is not None:
+        _settings['max_attempts'] = int(max_attempts)
+    if base_delay is not None:
+        _settings['base_delay'] = float(base_delay)
+    if max_delay is not None:
+        _settings['max_delay'] = float(max_delay)
+    if rate_limits is not None:
+        _settings['rate_limits'] = dict(DEFAULT_RATE_LIMITS, **rate_limits)
+        with _lock:
+            _limiters.clear()
+
+
+def limiter_for(service, operation):
+    # An operation with its own limit gets its own bucket, the rest share the
+    # service bucket. Returns None when neither is limited.
+    limits = _settings['rate_limits']
+    name = f"{service}.{operation}"
+    if limits.get(name) is None:
+        name = service
+    rate = limits.get(name)
+    if rate is None:
+        return None
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.setdefault(name, TokenBucket(rate))
+    return limiter
+
+
+def _count(service, **amounts):
+    with _lock:
+        counters = _metrics.setdefault(service, dict.fromkeys(COUNTERS, 0))
+        for name, amount in amounts.items():
+            counters[name] += amount
+
+
+def metrics():
+    with _lock:
+        return {service: dict(counters) for service, counters in _metrics.items()}
+
+
+def reset_metrics():
+    with _lock:
+        _metrics.clear()
+
+
+def classify_code(code, status=None):
+    if code in THROTTLE_CODES or status == 429:
+        return 'throttle'
+    if code in TRANSIENT_CODES or status in TRANSIENT_STATUS:
+        return 'transient'
+    return 'fatal'
+
+
+def classify(response=None, caught_exception=None):
+    # Returns None for a success, otherwise 'throttle', 'transient' or 'fatal'.
+    if caught_exception is not None:
+        return 'transient' if isinstance(caught_exception, TRANSIENT_EXCEPTIONS) else 'fatal'
+    if response is None:
+        return None
+    http_response, parsed = response
+    code = (parsed or {}).get('Error', {}).get('Code')
+    if code is None and http_response.status_code < 300:
+        return None
+    return classify_code(code, http_response.status_code)
+
+
+def backoff_delay(attempt):
+    # Full jitter: anywhere between zero and the exponential ceiling.
+    return random.uniform(0, min(_settings['max_delay'], _settings['base_delay'] * 2 ** attempt))
+
+
+def _split_event(event_name):
+    parts = event_name.split('.')
+    return parts[1], parts[2] if len(parts) > 2 else ''
+
+
+def _before_send(event_name=None, **kwargs):
+    service, operation = _split_event(event_name)
+    limiter = limiter_for(service, operation)
+    waited = limiter.acquire() if limiter else 0.0
+    _count(service, attempts=1, limited_seconds=waited)
+
+
+async def _before_send_async(event_name=None, **kwargs):
+    # aiobotocore awaits handlers, so the wait yields to the event loop instead
+    # of blocking it.
+    service, operation = _split_event(event_name)
+    limiter = limiter_for(service, operation)
+    waited = limiter.reserve() if limiter else 0.0
+    if waited:
+        await asyncio.sleep(waited)
+    _count(service, attempts=1, limited_seconds=waited)
+
+
+def _needs_retry(response=None, attempts=None, caught_exception=None, event_name=None, **kwargs):
+    service, operation = _split_event(event_name)
+    kind = classify(response, caught_exception)
+    if kind is None:
+        return None
+    if kind == 'fatal':
+        _count(service, fatal=1)
+        return None
+
+    if kind == 'throttle':
+        _count(service, throttles=1)
+        limiter = limiter_for(service, operation)
+        if limiter:
+            limiter.throttled()
+    else:
+        _count(service, transient=1)
+    if attempts >= _settings['max_attempts']:
+        _count(service, gave_up=1)
+        return None
+
+    delay = backoff_delay(attempts)
+    _count(service, retries=1, backoff_seconds=delay)
+    return delay
+
+
+def install(client):
+    # botocore's own retries are switched off in client_manager, this takes over.
+    events = client.meta.events
+    service = client.meta.service_model.service_id.hyphenize()
+    events.register(f"before-send.{service}", _before_send, unique_id='timecapsule-rate-limit')
+    events.register(f"needs-retry.{service}", _needs_retry, unique_id='timecapsule-retry')
+    return client
+
+
+def install_async(client):
+    # For aiobotocore clients, which also need botocore's retries switched off.
+    # _needs_retry only returns the delay, which aiobotocore sleeps without blocking.
+    events = client.meta.events
+    service = client.meta.service_model.service_id.hyphenize()
+    events.register(f"before-send.{service}", _before_send_async, unique_id='timecapsule-rate-limit')
+    events.register(f"needs-retry.{service}", _needs_retry, unique_id='timecapsule-retry')
+    return client
+
+
+def format_metrics():
+    lines = []
+    for service, counters in sorted(metrics().items()):
+        lines.append(f"{service}: {counters['attempts']} requests, {counters['retries']} retries, "
+                     f"{counters['throttles']} throttled, {counters['backoff_seconds']:.1f}s backing off, "
+                     f"{counters['limited_seconds']:.1f}s rate limited")
+    return "\n".join(lines)
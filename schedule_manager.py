@@ -0,0 +1,276 @@
+import heapq
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import botocore
+
+# Capsule unlock scheduling. Sealed capsules carry their unlock date as object
+# tags, and a local SQLite table is the durable copy the scheduler reloads on
+# start. Pending capsules sit in a heap ordered by due time, so the next due one
+# is always at the top and each release or reschedule costs O(log n).
+
+UNLOCK_TAG = 'timecapsule-unlock-at'
+STATE_TAG = 'timecapsule-state'
+DEFAULT_SCHEDULE_PATH = 'timecapsule_schedule.db'
+MAX_IDLE = 60
+
+DEFAULT_SCHEDULE_SETTINGS = {
+    'schedule_path': DEFAULT_SCHEDULE_PATH,
+    'release_mode': 'copy',
+    'release_prefix': 'unlocked/',
+    'release_batch': 100,
+    'release_workers': 16,
+    'presign_expiry': 7 * 24 * 3600,
+    'retry_delay': 300,
+    'max_release_attempts': 5,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS capsules (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    unlock_at REAL NOT NULL,
+    due_at REAL NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    released_at REAL,
+    location TEXT,
+    error TEXT,
+    PRIMARY KEY (bucket, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS capsules_by_state ON capsules (state, due_at);
+"""
+
+
+def schedule_settings(ctx, **overrides):
+    settings = dict(DEFAULT_SCHEDULE_SETTINGS)
+    settings.update({name: value for name, value in ctx.settings.items() if name in settings})
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    return settings
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+
+
+class WallClock:
+    # Unlock dates are absolute, so unlike job_manager.RealClock this runs on
+    # wall-clock time.
+    def __init__(self):
+        self.wakeup = threading.Event()
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def wake(self):
+        self.wakeup.set()
+
+
+def release_by_copy(ctx, settings, bucket_name, key):
+    # The managed copy switches to a multipart copy for objects over 5 GB. Either
+    # way the copy keeps the source's tags, so the released copy is retagged or
+    # it would still read as sealed.
+    destination = f"{settings['release_prefix']}{key}"
+    s3 = ctx.client('s3')
+    s3.copy({'Bucket': bucket_name, 'Key': key}, bucket_name, destination)
+    set_capsule_tags(s3, bucket_name, destination, **{STATE_TAG: 'released'})
+    return destination
+
+
+def release_by_presign(ctx, settings, bucket_name, key):
+    return ctx.client('s3').generate_presigned_url(
+        'get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=settings['presign_expiry'])
+
+
+RELEASE_MODES = {
+    'copy': release_by_copy,
+    'presign': release_by_presign,
+}
+
+
+def set_capsule_tags(s3, bucket_name, key, **tags):
+    # put_object_tagging replaces the whole tag set, so merge with what is there.
+    current = s3.get_object_tagging(Bucket=bucket_name, Key=key)['TagSet']
+    merged = {tag['Key']: tag['Value'] for tag in current}
+    merged.update(tags)
+    s3.put_object_tagging(Bucket=bucket_name, Key=key,
+                          Tagging={'TagSet': [{'Key': name, 'Value': value} for name, value in merged.items()]})
+
+
+class CapsuleScheduler:
+    def __init__(self, ctx, path=None, clock=None, release=None, **overrides):
+        self.ctx = ctx
+        self.settings = schedule_settings(ctx, **overrides)
+        self.clock = clock or WallClock()
+        self.release = release or self._default_release
+        self.path = path or self.settings['schedule_path']
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.heap = []
+        self._load()
+
+    def _default_release(self, bucket_name, key):
+        location = RELEASE_MODES[self.settings['release_mode']](self.ctx, self.settings, bucket_name, key)
+        set_capsule_tags(self.ctx.client('s3'), bucket_name, key, **{STATE_TAG: 'released'})
+        return location
+
+    def _load(self):
+        # heapify is O(n), so a restart with a million sealed capsules stays quick.
+        self.heap = self.db.execute("SELECT due_at, bucket, key FROM capsules WHERE state = 'sealed'").fetchall()
+        heapq.heapify(self.heap)
+
+    def close(self):
+        # The thread finishes the batch it is releasing before the table closes.
+        if self.thread is not None:
+            self.stopping.set()
+            if hasattr(self.clock, 'wake'):
+                self.clock.wake()
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.db.close()
+
+    def schedule(self, bucket_name, key, unlock_at):
+        self.schedule_many([(bucket_name, key, unlock_at)])
+
+    def schedule_many(self, capsules):
+        rows = [(bucket_name, key, unlock_at, unlock_at) for bucket_name, key, unlock_at in capsules]
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO capsules (bucket, key, unlock_at, due_at, state) "
+                                "VALUES (?, ?, ?, ?, 'sealed')", rows)
+            self.db.commit()
+            entries = [(due_at, bucket_name, key) for bucket_name, key, _, due_at in rows]
+            if len(entries) > len(self.heap):
+                self.heap.extend(entries)
+                heapq.heapify(self.heap)
+            else:
+                for entry in entries:
+                    heapq.heappush(self.heap, entry)
+        if hasattr(self.clock, 'wake'):
+            self.clock.wake()
+
+    def next_due(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def pending_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM capsules WHERE state = 'sealed'").fetchone()[0]
+
+    def upcoming(self, limit=20):
+        with self.lock:
+            return self.db.execute("SELECT bucket, key, unlock_at, attempts FROM capsules WHERE state = 'sealed' "
+                                   "ORDER BY due_at LIMIT ?", (limit,)).fetchall()
+
+    def recent_releases(self, limit=20):
+        with self.lock:
+            return self.db.execute("SELECT bucket, key, state, location, error FROM capsules "
+                                   "WHERE state != 'sealed' ORDER BY released_at DESC LIMIT ?", (limit,)).fetchall()
+
+    def pop_due(self, limit):
+        # Rescheduled capsules leave their old heap entry behind, so entries are
+        # checked against the table and dropped when they no longer match.
+        now = self.clock.now()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now and len(due) < limit:
+                due_at, bucket_name, key = heapq.heappop(self.heap)
+                row = self.db.execute("SELECT due_at, state, attempts FROM capsules WHERE bucket = ? AND key = ?",
+                                      (bucket_name, key)).fetchone()
+                if row is None or row[1] != 'sealed' or row[0] != due_at:
+                    continue
+                due.append((bucket_name, key, row[2]))
+        return due
+
+    def _release_one(self, capsule):
+        bucket_name, key, attempts = capsule
+        try:
+            return capsule, self.release(bucket_name, key), None
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            return capsule, None, str(e)
+
+    def release_due(self, pool=None):
+        due = self.pop_due(self.settings['release_batch'])
+        if not due:
+            return {'released': 0, 'retrying': 0, 'failed': 0}
+
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=self.settings['release_workers']) as own_pool:
+                outcomes = list(own_pool.map(self._release_one, due))
+        else:
+            outcomes = list(pool.map(self._release_one, due))
+
+        now = self.clock.now()
+        released, retrying, failed = [], [], []
+        for (bucket_name, key, attempts), location, error in outcomes:
+            if error is None:
+                released.append((now, location, bucket_name, key))
+            elif attempts + 1 >= self.settings['max_release_attempts']:
+                failed.append((now, error, bucket_name, key))
+            else:
+                # Back off linearly so a missing permission does not spin.
+                retrying.append((now + self.settings['retry_delay'] * (attempts + 1), error, bucket_name, key))
+
+        with self.lock:
+            self.db.executemany("UPDATE capsules SET state = 'released', released_at = ?, location = ?, error = NULL "
+                                "WHERE bucket = ? AND key = ?", released)
+            self.db.executemany("UPDATE capsules SET state = 'failed', released_at = ?, error = ?, "
+                                "attempts = attempts + 1 WHERE bucket = ? AND key = ?", failed)
+            self.db.executemany("UPDATE capsules SET due_at = ?, error = ?, attempts = attempts + 1 "
+                                "WHERE bucket = ? AND key = ?", retrying)
+            self.db.commit()
+            for due_at, _, bucket_name, key in retrying:
+                heapq.heappush(self.heap, (due_at, bucket_name, key))
+
+        if released and hasattr(self.ctx, 'cache'):
+            self.ctx.cache.invalidate('objects')
+        return {'released': len(released), 'retrying': len(retrying), 'failed': len(failed)}
+
+    def run_once(self, pool=None):
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=self.settings['release_workers']) as pool:
+                return self.run_once(pool)
+        totals = {'released': 0, 'retrying': 0, 'failed': 0}
+        while True:
+            result = self.release_due(pool)
+            for name, count in result.items():
+                totals[name] += count
+            if not any(result.values()):
+                return totals
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.settings['release_workers']) as pool:
+            while not self.stopping.is_set():
+                result = self.run_once(pool)
+                if result['released'] or result['failed']:
+                    print(f"\n[Capsules: {result['released']} released, {result['failed']} failed]")
+                next_due = self.next_due()
+                wait = MAX_IDLE if next_due is None else next_due - self.clock.now()
+                self.clock.sleep(min(max(wait, 0), MAX_IDLE))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='capsule-scheduler', daemon=True)
+            self.thread.start()
+
+
+def seal(ctx, bucket_name, key, unlock_at):
+    # unlock_at is a timezone-aware datetime. The tags make the seal visible to
+    # anything reading the bucket, for example a bucket policy that denies
+    # s3:GetObject while timecapsule-state is sealed.
+    unlock_at = unlock_at.astimezone(timezone.utc)
+    set_capsule_tags(ctx.client('s3'), bucket_name, key,
+                     **{UNLOCK_TAG: unlock_at.strftime('%Y-%m-%dT%H:%M:%SZ'), STATE_TAG: 'sealed'})
+    ctx.schedule.schedule(bucket_name, key, unlock_at.timestamp())
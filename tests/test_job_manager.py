@@ -0,0 +1,176 @@
+import botocore.exceptions
+
+import EC2_manager
+import job_manager
+
+
+class FakeClock:
+    # Sleeping only advances the counter, so a 15-minute wait takes no time.
+    def __init__(self):
+        self.current = 0.0
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.current += seconds
+
+
+class FakePages:
+    def __init__(self, fleet, instance_ids):
+        self.fleet = fleet
+        self.instance_ids = instance_ids
+
+    def search(self, expression):
+        # Like EC2, one unknown ID fails the whole request.
+        for instance_id in self.instance_ids:
+            if instance_id not in self.fleet.ready_after:
+                code = 'InvalidInstanceID.Malformed' if not instance_id.startswith('i-') else 'InvalidInstanceID.NotFound'
+                raise botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': instance_id}},
+                                                      'DescribeInstances')
+        now = self.fleet.clock.now()
+        for instance_id in self.instance_ids:
+            ready_after = self.fleet.ready_after[instance_id]
+            yield [instance_id, 'pending' if ready_after is None or now < ready_after else 'running']
+
+
+class FakeFleet:
+    # Each known instance is running from its ready_after time on the fake
+    # clock, None never gets there.
+    def __init__(self, clock, ready_after, outages=0):
+        self.clock = clock
+        self.ready_after = ready_after
+        self.outages = outages
+        self.calls = 0
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, InstanceIds):
+        self.calls += 1
+        if self.calls <= self.outages:
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url='https://ec2.us-east-1.amazonaws.com')
+        return FakePages(self, InstanceIds)
+
+
+def run_jobs(ready_after, *id_lists, outages=0, callback=None):
+    clock = FakeClock()
+    fleet = FakeFleet(clock, ready_after, outages)
+    poller = job_manager.InstancePoller(fleet, clock)
+    jobs = [poller.submit(job_manager.Job('start', ids, 'running', failed_states=('terminated',),
+                                          started=clock.now())) for ids in id_lists]
+    if callback:
+        jobs[0].callbacks.append(callback)
+    while poller.active_jobs():
+        poller.run_once()
+    return jobs, fleet
+
+
+def test_jobs_finish_as_their_instances_come_up():
+    jobs, fleet = run_jobs({'i-1': 10, 'i-2': 10, 'i-3': 20}, ['i-1', 'i-2'], ['i-3'])
+
+    # Polls at 0, 4 and 12 (backing off), then 14, 18 and 26.
+    assert [job.finished for job in jobs] == [12, 26]
+    assert all(result['ok'] and result['state'] == 'running' for job in jobs for result in job.snapshot().values())
+    assert fleet.calls == 6
+
+
+def test_unknown_instance_does_not_stall_other_jobs():
+    jobs, fleet = run_jobs({'i-good': 5}, ['i-good'], ['i-gone'])
+    good, gone = jobs
+
+    assert good.snapshot()['i-good']['ok']
+    assert good.finished < job_manager.NOT_FOUND_GRACE
+    result = gone.snapshot()['i-gone']
+    assert not result['ok']
+    assert 'InvalidInstanceID.NotFound' in result['error']
+    assert job_manager.NOT_FOUND_GRACE <= gone.finished < job_manager.JOB_TIMEOUT
+
+
+def test_malformed_instance_fails_on_first_poll():
+    jobs, _ = run_jobs({'i-good': 5}, ['i-good', 'not-an-id'])
+
+    results = jobs[0].snapshot()
+    assert results['not-an-id']['error'].endswith('(InvalidInstanceID.Malformed)')
+    assert results['not-an-id']['at'] == 0
+    assert results['i-good']['ok']
+
+
+def test_instance_that_never_arrives_times_out():
+    jobs, _ = run_jobs({'i-slow': None}, ['i-slow'])
+
+    result = jobs[0].snapshot()['i-slow']
+    assert result == {'state': 'pending', 'ok': False, 'error': 'timed out waiting'}
+    assert jobs[0].finished >= job_manager.JOB_TIMEOUT
+
+
+def test_describe_isolating_splits_around_bad_ids():
+    clock = FakeClock()
+    fleet = FakeFleet(clock, {f"i-{n}": 0 for n in range(8)})
+    ids = [f"i-{n}" for n in range(8)] + ['i-gone']
+
+    states, unknown = job_manager.describe_isolating(
+        lambda ec2, batch: dict(ec2.paginate(InstanceIds=batch).search('')), fleet, ids)
+
+    assert states == {f"i-{n}": 'running' for n in range(8)}
+    assert unknown == {'i-gone': 'InvalidInstanceID.NotFound'}
+
+
+def test_snapshot_is_a_copy():
+    job = job_manager.Job('stop', ['i-1', 'i-2'], 'stopped')
+    snapshot = job.snapshot()
+    job.record('i-1', 'stopped', True)
+
+    assert snapshot == {}
+    assert job.pending == ['i-2']
+
+
+def test_connection_errors_are_missed_ticks():
+    jobs, fleet = run_jobs({'i-1': 0}, ['i-1'], outages=2)
+
+    assert jobs[0].snapshot()['i-1']['ok']
+    assert fleet.calls == 3
+
+
+def test_failing_callback_does_not_stop_the_poller(capsys):
+    def report(job):
+        raise botocore.exceptions.EndpointConnectionError(endpoint_url='https://ec2.us-east-1.amazonaws.com')
+
+    jobs, _ = run_jobs({'i-1': 0, 'i-2': 10}, ['i-1'], ['i-2'], callback=report)
+
+    assert all(job.done for job in jobs)
+    assert jobs[1].snapshot()['i-2']['ok']
+    assert 'follow-up after start failed' in capsys.readouterr().out
+
+
+def test_wait_for_fleet_uses_the_poller():
+    clock = FakeClock()
+    fleet = FakeFleet(clock, {'i-1': 20, 'i-2': None}, outages=1)
+
+    results = EC2_manager.wait_for_fleet(fleet, ['i-1', 'i-2'], 'running', delay=15, timeout=60, sleep=clock.sleep)
+
+    # The outage at 15 s is a missed tick, not a failure.
+    assert results['i-1']['ok'] and results['i-1']['at'] == 30
+    assert results['i-2'] == {'state': 'pending', 'ok': False, 'error': 'timed out waiting'}
+    assert clock.now() == 60
+
+
+def test_bad_id_does_not_fail_the_rest_of_its_chunk():
+    known = {f"i-{n}" for n in range(6)}
+    sent = []
+
+    def start_instances(InstanceIds):
+        # Like EC2, one unknown ID rejects the whole call.
+        missing = [instance_id for instance_id in InstanceIds if instance_id not in known]
+        if missing:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': f"{missing} do not exist"}},
+                'StartInstances')
+        sent.extend(InstanceIds)
+
+    results = {}
+    accepted = EC2_manager.send_isolating(start_instances, sorted(known) + ['i-gone'], results)
+
+    assert sorted(accepted) == sorted(sent) == sorted(known)
+    assert list(results) == ['i-gone']
+    assert not results['i-gone']['ok']
@@ -0,0 +1,145 @@
+import boto3
+import botocore.endpoint
+import botocore.exceptions
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+
+import retry_manager
+
+S3_LISTING = (b'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>bkt1</Name>'
+              b'<KeyCount>0</KeyCount><IsTruncated>false</IsTruncated></ListBucketResult>')
+S3_SLOW_DOWN = b'<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'
+IAM_USERS = (b'<ListUsersResponse xmlns="https://iam.amazonaws.com/doc/2010-05-08/"><ListUsersResult>'
+             b'<Users/><IsTruncated>false</IsTruncated></ListUsersResult></ListUsersResponse>')
+IAM_THROTTLED = (b'<ErrorResponse xmlns="https://iam.amazonaws.com/doc/2010-05-08/"><Error><Type>Sender</Type>'
+                 b'<Code>ThrottlingException</Code><Message>Rate exceeded</Message></Error></ErrorResponse>')
+
+
+class RawBody:
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, **kwargs):
+        yield self.data
+
+
+class ScriptedEndpoint:
+    # Answers each HTTP attempt from a script of (status, body), the way AWS
+    # would. botocore's Stubber answers in before-call, ahead of the retry
+    # loop, so it cannot show retries; this sits in before-send instead.
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.attempts = 0
+
+    def __call__(self, request, **kwargs):
+        status, body = self.responses[min(self.attempts, len(self.responses) - 1)]
+        self.attempts += 1
+        return AWSResponse(request.url, status, {}, RawBody(body))
+
+
+class FakeClock:
+    def __init__(self):
+        self.current = 0.0
+        self.slept = []
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.current += seconds
+
+
+@pytest.fixture(autouse=True)
+def fresh_settings(monkeypatch):
+    # Full jitter picks its ceiling, and botocore's back-off sleeps are recorded
+    # rather than waited out.
+    monkeypatch.setattr(retry_manager.random, 'uniform', lambda low, high: high)
+    slept = []
+    monkeypatch.setattr(botocore.endpoint.time, 'sleep', slept.append)
+    retry_manager.configure(max_attempts=retry_manager.DEFAULT_MAX_ATTEMPTS, rate_limits={'iam': None})
+    retry_manager.reset_metrics()
+    yield slept
+    retry_manager.configure(max_attempts=retry_manager.DEFAULT_MAX_ATTEMPTS, rate_limits={})
+    retry_manager.reset_metrics()
+
+
+def scripted_client(service, endpoint):
+    client = boto3.session.Session().client(service, region_name='us-east-1',
+                                            config=Config(retries={'total_max_attempts': 1, 'mode': 'standard'}))
+    retry_manager.install(client)
+    client.meta.events.register(f"before-send.{service}", endpoint)
+    return client
+
+
+@pytest.mark.parametrize('service, call, throttled, ok', [
+    ('s3', lambda client: client.list_objects_v2(Bucket='bkt1'), (503, S3_SLOW_DOWN), (200, S3_LISTING)),
+    ('iam', lambda client: client.list_users(), (400, IAM_THROTTLED), (200, IAM_USERS)),
+])
+def test_throttled_calls_back_off_and_retry(fresh_settings, service, call, throttled, ok):
+    endpoint = ScriptedEndpoint(throttled, throttled, ok)
+
+    call(scripted_client(service, endpoint))
+
+    counters = retry_manager.metrics()[service]
+    assert endpoint.attempts == 3
+    assert counters['attempts'] == 3
+    assert counters['throttles'] == 2
+    assert counters['retries'] == 2
+    # Exponential ceilings for the first and second retry.
+    assert fresh_settings == [0.2, 0.4]
+    assert counters['backoff_seconds'] == pytest.approx(0.6)
+
+
+def test_gives_up_after_max_attempts():
+    retry_manager.configure(max_attempts=3)
+    endpoint = ScriptedEndpoint((503, S3_SLOW_DOWN))
+
+    with pytest.raises(botocore.exceptions.ClientError) as caught:
+        scripted_client('s3', endpoint).list_objects_v2(Bucket='bkt1')
+
+    assert caught.value.response['Error']['Code'] == 'SlowDown'
+    assert endpoint.attempts == 3
+    assert retry_manager.metrics()['s3']['gave_up'] == 1
+
+
+def test_throttling_slows_the_limiter():
+    retry_manager.configure(rate_limits={'s3': 100})
+    endpoint = ScriptedEndpoint((503, S3_SLOW_DOWN), (200, S3_LISTING))
+
+    scripted_client('s3', endpoint).list_objects_v2(Bucket='bkt1')
+
+    # The limiter runs on the real clock, so allow for a little recovery since.
+    limiter = retry_manager.limiter_for('s3', 'ListObjectsV2')
+    assert limiter.rate == pytest.approx(100 * retry_manager.THROTTLE_FACTOR, rel=0.01)
+
+
+def test_empty_bucket_makes_callers_wait():
+    clock = FakeClock()
+    bucket = retry_manager.TokenBucket(10, burst=2, clock=clock.now, sleep=clock.sleep)
+
+    # The burst goes through at once, then each call waits for the next token.
+    assert [bucket.acquire() for _ in range(4)] == [0.0, 0.0, pytest.approx(0.1), pytest.approx(0.1)]
+    assert clock.slept == [pytest.approx(0.1), pytest.approx(0.1)]
+
+
+def test_empty_bucket_reservations_queue_up():
+    clock = FakeClock()
+    bucket = retry_manager.TokenBucket(10, burst=1, clock=clock.now, sleep=clock.sleep)
+
+    waits = [bucket.reserve() for _ in range(3)]
+
+    assert waits == [0.0, pytest.approx(0.1), pytest.approx(0.2)]
+    assert clock.slept == []
+
+
+def test_throttle_cuts_the_rate_once_per_window():
+    clock = FakeClock()
+    bucket = retry_manager.TokenBucket(100, clock=clock.now, sleep=clock.sleep)
+
+    bucket.throttled()
+    bucket.throttled()
+
+    assert bucket.rate == pytest.approx(100 * retry_manager.THROTTLE_FACTOR)
+    assert bucket.tokens <= 0
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import benchmarks
+
+# Service modules load lazily so the login menu shows up fast, see main.py.
+# The startup time budget itself is checked by `benchmarks.py startup`.
+HEAVY_MODULES = ('boto3', 'botocore', 'moto', 'EC2_manager', 'S3_manager', 'IAM_manager')
+
+# Runs main.py as a script and, when it asks for the first menu choice, lists
+# the heavy modules already loaded, then leaves before anything is chosen.
+AT_FIRST_PROMPT = f"""
+import builtins, runpy, sys
+
+def first_prompt(prompt=''):
+    print(' '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+    raise SystemExit(0)
+
+builtins.input = first_prompt
+runpy.run_path('main.py', run_name='__main__')
+"""
+
+
+def loaded_modules(code):
+    return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(benchmarks.__file__))).stdout.splitlines()
+
+
+def test_main_imports_no_service_modules():
+    loaded = loaded_modules(f"import sys, main; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    assert loaded[-1].split() == []
+
+
+def test_first_prompt_loads_no_aws_modules():
+    loaded = loaded_modules(AT_FIRST_PROMPT)
+    # The welcome banner comes first; the module list is printed at the prompt.
+    assert loaded[-1].split() == []
@@ -0,0 +1,283 @@
+import json
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+import client_manager
+
+# Per-call instrumentation for every client handed out by client_manager. Two
+# botocore event hooks wrap each API call: before-call notes the start time in
+# the request context, after-call (or after-call-error) records latency, bytes
+# and the outcome. Retries happen inside the call, botocore reports how many
+# there were in ResponseMetadata. Every call lands in a per-operation
+# histogram, and a sample of them is also kept as spans. While tracing is off
+# the hooks are not registered at all, so calls pay nothing.
+#
+# Exports: Prometheus text (.prom), JSON lines (.jsonl) or an OpenTelemetry
+# style span dump (.json).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+DEFAULT_MAX_SPANS = 10_000
+METRIC_PREFIX = 'timecapsule_aws'
+
+_settings = {
+    'enabled': False,
+    'sample_rate': 1.0,
+}
+_operations = {}
+_spans = deque(maxlen=DEFAULT_MAX_SPANS)
+_lock = threading.Lock()
+
+
+class OperationStats:
+    __slots__ = ('service', 'operation', 'count', 'total_seconds', 'buckets', 'bytes_sent', 'bytes_received',
+                 'retries', 'errors')
+
+    def __init__(self, service, operation):
+        self.service = service
+        self.operation = operation
+        self.count = 0
+        self.total_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.errors = {}
+
+    def as_dict(self):
+        return {'service': self.service, 'operation': self.operation, 'count': self.count,
+                'total_seconds': self.total_seconds, 'buckets': dict(zip(map(str, LATENCY_BUCKETS), self.buckets)),
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99), 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received, 'retries': self.retries, 'errors': dict(self.errors)}
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th call, as Prometheus would estimate it.
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+def configure(enabled=None, sample_rate=None, max_spans=None):
+    # Process-wide like retry_manager. Switching on or off updates the hooks on
+    # clients that already exist as well as the ones created later.
+    global _spans
+    if sample_rate is not None:
+        _settings['sample_rate'] = float(sample_rate)
+    if max_spans is not None and max_spans != _spans.maxlen:
+        with _lock:
+            _spans = deque(_spans, maxlen=int(max_spans))
+    if enabled is not None and bool(enabled) != _settings['enabled']:
+        _settings['enabled'] = bool(enabled)
+        for client in client_manager.clients():
+            if enabled:
+                install(client)
+            else:
+                uninstall(client)
+
+
+def enabled():
+    return _settings['enabled']
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+        _spans.clear()
+
+
+def _request_bytes(params):
+    # Bodies arrive as bytes or as file objects positioned at the start of the
+    # part being sent, which are measured without being read.
+    body = params.get('body')
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    try:
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        length = params.get('headers', {}).get('Content-Length')
+        return int(length) if length else 0
+
+
+def _before_call(params=None, context=None, **kwargs):
+    context['timecapsule_trace'] = (time.time_ns(), time.perf_counter(), _request_bytes(params or {}))
+
+
+def _finish(model, context, status, metadata, error_code):
+    started = context.pop('timecapsule_trace', None)
+    if started is None:
+        return
+    start_ns, start, sent = started
+    elapsed = time.perf_counter() - start
+    # A HEAD response's content-length is the object's size, not a body that arrived.
+    received = 0 if model.http.get('method') == 'HEAD' else int(metadata.get('HTTPHeaders', {}).get('content-length') or 0)
+    retries = metadata.get('RetryAttempts', 0)
+
+    with _lock:
+        # Operation models are cached by botocore, so they make a cheap key.
+        stats = _operations.get(model)
+        if stats is None:
+            stats = _operations[model] = OperationStats(model.service_model.service_id.hyphenize(), model.name)
+        stats.count += 1
+        stats.total_seconds += elapsed
+        stats.buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        stats.bytes_sent += sent
+        stats.bytes_received += received
+        stats.retries += retries
+        if error_code:
+            stats.errors[error_code] = stats.errors.get(error_code, 0) + 1
+
+    rate = _settings['sample_rate']
+    if rate >= 1.0 or random.random() < rate:
+        span = (start_ns, start_ns + int(elapsed * 1e9), stats.service, stats.operation, status, retries, error_code,
+                sent, received, metadata.get('RequestId'))
+        with _lock:
+            _spans.append(span)
+
+
+def _after_call(http_response=None, parsed=None, model=None, context=None, **kwargs):
+    parsed = parsed or {}
+    error_code = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+    _finish(model, context, http_response.status_code, parsed.get('ResponseMetadata', {}), error_code)
+
+
+def _after_call_error(exception=None, model=None, context=None, **kwargs):
+    # Connection failures that outlived the retries never get a response.
+    _finish(model, context, None, {}, type(exception).__name__)
+
+
+def install(client):
+    # Registered on the full service.operation pattern and first in line, so the
+    # start time is taken before handlers that answer the call themselves, like
+    # Stubber or the local permission check, get to run.
+    if not _settings['enabled']:
+        return client
+    events = client.meta.events
+    events.register_first('before-call.*.*', _before_call, unique_id='timecapsule-trace-start')
+    events.register('after-call.*.*', _after_call, unique_id='timecapsule-trace-end')
+    events.register('after-call-error.*.*', _after_call_error, unique_id='timecapsule-trace-error')
+    return client
+
+
+def uninstall(client):
+    events = client.meta.events
+    events.unregister('before-call.*.*', unique_id='timecapsule-trace-start')
+    events.unregister('after-call.*.*', unique_id='timecapsule-trace-end')
+    events.unregister('after-call-error.*.*', unique_id='timecapsule-trace-error')
+    return client
+
+
+def snapshot():
+    with _lock:
+        return [stats.as_dict() for stats in _operations.values()]
+
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def prometheus_text():
+    lines = [f"# HELP {METRIC_PREFIX}_call_duration_seconds Latency of AWS API calls, retries included.",
+             f"# TYPE {METRIC_PREFIX}_call_duration_seconds histogram"]
+    operations = sorted(snapshot(), key=lambda stats: (stats['service'], stats['operation']))
+    for stats in operations:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stats['buckets'].values()):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{METRIC_PREFIX}_call_duration_seconds_bucket"
+                         f"{_labels(service=stats['service'], operation=stats['operation'], le=le)} {cumulative}")
+        labels = _labels(service=stats['service'], operation=stats['operation'])
+        lines.append(f"{METRIC_PREFIX}_call_duration_seconds_sum{labels} {stats['total_seconds']}")
+        lines.append(f"{METRIC_PREFIX}_call_duration_seconds_count{labels} {stats['count']}")
+
+    for name, field, text in (('bytes_sent_total', 'bytes_sent', "Request body bytes sent."),
+                              ('bytes_received_total', 'bytes_received', "Response body bytes received."),
+                              ('retries_total', 'retries', "Retried attempts.")):
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+        for stats in operations:
+            labels = _labels(service=stats['service'], operation=stats['operation'])
+            lines.append(f"{METRIC_PREFIX}_{name}{labels} {stats[field]}")
+
+    lines.append(f"# HELP {METRIC_PREFIX}_errors_total Failed calls by error code.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_errors_total counter")
+    for stats in operations:
+        for code, count in sorted(stats['errors'].items()):
+            lines.append(f"{METRIC_PREFIX}_errors_total"
+                         f"{_labels(service=stats['service'], operation=stats['operation'], code=code)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def json_lines():
+    return ''.join(json.dumps(stats) + '\n' for stats in snapshot())
+
+
+def _attribute(key, value):
+    kind = 'intValue' if isinstance(value, int) else 'stringValue'
+    return {'key': key, 'value': {kind: value}}
+
+
+def span_dump():
+    # Shaped like an OTLP/JSON export so collectors and viewers can read it.
+    # Calls are independent, so each span is its own trace.
+    otel_spans = []
+    for start_ns, end_ns, service, operation, status, retries, error_code, sent, received, request_id in spans():
+        attributes = [_attribute('rpc.system', 'aws-api'), _attribute('rpc.service', service),
+                      _attribute('rpc.method', operation), _attribute('aws.retries', retries),
+                      _attribute('aws.bytes_sent', sent), _attribute('aws.bytes_received', received)]
+        if status is not None:
+            attributes.append(_attribute('http.status_code', status))
+        if request_id:
+            attributes.append(_attribute('aws.request_id', request_id))
+        if error_code:
+            attributes.append(_attribute('aws.error_code', error_code))
+        otel_spans.append({
+            'traceId': os.urandom(16).hex(),
+            'spanId': os.urandom(8).hex(),
+            'name': f"{service}.{operation}",
+            'kind': 3,  # SPAN_KIND_CLIENT
+            'startTimeUnixNano': str(start_ns),
+            'endTimeUnixNano': str(end_ns),
+            'attributes': attributes,
+            'status': {'code': 2, 'message': error_code} if error_code else {'code': 1},
+        })
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', 'timecapsule')]},
+        'scopeSpans': [{'scope': {'name': 'timecapsule.trace_manager'}, 'spans': otel_spans}],
+    }]}
+
+
+EXPORTERS = {
+    '.prom': prometheus_text,
+    '.jsonl': json_lines,
+    '.json': lambda: json.dumps(span_dump()),
+}
+
+
+def export(path):
+    # The format follows the file extension.
+    extension = os.path.splitext(path)[1]
+    if extension not in EXPORTERS:
+        raise ValueError(f"Unknown trace export format {extension}, use one of {', '.join(EXPORTERS)}.")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as target:
+        target.write(EXPORTERS[extension]())
+    os.replace(tmp_path, path)
+    return path
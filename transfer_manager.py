@@ -0,0 +1,438 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import botocore
+
+import S3_manager
+import index_manager
+
+# Parallel multipart transfers for capsule archives. Settings come from the
+# AppContext settings and can be overridden per call.
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+DEFAULT_TRANSFER_SETTINGS = {
+    'multipart_threshold': 64 * MB,
+    'part_size': 16 * MB,
+    'upload_concurrency': 8,
+    'sync_workers': 16,
+    'download_concurrency': 8,
+    'verify_downloads': True,
+    'use_mmap': False,
+    'manifest_dir': '.timecapsule_uploads',
+    # 'threads' or 'async'. The async backend (async_manager) needs aiobotocore
+    # and suits prefixes of many small files.
+    'transfer_backend': 'threads',
+}
+
+
+def transfer_settings(ctx, **overrides):
+    settings = dict(DEFAULT_TRANSFER_SETTINGS)
+    settings.update({name: value for name, value in ctx.settings.items() if name in settings})
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    return settings
+
+
+class WorkerErrors:
+    # Workers record the failures they expect themselves. Anything else would
+    # vanish with its future, which the bounded loops do not keep, so the first
+    # one is held here and raised once the pool has drained.
+    def __init__(self):
+        self.error = None
+
+    def __call__(self, future):
+        if self.error is None and not future.cancelled() and future.exception() is not None:
+            self.error = future.exception()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+
+def choose_part_size(file_size, part_size):
+    part_size = max(part_size, MIN_PART_SIZE)
+    # S3 allows at most 10,000 parts, so very large files need bigger parts.
+    while file_size > part_size * MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+
+def manifest_path(settings, file_path, bucket_name, key):
+    digest = hashlib.sha1(f"{os.path.abspath(file_path)}|{bucket_name}|{key}".encode()).hexdigest()
+    return os.path.join(settings['manifest_dir'], f"{digest}.json")
+
+
+def load_manifest(path):
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, path)
+
+
+def remove_manifest(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def upload(ctx, file_path, bucket_name, key, progress=None, **overrides):
+    settings = transfer_settings(ctx, **overrides)
+    file_size = os.path.getsize(file_path)
+
+    etag = None
+    if file_size < settings['multipart_threshold'] or file_size == 0:
+        with open(file_path, 'rb') as body:
+            etag = ctx.client('s3').put_object(Bucket=bucket_name, Key=key, Body=body)['ETag'].strip('"')
+        if progress:
+            progress(file_size, file_size)
+        result = {'Bucket': bucket_name, 'Key': key, 'Size': file_size, 'Parts': 1, 'Resumed': 0}
+    else:
+        result = multipart_upload(ctx, file_path, bucket_name, key, settings, progress)
+
+    ctx.cache.invalidate('objects', bucket_name)
+    if index_manager.has_index(ctx, bucket_name):
+        ctx.index.upsert(bucket_name, [index_manager.written_row(key, file_size, etag)])
+    return result
+
+
+def completed_parts(s3, manifest):
+    # The manifest says what we finished, list_parts says what S3 actually kept.
+    parts = {}
+    paginator = s3.get_paginator('list_parts')
+    pages = paginator.paginate(Bucket=manifest['bucket'], Key=manifest['key'], UploadId=manifest['upload_id'])
+    for page in pages:
+        for part in page.get('Parts', []):
+            parts[str(part['PartNumber'])] = part['ETag']
+    return parts
+
+
+def resume_or_start(s3, path, file_path, bucket_name, key, file_size, part_size):
+    stat = os.stat(file_path)
+    manifest = load_manifest(path)
+    if manifest and (manifest.get('size'), manifest.get('mtime'), manifest.get('part_size')) == (file_size, stat.st_mtime, part_size):
+        try:
+            manifest['parts'] = completed_parts(s3, manifest)
+            return manifest
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+
+    response = s3.create_multipart_upload(Bucket=bucket_name, Key=key)
+    manifest = {
+        'bucket': bucket_name,
+        'key': key,
+        'file': os.path.abspath(file_path),
+        'size': file_size,
+        'mtime': stat.st_mtime,
+        'part_size': part_size,
+        'upload_id': response['UploadId'],
+        'parts': {},
+    }
+    save_manifest(path, manifest)
+    return manifest
+
+
+def multipart_upload(ctx, file_path, bucket_name, key, settings, progress=None):
+    s3 = ctx.client('s3')
+    file_size = os.path.getsize(file_path)
+    part_size = choose_part_size(file_size, settings['part_size'])
+    part_count = (file_size + part_size - 1) // part_size
+    path = manifest_path(settings, file_path, bucket_name, key)
+
+    manifest = resume_or_start(s3, path, file_path, bucket_name, key, file_size, part_size)
+    resumed = len(manifest['parts'])
+    pending = [number for number in range(1, part_count + 1) if str(number) not in manifest['parts']]
+
+    lock = threading.Lock()
+    sent = [sum(min(part_size, file_size - (int(number) - 1) * part_size) for number in manifest['parts'])]
+    if progress:
+        progress(sent[0], file_size)
+
+    with open(file_path, 'rb') as source:
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if settings['use_mmap'] else None
+
+        def read_part(number):
+            offset = (number - 1) * part_size
+            length = min(part_size, file_size - offset)
+            if mapped is not None:
+                return mapped[offset:offset + length]
+            with open(file_path, 'rb') as part_file:
+                part_file.seek(offset)
+                return part_file.read(length)
+
+        def send_part(number):
+            body = read_part(number)
+            response = s3.upload_part(Bucket=bucket_name, Key=key, UploadId=manifest['upload_id'],
+                                      PartNumber=number, Body=body)
+            with lock:
+                manifest['parts'][str(number)] = response['ETag']
+                save_manifest(path, manifest)
+                sent[0] += len(body)
+                if progress:
+                    progress(sent[0], file_size)
+
+        try:
+            with ThreadPoolExecutor(max_workers=settings['upload_concurrency']) as pool:
+                futures = [pool.submit(send_part, number) for number in pending]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+    parts = [{'PartNumber': int(number), 'ETag': etag} for number, etag in manifest['parts'].items()]
+    parts.sort(key=lambda part: part['PartNumber'])
+    s3.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=manifest['upload_id'],
+                                 MultipartUpload={'Parts': parts})
+    remove_manifest(path)
+    return {'Bucket': bucket_name, 'Key': key, 'Size': file_size, 'Parts': part_count, 'Resumed': resumed}
+
+
+def file_md5(path, block_size=MB):
+    digest = hashlib.md5()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(block_size), b''):
+            digest.update(block)
+    return digest
+
+
+def local_etag(path, settings):
+    # Reproduces the ETag S3 would give the file when uploaded with these settings:
+    # plain MD5 for single requests, MD5 of the part MD5s plus "-N" for multipart.
+    file_size = os.path.getsize(path)
+    if file_size < settings['multipart_threshold'] or file_size == 0:
+        return file_md5(path).hexdigest()
+
+    part_size = choose_part_size(file_size, settings['part_size'])
+    digests = []
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(part_size), b''):
+            digests.append(hashlib.md5(block).digest())
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def needs_upload(path, remote, settings):
+    if remote is None:
+        return True
+    stat = os.stat(path)
+    if stat.st_size != remote.size:
+        return True
+    if remote.last_modified and stat.st_mtime <= remote.last_modified.timestamp():
+        return False
+    # Same size but touched locally since the upload, only the content can tell.
+    return local_etag(path, settings) != remote.etag
+
+
+def walk_directory(local_dir, prefix=''):
+    for root, _, files in os.walk(local_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, local_dir).replace(os.sep, '/')
+            yield path, f"{prefix.rstrip('/')}/{relative}" if prefix else relative
+
+
+def sync_directory(ctx, local_dir, bucket_name, prefix='', workers=None, **overrides):
+    settings = transfer_settings(ctx, **overrides)
+    if settings['transfer_backend'] == 'async':
+        import async_manager
+        return async_manager.sync_directory(ctx, local_dir, bucket_name, prefix, concurrency=workers)
+    workers = workers or settings['sync_workers']
+
+    # One paginated listing of the remote prefix instead of a HEAD per file.
+    remote = {record.key: record for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix, use_cache=False)}
+
+    result = {'uploaded': 0, 'skipped': 0, 'failed': [], 'bytes': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def sync_one(path, key):
+        try:
+            if not needs_upload(path, remote.get(key), settings):
+                with lock:
+                    result['skipped'] += 1
+                return
+            # Files are already uploaded in parallel, so keep each one to a single stream.
+            sent = upload(ctx, path, bucket_name, key, **dict(overrides, upload_concurrency=1))
+            with lock:
+                result['uploaded'] += 1
+                result['bytes'] += sent['Size']
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError, OSError) as e:
+            with lock:
+                result['failed'].append((key, str(e)))
+        finally:
+            slots.release()
+
+    unexpected = WorkerErrors()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, key in walk_directory(local_dir, prefix):
+            slots.acquire()
+            pool.submit(sync_one, path, key).add_done_callback(unexpected)
+    elapsed = time.perf_counter() - start
+    unexpected.check()
+
+    files = result['uploaded'] + result['skipped']
+    result['elapsed'] = elapsed
+    result['files_per_s'] = files / elapsed if elapsed else 0.0
+    result['bytes_per_s'] = result['bytes'] / elapsed if elapsed else 0.0
+    return result
+
+
+def multipart_etag_matches(s3, bucket_name, key, path, etag):
+    part_count = int(etag.split('-')[1])
+    part_size = s3.head_object(Bucket=bucket_name, Key=key, PartNumber=1)['ContentLength']
+    digests = []
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(part_size), b''):
+            digests.append(hashlib.md5(block).digest())
+    return len(digests) == part_count and hashlib.md5(b''.join(digests)).hexdigest() == etag.split('-')[0]
+
+
+def verify_download(s3, bucket_name, key, path, head):
+    # KMS-encrypted objects do not use an MD5 ETag, so there is nothing to compare.
+    if head.get('ServerSideEncryption') == 'aws:kms':
+        return None
+    etag = head['ETag'].strip('"')
+    if '-' in etag:
+        return multipart_etag_matches(s3, bucket_name, key, path, etag)
+    return file_md5(path).hexdigest() == etag
+
+
+class FileWriter:
+    # Writes parts straight into their offsets of a preallocated file, so nothing
+    # has to be stitched together afterwards. Falls back to mmap without pwrite.
+    def __init__(self, path, size):
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.mapped = None
+        if not hasattr(os, 'pwrite') and size:
+            self.mapped = mmap.mmap(self.file.fileno(), size)
+
+    def write(self, data, offset):
+        if self.mapped is not None:
+            self.mapped[offset:offset + len(data)] = data
+        else:
+            os.pwrite(self.file.fileno(), data, offset)
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+        self.file.close()
+
+
+def download(ctx, bucket_name, key, local_path, progress=None, **overrides):
+    settings = transfer_settings(ctx, **overrides)
+    s3 = ctx.client('s3')
+    head = s3.head_object(Bucket=bucket_name, Key=key)
+    file_size = head['ContentLength']
+    part_size = choose_part_size(file_size, settings['part_size'])
+    ranges = [(offset, min(offset + part_size, file_size) - 1) for offset in range(0, file_size, part_size)]
+    concurrency = settings['download_concurrency'] if file_size >= settings['multipart_threshold'] else 1
+
+    directory = os.path.dirname(local_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{local_path}.download"
+    writer = FileWriter(tmp_path, file_size)
+    lock = threading.Lock()
+    received = [0]
+
+    def fetch_range(first, last):
+        # IfMatch makes every range come from the same version of the object.
+        response = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={first}-{last}", IfMatch=head['ETag'])
+        offset = first
+        for chunk in response['Body'].iter_chunks(MB):
+            writer.write(chunk, offset)
+            offset += len(chunk)
+            with lock:
+                received[0] += len(chunk)
+                if progress:
+                    progress(received[0], file_size)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(fetch_range, first, last) for first, last in ranges]
+            for future in as_completed(futures):
+                future.result()
+        writer.close()
+        if settings['verify_downloads'] and verify_download(s3, bucket_name, key, tmp_path, head) is False:
+            raise ValueError(f"Checksum mismatch for {key}, the download was discarded.")
+        os.replace(tmp_path, local_path)
+    except BaseException:
+        writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return {'Bucket': bucket_name, 'Key': key, 'Path': local_path, 'Size': file_size, 'Parts': len(ranges)}
+
+
+def local_path_for(local_dir, prefix, key):
+    relative = key[len(prefix):].lstrip('/') if prefix else key
+    path = os.path.abspath(os.path.join(local_dir, *relative.split('/')))
+    # Keys like "../x" must not escape the target directory.
+    if os.path.commonpath([path, os.path.abspath(local_dir)]) != os.path.abspath(local_dir):
+        raise ValueError(f"Refusing to write {key} outside {local_dir}.")
+    return path
+
+
+def download_prefix(ctx, bucket_name, prefix, local_dir, workers=None, **overrides):
+    settings = transfer_settings(ctx, **overrides)
+    if settings['transfer_backend'] == 'async':
+        import async_manager
+        return async_manager.download_prefix(ctx, bucket_name, prefix, local_dir, concurrency=workers)
+    workers = workers or settings['sync_workers']
+
+    result = {'downloaded': 0, 'failed': [], 'bytes': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def fetch_one(key):
+        try:
+            # Objects are already fetched in parallel, so keep each one to a single stream.
+            fetched = download(ctx, bucket_name, key, local_path_for(local_dir, prefix, key),
+                               **dict(overrides, download_concurrency=1))
+            with lock:
+                result['downloaded'] += 1
+                result['bytes'] += fetched['Size']
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError, OSError, ValueError) as e:
+            with lock:
+                result['failed'].append((key, str(e)))
+        finally:
+            slots.release()
+
+    unexpected = WorkerErrors()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in S3_manager.iter_objects(ctx, bucket_name, prefix=prefix, use_cache=False):
+            if record.key.endswith('/'):
+                continue
+            slots.acquire()
+            pool.submit(fetch_one, record.key).add_done_callback(unexpected)
+    elapsed = time.perf_counter() - start
+    unexpected.check()
+
+    result['elapsed'] = elapsed
+    result['files_per_s'] = result['downloaded'] / elapsed if elapsed else 0.0
+    result['bytes_per_s'] = result['bytes'] / elapsed if elapsed else 0.0
+    return result
+
+
+def print_progress(done, total):
+    percent = done * 100 // total if total else 100
+    print(f"\rTransferred {done / MB:.1f} of {total / MB:.1f} MB ({percent}%)", end='' if done < total else '\n')